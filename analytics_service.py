@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from config import DB_PATH
+from query_api import STATEMENTS, PARTITIONED_STATEMENTS, bind_parameters, statement_sql
+from query_cache import normalize_sql
+from query_sql import queries, question_sql
+
+# Long-lived, read-only HTTP service for the analytics queries.
+# Usage: python analytics_service.py [--port 8765] [--pool-size 8]
+#
+#   GET  /queries          the named questions of query_sql.py and their ids (Q1 ... Q6)
+#   GET  /queries/Q1       the result of one named question
+#   GET  /api              the parameterized statements of query_api.py and their default parameters
+#   GET  /api/<statement>  one statement, e.g. /api/top_brands_by_scans?months=3&statuses=FINISHED,FLAGGED&limit=10
+#   POST /sql              an ad-hoc query: {"sql": "SELECT ...", "params": [...]}
+#   GET  /health           pool and request counters
+#
+# Results are JSON objects {"columns": [...], "rows": [[...], ...], "truncated": bool, "seconds": s};
+# BLOB values are returned as hex text.
+#
+# The server is a single asyncio event loop (stdlib only, HTTP/1.1 with keep-alive). Queries run in
+# a thread pool on a pool of read-only connections to fetch_data.db: sqlite3 releases the GIL while
+# a statement runs, and load_to_sql.py leaves the database in WAL mode, so readers run concurrently
+# with each other and with a reload. Each connection gets a large page cache and maps the database
+# file into memory, so hot pages are read without a system call. A request for a query that is
+# already running (same normalized SQL and parameters) waits for that execution instead of
+# starting another one, so a burst of dashboards asking the same question costs one query.
+#
+# Connections are opened with mode=ro and PRAGMA query_only, so ad-hoc SQL cannot write; it is
+# interrupted after --timeout seconds and its result cut at --max-rows rows.
+
+POOL_PRAGMAS = {
+    "mmap_size": 1024 * 1024 * 1024,   # bytes, the first 1 GiB of the database file
+    "cache_size": -64 * 1024,          # KiB, i.e. 64 MiB of page cache per connection
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
+
+# Virtual machine instructions between two checks of the query deadline
+PROGRESS_STEPS = 10_000
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error", 504: "Gateway Timeout"}
+
+
+def question_ids(named_queries=queries):
+    """
+    Map the id of every named question ("Q1") to its full name and SQL.
+    """
+    return {question.split(":")[0]: (question, sql) for question, sql in named_queries.items()}
+
+
+def json_value(value):
+    """
+    JSON form of the result values json cannot encode itself: BLOBs become hex text.
+    """
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"cannot encode {type(value).__name__} as JSON")
+
+
+def encode_response(status, result):
+    """
+    Encode a response body as JSON; a result that cannot be encoded becomes a 500 error.
+    """
+    try:
+        return status, json.dumps(result, default=json_value).encode()
+    except (TypeError, ValueError) as e:
+        return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A fixed set of read-only connections to `db_path`, each used by one thread at a time.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=8, pragmas=POOL_PRAGMAS):
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite")
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+            for pragma, value in pragmas.items():
+                conn.execute(f"PRAGMA {pragma} = {value}")
+            self._idle.put_nowait(conn)
+        self.journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+    @property
+    def idle(self):
+        return self._idle.qsize()
+
+    async def call(self, function, *args):
+        """
+        Run function(connection, *args) on an idle connection in the thread pool.
+        """
+        conn = await self._idle.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, conn, *args)
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def run(self, sql, params=(), timeout=30.0, max_rows=10_000):
+        """
+        Execute `sql` on an idle connection in the thread pool; returns the result object (see the header).
+        """
+        return await self.call(execute, sql, params, timeout, max_rows)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+def execute(conn, sql, params, timeout, max_rows):
+    deadline = time.perf_counter() + timeout
+    conn.set_progress_handler(lambda: time.perf_counter() > deadline, PROGRESS_STEPS)
+    start = time.perf_counter()
+    try:
+        cursor = conn.execute(sql, params)
+        rows = cursor.fetchmany(max_rows + 1)
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e) and time.perf_counter() > deadline:
+            raise QueryTimeout(f"query interrupted after {timeout:g}s") from e
+        raise
+    finally:
+        conn.set_progress_handler(None, PROGRESS_STEPS)
+    columns = [column[0] for column in cursor.description or []]
+    cursor.close()
+    return {
+        "columns": columns,
+        "rows": [list(row) for row in rows[:max_rows]],
+        "truncated": len(rows) > max_rows,
+        "seconds": round(time.perf_counter() - start, 6),
+    }
+
+
+class AnalyticsService:
+    """
+    Request handling: routing, coalescing of identical in-flight queries, and counters.
+    """
+
+    def __init__(self, pool, timeout=30.0, max_rows=10_000):
+        self.pool = pool
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.questions = question_ids()
+        self.requests = self.executed = self.coalesced = 0
+        self._in_flight = {}
+
+    async def query(self, sql, params=()):
+        """
+        Return the result of `sql`, sharing the execution with identical queries already running.
+        """
+        key = (normalize_sql(sql), json.dumps(params, sort_keys=True))
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(self.pool.run(sql, params, self.timeout, self.max_rows))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded, so a caller that goes away does not cancel the query for the others
+        return await asyncio.shield(task)
+
+    async def handle(self, method, path, body, query_string=""):
+        """
+        Answer one request; returns (status, JSON-serializable object).
+        """
+        self.requests += 1
+        if path == "/health":
+            return 200, {"status": "ok", "journal_mode": self.pool.journal_mode, "pool_size": self.pool.size,
+                         "idle_connections": self.pool.idle, "in_flight": len(self._in_flight),
+                         "requests": self.requests, "executed": self.executed, "coalesced": self.coalesced}
+        if path == "/queries":
+            return 200, {qid: question for qid, (question, _) in self.questions.items()}
+        if path.startswith("/queries/"):
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            qid = path[len("/queries/"):]
+            if qid not in self.questions:
+                return 404, {"error": f"unknown question {qid!r}"}
+            question, sql = self.questions[qid]
+            # With month partitions, the partitions to read are looked up in the database
+            sql = await self.pool.call(question_sql, sql)
+            return 200, {"question": question, **await self.query(sql)}
+        if path == "/api":
+            return 200, {name: defaults for name, (_, defaults) in STATEMENTS.items()}
+        if path.startswith("/api/"):
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            name = path[len("/api/"):]
+            if name not in STATEMENTS:
+                return 404, {"error": f"unknown statement {name!r}"}
+            # Repeated parameters (statuses=A&statuses=B) are lists, like comma-separated ones
+            params = {key: ",".join(values) for key, values in parse_qs(query_string).items()}
+            bound = bind_parameters(name, **params)
+            sql = STATEMENTS[name][0]
+            if name in PARTITIONED_STATEMENTS:
+                # The partitions of the window are looked up in the database
+                sql = await self.pool.call(statement_sql, name, bound)
+            return 200, {"statement": name, **await self.query(sql, bound)}
+        if path == "/sql":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            try:
+                request = json.loads(body or b"{}")
+                sql, params = request["sql"], request.get("params", [])
+            except (ValueError, KeyError, TypeError):
+                return 400, {"error": 'expected a JSON body {"sql": ..., "params": [...]}'}
+            return 200, await self.query(sql, params)
+        return 404, {"error": f"no route {path}"}
+
+    async def respond(self, method, target, body):
+        path, _, query_string = target.partition("?")
+        try:
+            return await self.handle(method, path, body, query_string)
+        except QueryTimeout as e:
+            return 504, {"error": str(e)}
+        except (sqlite3.Error, ValueError) as e:
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+
+    async def serve_connection(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of one client connection until it closes.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = encode_response(*await self.respond(method, target, body))
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                             f"\r\n\r\n".encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host, port, db_path, pool_size, timeout, max_rows):
+    pool = ConnectionPool(db_path, pool_size)
+    service = AnalyticsService(pool, timeout, max_rows)
+    server = await asyncio.start_server(service.serve_connection, host, port, backlog=1024)
+    print(f"Serving {db_path} ({pool.journal_mode} mode, {pool_size} connections) on http://{host}:{port}", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the analytics queries over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--pool-size", type=int, default=8, help="read-only connections (and query threads)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a query is interrupted")
+    parser.add_argument("--max-rows", type=int, default=10_000, help="rows returned per result at most")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.db, args.pool_size, args.timeout, args.max_rows))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from config import DB_PATH
+from keys import stored_key_type
+from query_sql import queries, question_sql
+from sql_loader import create_indexes
+
+# Before/after timings of the Q5/Q6 date filters on a scaled copy of fetch_data.db.
+# Usage: python benchmark_date_filters.py [scale]   (default: 200 copies of every user, receipt and item)
+#
+# "before" is the old query: receipts joined to users, filtered on strftime('%Y-%m-%d', createdDate)
+# text, which no index can serve. "after" is query_sql.py: a createdDateMs range scan of users
+# driving the join.
+
+# Q5/Q6 as they were before the epoch-ms columns, kept here only as the benchmark reference
+TEXT_DATE_FILTER = ("strftime('%Y-%m-%d', u.createdDate) >= "
+                    "date((SELECT MAX(strftime('%Y-%m-%d', createdDate)) FROM users), '-6 month')")
+TEXT_DATE_JOIN = """FROM receipts AS r
+            JOIN users AS u ON r.userId = u._id"""
+EPOCH_MS_JOIN = """FROM users AS u
+            CROSS JOIN receipts AS r ON r.userId = u._id"""
+EPOCH_MS_FILTER = ("u.createdDateMs >= strftime('%s', date((SELECT MAX(createdDateMs) FROM users) / 1000, "
+                   "'unixepoch', '-6 month')) * 1000")
+
+# Columns that get a per-copy suffix (or, with integer keys, offset), so the copies are new users, receipts and items
+ID_COLUMNS = {"users": ["_id"], "receipts": ["_id", "userId"], "receiptItems": ["_id", "receiptId"]}
+# Copy k of a user signed up k weeks earlier, so the users span years and the six-month
+# window of Q5/Q6 selects a realistic share of them
+SIGNUP_SHIFT_DAYS = 7
+
+
+def scale_database(conn, scale):
+    """
+    Append `scale` - 1 copies of every user, receipt and item, with suffixed ids.
+
+    Integer keys (see keys.py) are offset by a multiple of the largest key instead; the copies get no key_map entries.
+    """
+    stride = conn.execute("SELECT MAX(key) FROM key_map").fetchone()[0] if stored_key_type(conn) == "integer" else None
+    for table, id_columns in ID_COLUMNS.items():
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        rows = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0]
+        for copy in range(1, scale):
+            shift_days = copy * SIGNUP_SHIFT_DAYS
+            expressions = {col: f"{col} + {copy * stride}" if stride else f"{col} || '~{copy}'" for col in id_columns}
+            if table == "users":
+                expressions["createdDate"] = f"datetime(createdDate, '-{shift_days} days')"
+                expressions["createdDateMs"] = f"createdDateMs - {shift_days * 86_400_000}"
+            select = ", ".join(expressions.get(col, col) for col in columns)
+            conn.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT {select} FROM {table} WHERE rowid <= ?",
+                         (rows,))
+    conn.commit()
+
+
+def time_query(conn, sql, repeat=5):
+    """
+    Return the result rows and the median wall time of `repeat` runs.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        timings.append(time.perf_counter() - start)
+    return rows, statistics.median(timings)
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "scaled.db")
+        shutil.copy(DB_PATH, db_path)
+        conn = sqlite3.connect(db_path)
+        scale_database(conn, scale)
+        create_indexes(conn)
+        conn.commit()
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ID_COLUMNS}
+        print(f"Scaled x{scale}: " + ", ".join(f"{rows:,} {table}" for table, rows in counts.items()) + "\n")
+
+        print(f"{'query':<4} {'before_ms':>10} {'after_ms':>10} {'speedup':>8}  same result")
+        for question, sql in list(queries.items())[4:6]:
+            sql = question_sql(conn, sql)
+            before_sql = sql.replace(EPOCH_MS_FILTER, TEXT_DATE_FILTER).replace(EPOCH_MS_JOIN, TEXT_DATE_JOIN)
+            assert EPOCH_MS_FILTER not in before_sql and EPOCH_MS_JOIN not in before_sql, \
+                f"{question} no longer has the epoch-ms filter this benchmark replaces"
+            before_rows, before = time_query(conn, before_sql)
+            after_rows, after = time_query(conn, sql)
+            # Sums may differ in the last float digits, as the rows are added up in another order
+            same = [(name, round(value, 6)) for name, value in before_rows] == \
+                   [(name, round(value, 6)) for name, value in after_rows]
+            print(f"{question[:2]:<4} {before * 1000:>10.1f} {after * 1000:>10.1f} {before / after:>7.1f}x  {same}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
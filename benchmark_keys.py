@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from columnar import table_path
+from config import BASE_DIR
+from data_quality import rules_by_table, table_query
+from query_sql import queries, question_sql
+from sql_loader import TABLE_SOURCES
+
+# Text ids against integer surrogate keys (FETCH_KEY_TYPE, see keys.py) on scaled stage outputs.
+# Usage: python benchmark_keys.py [scale]   (default: 20 copies of every user, receipt and item)
+#
+# The stage outputs are written `scale` times with suffixed ids (brands are shared by the copies),
+# and load_to_sql.py loads them into one database per key type, in a subprocess whose
+# FETCH_DATA_PATH points at the copies. For each database the benchmark reports the load time, the
+# file size and the size of every table and index (dbstat), then times the queries that join on
+# ids: Q1-Q6 of query_sql.py, the passes of check_data_quality.py (its Exists rules look ids up in
+# the parent table) and full joins of the items with their receipts, users and brands.
+
+KEY_TYPES = ["text", "integer"]
+
+# Columns that get a per-copy suffix, so the copies are new users, receipts and items
+ID_COLUMNS = {"users": ["_id"], "receipts": ["_id", "userId"], "receiptItems": ["_id", "receiptId"]}
+
+JOINS = {
+    "items-receipts-users": """
+        SELECT COUNT(*), SUM(ri.quantity), COUNT(DISTINCT u._id)
+        FROM receiptItems AS ri
+        JOIN receipts AS r ON r._id = ri.receiptId
+        JOIN users AS u ON u._id = r.userId""",
+    "items-brands": """
+        SELECT COUNT(*), COUNT(DISTINCT b._id)
+        FROM receiptItems AS ri
+        JOIN brands AS b ON b.brandCode = ri.brandCode""",
+}
+
+
+def write_scaled_outputs(data_dir, scale):
+    """
+    Write the stage outputs loaded by load_to_sql.py to `data_dir`/cleaned, with `scale` copies
+    of the tables in ID_COLUMNS. Returns {table: rows}.
+    """
+    os.makedirs(os.path.join(data_dir, "cleaned"))
+    counts = {}
+    for table, name in TABLE_SOURCES.items():
+        source = pq.read_table(table_path(name))
+        with pq.ParquetWriter(os.path.join(data_dir, "cleaned", f"{name}.parquet"), source.schema) as writer:
+            for copy in range(scale if table in ID_COLUMNS else 1):
+                scaled = source
+                for col in ID_COLUMNS.get(table, []) if copy else []:
+                    scaled = scaled.set_column(scaled.schema.get_field_index(col), col,
+                                               pc.binary_join_element_wise(scaled[col], f"~{copy}", ""))
+                writer.write_table(scaled)
+        counts[table] = len(source) * (scale if table in ID_COLUMNS else 1)
+    return counts
+
+
+def load(data_dir, db_path, key_type):
+    """
+    Replace-load the stage outputs of `data_dir` into `db_path` with `key_type` ids.
+    Returns the wall time of load_to_sql.py.
+    """
+    env = dict(os.environ, FETCH_DATA_PATH=data_dir, FETCH_DB_PATH=db_path, FETCH_KEY_TYPE=key_type,
+               FETCH_LOAD_MODE="replace")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(BASE_DIR, "load_to_sql.py")], cwd=BASE_DIR, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def object_sizes(conn):
+    """
+    Return {table or index: bytes} of the database, from the dbstat virtual table.
+    """
+    return dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+
+
+def time_query(conn, sql, repeat=5):
+    """
+    Return the result rows and the median wall time of `repeat` runs.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        timings.append(time.perf_counter() - start)
+    return rows, statistics.median(timings)
+
+
+def benchmark_queries(conn):
+    """
+    The timed queries on the database of `conn` (both databases have the same layout): {label: sql}.
+    """
+    timed = {question[:2]: question_sql(conn, sql) for question, sql in queries.items()}
+    timed.update({f"dq {table}": table_query(table, rules) for table, rules in rules_by_table().items()})
+    timed.update(JOINS)
+    return timed
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        counts = write_scaled_outputs(os.path.join(tmp, "data"), scale)
+        print(f"Scaled x{scale}: " + ", ".join(f"{rows:,} {table}" for table, rows in counts.items()) + "\n")
+
+        conns, load_seconds, file_sizes, sizes = {}, {}, {}, {}
+        for key_type in KEY_TYPES:
+            db_path = os.path.join(tmp, f"{key_type}.db")
+            load_seconds[key_type] = load(os.path.join(tmp, "data"), db_path, key_type)
+            conn = sqlite3.connect(db_path)
+            # Without the pages the staging tables left free, and with the WAL written back
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            file_sizes[key_type] = os.path.getsize(db_path)
+            sizes[key_type] = object_sizes(conn)
+            conns[key_type] = conn
+
+        text, integer = KEY_TYPES
+        print(f"{'':<36} {text:>10} {integer:>10} {'ratio':>7}")
+        print(f"{'load_s':<36} {load_seconds[text]:>10.2f} {load_seconds[integer]:>10.2f} "
+              f"{load_seconds[integer] / load_seconds[text]:>7.2f}")
+        print(f"{'file_MiB':<36} {file_sizes[text] / 2**20:>10.1f} {file_sizes[integer] / 2**20:>10.1f} "
+              f"{file_sizes[integer] / file_sizes[text]:>7.2f}")
+        names = sorted(set(sizes[text]) | set(sizes[integer]),
+                       key=lambda name: -max(sizes[text].get(name, 0), sizes[integer].get(name, 0)))
+        for name in names:
+            before, after = sizes[text].get(name, 0), sizes[integer].get(name, 0)
+            if max(before, after) >= 64 * 1024:
+                ratio = f"{after / before:>7.2f}" if before else f"{'-':>7}"
+                print(f"  {name:<34} {before / 2**20:>10.1f} {after / 2**20:>10.1f} {ratio}")
+
+        print(f"\n{'query':<24} {'text_ms':>10} {'integer_ms':>10} {'speedup':>8}  same result")
+        for label, sql in benchmark_queries(conns[text]).items():
+            text_rows, text_seconds = time_query(conns[text], sql)
+            integer_rows, integer_seconds = time_query(conns[integer], sql)
+            # Sums may differ in the last float digits, as the rows are added up in another order
+            same = [tuple(round(v, 6) if isinstance(v, float) else v for v in row) for row in text_rows] == \
+                   [tuple(round(v, 6) if isinstance(v, float) else v for v in row) for row in integer_rows]
+            print(f"{label:<24} {text_seconds * 1000:>10.1f} {integer_seconds * 1000:>10.1f} "
+                  f"{text_seconds / integer_seconds:>7.1f}x  {same}")
+        for conn in conns.values():
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from columnar import SCHEMAS
+from sql_loader import TABLES, INDEXES, LOAD_PRAGMAS, apply_pragmas, bulk_load_table, create_indexes
+
+# Benchmark of the SQLite bulk loader on synthetic receipt items.
+# Usage: python benchmark_load.py [rows ...]   (default: 1,000,000 10,000,000 50,000,000)
+#
+# Each size is written to a Parquet file shaped like receiptItems_cleaned.parquet and loaded
+# into a fresh database with the declared receiptItems DDL, the way load_to_sql.py does it.
+# Sizes up to LEGACY_MAX_ROWS are also loaded with the old pandas to_sql(if_exists="replace")
+# path for comparison. Needs about 12 GB of free disk space in the temp directory for 50M rows.
+
+LEGACY_MAX_ROWS = 1_000_000
+ROW_GROUP_ROWS = 1_000_000
+
+
+def synthetic_items(rows, rng):
+    """
+    Return `rows` receipt items with random-looking ids, ~5 items per receipt and 2,000 brands.
+    """
+    hex_ids = rng.bytes(16 * rows)
+    ids = [hex_ids[i:i + 16].hex() for i in range(0, len(hex_ids), 16)]
+    receipt_ids = np.char.mod("%024x", rng.integers(0, max(rows // 5, 1), rows))
+    brands = np.char.mod("BRAND%04d", np.arange(2000))
+    brand_index = rng.zipf(1.3, rows) % len(brands)
+    barcodes = np.char.mod("5110%08d", rng.integers(0, 10**8, rows))
+    return pa.table({
+        "_id": ids,
+        "receiptId": receipt_ids,
+        "brandCode": brands[brand_index],
+        "barcode": barcodes,
+        "brandName": brands[brand_index],
+        "description": np.char.add("ITEM ", barcodes),
+        "quantity": rng.integers(1, 5, rows),
+        "price": np.round(rng.random(rows) * 20, 2),
+        "isBonus": rng.random(rows) < 0.1,
+        "needsFetchReview": rng.random(rows) < 0.05,
+    }, schema=SCHEMAS["receiptItems_cleaned"])
+
+
+def write_items(path, rows):
+    rng = np.random.default_rng(0)
+    with pq.ParquetWriter(path, SCHEMAS["receiptItems_cleaned"]) as writer:
+        for start in range(0, rows, ROW_GROUP_ROWS):
+            writer.write_table(synthetic_items(min(ROW_GROUP_ROWS, rows - start), rng))
+
+
+def bulk(parquet_path, db_path):
+    """
+    Time the bulk path; returns (load seconds, index seconds).
+    """
+    conn = sqlite3.connect(db_path)
+    apply_pragmas(conn, LOAD_PRAGMAS)
+    conn.executescript(TABLES["receiptItems"])
+    start = time.perf_counter()
+    bulk_load_table(conn, "receiptItems", parquet_path)
+    conn.commit()
+    loaded = time.perf_counter()
+    # Only receiptItems exists here
+    create_indexes(conn, {name: ddl for name, ddl in INDEXES.items() if "ON receiptItems (" in ddl})
+    conn.commit()
+    conn.close()
+    return loaded - start, time.perf_counter() - loaded
+
+
+def legacy(parquet_path, db_path):
+    """
+    Time the old path: read everything into pandas and call to_sql(if_exists="replace").
+    """
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    pq.read_table(parquet_path).to_pandas().to_sql("receiptItems", conn, if_exists="replace", index=False)
+    conn.commit()
+    conn.close()
+    return time.perf_counter() - start
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000_000, 10_000_000, 50_000_000]
+    print(f"SQLite {sqlite3.sqlite_version} bulk load of receiptItems:\n")
+    print(f"{'rows':>12} {'load_s':>9} {'index_s':>9} {'rows/s':>11} {'legacy_s':>9} {'legacy rows/s':>14}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            parquet_path = os.path.join(tmp, "receiptItems_cleaned.parquet")
+            write_items(parquet_path, rows)
+            load_seconds, index_seconds = bulk(parquet_path, os.path.join(tmp, "bulk.db"))
+            line = (f"{rows:>12,} {load_seconds:>9.2f} {index_seconds:>9.2f} "
+                    f"{rows / (load_seconds + index_seconds):>11,.0f}")
+            if rows <= LEGACY_MAX_ROWS:
+                legacy_seconds = legacy(parquet_path, os.path.join(tmp, "legacy.db"))
+                line += f" {legacy_seconds:>9.2f} {rows / legacy_seconds:>14,.0f}"
+            print(line, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import gc
+import sys
+import time
+import warnings
+import ast
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from extended_json import parse_oid, parse_date, parse_dbref_id, normalize_nulls
+
+# Benchmark of the extended-JSON column parsers against the per-row `.apply` path
+# the cleaning scripts used before.
+# Usage: python benchmark_parsers.py [rows]   (default: 1,000,000 rows per column)
+
+warnings.simplefilter("ignore", DeprecationWarning)
+
+# Legacy per-row parsers, kept here only as the benchmark reference
+def legacy_extract_oid(oid_field):
+    if isinstance(oid_field, dict):
+        return oid_field.get("$oid")
+    if isinstance(oid_field, str) and "{'$oid':" in oid_field:
+        return oid_field.split(": '")[1].strip("'}")
+    return oid_field
+
+def legacy_extract_timestamp(date_field):
+    if isinstance(date_field, dict):
+        date_field = str(date_field)
+    if isinstance(date_field, str) and "{'$date':" in date_field:
+        try:
+            timestamp = int(date_field.split(": ")[1].strip("}")) / 1000
+            return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        except:
+            return None
+    return None if pd.isna(date_field) or date_field == "" else date_field
+
+def legacy_extract_cpg_id(cpg_field):
+    if isinstance(cpg_field, dict):
+        cpg_field = str(cpg_field)
+    if isinstance(cpg_field, str):
+        try:
+            cpg_dict = ast.literal_eval(cpg_field)
+            return cpg_dict.get("$id", {}).get("$oid", "UNKNOWN")
+        except:
+            return "UNKNOWN"
+    return "UNKNOWN"
+
+def legacy_normalize_nulls(df):
+    for col in df.columns:
+        df[col] = df[col].apply(lambda x: None if pd.isna(x) or x == "" else x)
+    return df
+
+def build_columns(rows):
+    """
+    Build extended-JSON columns in both shapes the parsers accept: parsed objects and repr text.
+    About 5% of the cells are missing.
+    """
+    rng = np.random.default_rng(0)
+    missing = rng.random(rows) < 0.05
+    oids = [f"{i:024x}" for i in range(rows)]
+    millis = rng.integers(1_500_000_000_000, 1_620_000_000_000, rows)
+
+    oid_objects = pd.Series([{"$oid": oid} for oid in oids])
+    date_objects = pd.Series([None if m else {"$date": int(ms)} for m, ms in zip(missing, millis)])
+    cpg_objects = pd.Series([None if m else {"$id": {"$oid": oid}, "$ref": "Cogs"} for m, oid in zip(missing, oids)])
+    return {
+        "$oid (objects)": oid_objects,
+        "$oid (repr text)": oid_objects.astype(str),
+        "$date (objects)": date_objects,
+        "$date (repr text)": date_objects.map(lambda v: str(v) if v else None),
+        "cpg $id (objects)": cpg_objects,
+        "cpg $id (repr text)": cpg_objects.map(lambda v: str(v) if v else None),
+    }
+
+def time_call(func, *args):
+    """
+    Time one call with the garbage collector paused, as timeit does.
+    """
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    columns = build_columns(rows)
+    cases = [
+        ("$oid (objects)", legacy_extract_oid, parse_oid),
+        ("$oid (repr text)", legacy_extract_oid, parse_oid),
+        ("$date (objects)", legacy_extract_timestamp, parse_date),
+        ("$date (repr text)", legacy_extract_timestamp, parse_date),
+        ("cpg $id (objects)", legacy_extract_cpg_id, parse_dbref_id),
+        ("cpg $id (repr text)", legacy_extract_cpg_id, parse_dbref_id),
+    ]
+
+    results = []
+    for name, legacy, vectorized in cases:
+        series = columns[name]
+        legacy_seconds = time_call(lambda s: s.apply(legacy), series)
+        vectorized_seconds = time_call(vectorized, series)
+        results.append((name, legacy_seconds, vectorized_seconds))
+
+    # Null normalization over a users-shaped frame
+    frame = pd.DataFrame({
+        "role": np.where(np.arange(rows) % 20 == 0, "", "consumer"),
+        "state": pd.Series(["WI", None, "IL", np.nan] * (rows // 4 + 1))[:rows].to_numpy(),
+        "active": np.ones(rows, dtype=bool),
+    })
+    legacy_seconds = time_call(legacy_normalize_nulls, frame.copy())
+    vectorized_seconds = time_call(normalize_nulls, frame.copy())
+    results.append(("null normalization (3 columns)", legacy_seconds, vectorized_seconds))
+
+    report = pd.DataFrame(results, columns=["column", "apply_s", "vectorized_s"])
+    report["speedup"] = report["apply_s"] / report["vectorized_s"]
+    print(f"Extended-JSON parsing benchmark, {rows:,} rows per column:\n")
+    print(report.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+
+if __name__ == "__main__":
+    main()
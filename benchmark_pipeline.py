@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from config import BASE_DIR
+from query_sql import queries, question_sql
+from synthetic_data import generate
+
+# Scaling benchmark of the whole pipeline on synthetic data (see synthetic_data.py).
+# Usage: python benchmark_pipeline.py [--scales 10000 100000 1000000] [--baseline FILE] [--save-baseline]
+#
+# For every scale (number of distinct receipts) the source files are generated into a fresh
+# directory and main.py --force runs on them in a subprocess, with FETCH_DATA_PATH/FETCH_DB_PATH
+# pointing there and the query cache off. Per-stage wall time and peak memory are read back from
+# the pipeline's stages.json; every query of query_sql.py is then timed on the loaded database
+# (median of QUERY_REPEATS runs). The results go to a JSON file.
+#
+# With a baseline file (written earlier with --save-baseline, on the same machine), every stage
+# time, stage peak memory and query time is compared with the baseline of the same scale; a
+# metric that grew by more than --tolerance and by more than its noise floor is reported as a
+# regression and the script exits with status 1.
+# 50M receipts need about 25 GB of disk for the sources, the Parquet outputs and the database.
+
+BENCHMARK_PATH = os.path.join(BASE_DIR, "benchmarks")
+QUERY_REPEATS = 3
+# Differences below these are noise, whatever the ratio
+NOISE_FLOORS = {"seconds": 0.05, "peak_memory_mb": 16.0}
+
+
+def run_pipeline(data_dir, db_path, jobs, log_path):
+    env = dict(os.environ, FETCH_DATA_PATH=data_dir, FETCH_DB_PATH=db_path, FETCH_QUERY_CACHE="0")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        result = subprocess.run([sys.executable, os.path.join(BASE_DIR, "main.py"), "--force", "--jobs", str(jobs)],
+                                cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode:
+        raise RuntimeError(f"main.py failed with status {result.returncode}, see {log_path}")
+    return time.perf_counter() - start
+
+
+def stage_metrics(data_dir):
+    with open(os.path.join(data_dir, "state", "stages.json")) as f:
+        stages = json.load(f)["stages"]
+    return {name: {"seconds": stage["seconds"], "peak_memory_mb": stage["peak_memory_mb"]}
+            for name, stage in sorted(stages.items())}
+
+
+def query_metrics(db_path):
+    """
+    Time every query of query_sql.py; returns {"Q1": {"seconds": median, "rows": n}, ...}.
+    """
+    metrics = {}
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for question, query in queries.items():
+            query = question_sql(conn, query)
+            timings = []
+            for _ in range(QUERY_REPEATS):
+                start = time.perf_counter()
+                rows = conn.execute(query).fetchall()
+                timings.append(time.perf_counter() - start)
+            metrics[question.split(":")[0]] = {"seconds": round(statistics.median(timings), 4), "rows": len(rows)}
+    finally:
+        conn.close()
+    return metrics
+
+
+def benchmark_scale(receipts, jobs, seed, workdir):
+    data_dir = os.path.join(workdir, "data")
+    db_path = os.path.join(workdir, "fetch_data.db")
+    start = time.perf_counter()
+    records = generate(data_dir, receipts, seed=seed)
+    generate_seconds = time.perf_counter() - start
+    pipeline_seconds = run_pipeline(data_dir, db_path, jobs, os.path.join(workdir, "pipeline.log"))
+    return {
+        "records": records,
+        "generate_seconds": round(generate_seconds, 3),
+        "pipeline_seconds": round(pipeline_seconds, 3),
+        "database_mb": round(os.path.getsize(db_path) / 2**20, 1),
+        "stages": stage_metrics(data_dir),
+        "queries": query_metrics(db_path),
+    }
+
+
+def metadata(jobs):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "jobs": jobs,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Return one line per metric of `results` that is worse than in `baseline` (see the header).
+    """
+    found = []
+    for scale, measured in results["scales"].items():
+        base = baseline["scales"].get(scale)
+        if base is None:
+            continue
+        metrics = [(f"stage {name}", values, base["stages"].get(name, {})) for name, values in measured["stages"].items()]
+        metrics += [(f"query {name}", values, base["queries"].get(name, {})) for name, values in measured["queries"].items()]
+        for label, values, base_values in metrics:
+            for metric, floor in NOISE_FLOORS.items():
+                if metric not in values or metric not in base_values:
+                    continue
+                new, old = values[metric], base_values[metric]
+                if new > old * (1 + tolerance) and new - old > floor:
+                    found.append(f"{scale} receipts, {label}: {metric} {old} -> {new} (+{(new - old) / old if old else 1:.0%})")
+    return found
+
+
+def print_scale(receipts, measured):
+    print(f"\n{receipts:,} receipts: {measured['records']}, generated in {measured['generate_seconds']:.1f}s, "
+          f"pipeline {measured['pipeline_seconds']:.1f}s, database {measured['database_mb']:.1f} MiB")
+    for name, values in measured["stages"].items():
+        print(f"  {name:<24} {values['seconds']:>9.2f}s {values['peak_memory_mb']:>9.1f} MiB")
+    for name, values in measured["queries"].items():
+        print(f"  {name:<24} {values['seconds']:>9.4f}s {values['rows']:>9} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data of growing size.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="numbers of distinct receipts to generate, e.g. 10000 1000000 50000000")
+    parser.add_argument("--jobs", type=int, default=3, help="passed on to main.py --jobs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_PATH, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_PATH, "baseline.json"),
+                        help="results to compare with, if the file exists")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth of a metric, as a fraction")
+    parser.add_argument("--keep", help="generate into this directory and keep the data instead of a temp directory")
+    args = parser.parse_args()
+
+    results = {"metadata": metadata(args.jobs), "scales": {}}
+    for receipts in args.scales:
+        if args.keep:
+            workdir = os.path.join(args.keep, str(receipts))
+            os.makedirs(workdir, exist_ok=True)
+            measured = benchmark_scale(receipts, args.jobs, args.seed, workdir)
+        else:
+            with tempfile.TemporaryDirectory(prefix="fetch-benchmark-") as workdir:
+                measured = benchmark_scale(receipts, args.jobs, args.seed, workdir)
+        results["scales"][str(receipts)] = measured
+        print_scale(receipts, measured)
+
+    paths = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for path in paths:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+    print(f"\nResults written to {', '.join(paths)}")
+
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        print(f"{len(found)} regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
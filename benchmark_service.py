@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from config import BASE_DIR, DB_PATH
+from analytics_service import question_ids
+
+# Load test of analytics_service.py.
+# Usage: python benchmark_service.py [--concurrency 1 16 64] [--requests 2000] [--start-server]
+#
+# For every concurrency level, that many clients, each on its own keep-alive connection, send
+# GET /queries/<id> requests back to back, cycling through the questions (or --questions), until
+# --requests requests have been answered. The latency of every request is measured from sending
+# it to reading the whole response; p50, p90, p99 and max latency and the throughput are reported
+# per level, along with how many executions the service saved by coalescing (from /health).
+# With --start-server the service is started on --db for the run and stopped afterwards.
+
+PERCENTILES = [50, 90, 99]
+
+
+async def request(reader, writer, method, path, body=b""):
+    """
+    Send one HTTP/1.1 request on an open connection; returns (status, decoded JSON body).
+    """
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) != b"\r\n":
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def get_json(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await request(reader, writer, "GET", path))[1]
+    finally:
+        writer.close()
+
+
+async def client(host, port, paths, counter, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while counter[0] > 0:
+            counter[0] -= 1
+            path = paths[counter[0] % len(paths)]
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, "GET", path)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+async def run_level(host, port, paths, concurrency, requests):
+    before = await get_json(host, port, "/health")
+    counter, latencies, errors = [requests], [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, paths, counter, latencies, errors) for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    after = await get_json(host, port, "/health")
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / seconds, 1),
+        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 2) for p in PERCENTILES},
+        "max_ms": round(max(latencies) * 1000, 2),
+        "executed": after["executed"] - before["executed"],
+        "coalesced": after["coalesced"] - before["coalesced"],
+    }
+
+
+async def wait_for_server(host, port, seconds=30):
+    deadline = time.perf_counter() + seconds
+    while True:
+        try:
+            return await get_json(host, port, "/health")
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def benchmark(args):
+    health = await wait_for_server(args.host, args.port)
+    print(f"Service: {health['pool_size']} connections, journal mode {health['journal_mode']}")
+    paths = [f"/queries/{qid}" for qid in args.questions]
+    header = f"{'clients':>8} {'requests':>9} {'errors':>7} {'req/s':>9} " + \
+             " ".join(f"{'p' + str(p) + ' ms':>9}" for p in PERCENTILES) + f" {'max ms':>9} {'executed':>9} {'coalesced':>10}"
+    print(header)
+    results = []
+    for concurrency in args.concurrency:
+        level = await run_level(args.host, args.port, paths, concurrency, args.requests)
+        results.append(level)
+        print(f"{level['concurrency']:>8} {level['requests']:>9} {level['errors']:>7} {level['throughput_rps']:>9.1f} " +
+              " ".join(f"{level[f'p{p}_ms']:>9.2f}" for p in PERCENTILES) +
+              f" {level['max_ms']:>9.2f} {level['executed']:>9} {level['coalesced']:>10}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the analytics service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64], help="concurrent clients per level")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--questions", nargs="+", default=list(question_ids()), help="question ids to request, e.g. Q1 Q5")
+    parser.add_argument("--start-server", action="store_true", help="start analytics_service.py for the run")
+    parser.add_argument("--db", default=DB_PATH, help="database of the started server")
+    parser.add_argument("--pool-size", type=int, default=8, help="connections of the started server")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = None
+    if args.start_server:
+        server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "analytics_service.py"), "--host", args.host,
+                                   "--port", str(args.port), "--db", args.db, "--pool-size", str(args.pool_size)])
+    try:
+        results = asyncio.run(benchmark(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(level["errors"] for level in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
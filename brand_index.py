@@ -0,0 +1,154 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from columnar import read_table
+from config import BRAND_INDEX_PATH
+
+# Brand resolution index used by the receipt-item extraction.
+#
+# The index maps normalized keys to brand names and is built once from brands_cleaned.parquet
+# (build_brand_index.py), then memory-mapped by every extraction worker, so the workers share
+# one copy in the page cache instead of each receiving pickled dicts. It is an Arrow IPC file
+# with one row per (key_type, key): "barcode" keys come from brands.barcode, "brandCode" keys
+# from brands.brandCode. When a key appears more than once, the last brand wins, as it did with
+# the old set_index(...).to_dict() maps.
+#
+# Keys are normalized the same way on both sides, so a barcode that went through a float column
+# somewhere ("511111102540.0") or lost its leading zero still matches:
+#   barcodes:    trimmed, a trailing ".0" and leading zeros removed
+#   brand codes: trimmed and upper-cased
+# Empty keys never match.
+
+INDEX_SCHEMA = pa.schema([
+    ("key_type", pa.string()),
+    ("key", pa.string()),
+    ("name", pa.string()),
+])
+
+
+def normalize_barcodes(values):
+    values = pc.utf8_trim_whitespace(pc.cast(values, pa.string()))
+    values = pc.if_else(pc.ends_with(values, ".0"), pc.utf8_slice_codeunits(values, 0, -2), values)
+    values = pc.utf8_ltrim(values, characters="0")
+    return pc.if_else(pc.equal(values, ""), pa.scalar(None, pa.string()), values)
+
+
+def normalize_brand_codes(values):
+    values = pc.utf8_upper(pc.utf8_trim_whitespace(pc.cast(values, pa.string())))
+    return pc.if_else(pc.equal(values, ""), pa.scalar(None, pa.string()), values)
+
+
+NORMALIZERS = {
+    "barcode": normalize_barcodes,
+    "brandCode": normalize_brand_codes,
+}
+
+# Item fields tried in order to resolve the brand of a receipt item, and the index keys they are looked up in
+ITEM_ALIASES = [
+    ("barcode", "barcode"),
+    ("userFlaggedBarcode", "barcode"),
+    ("brandCode", "brandCode"),
+]
+
+
+def build_brand_index(df_brands):
+    """
+    Return the index entries of a brands DataFrame (columns barcode, brandCode, name) as an Arrow table.
+    """
+    parts = []
+    for key_type, normalize in NORMALIZERS.items():
+        keys = normalize(pa.array(df_brands[key_type], from_pandas=True)).to_pandas()
+        part = pd.DataFrame({"key_type": key_type, "key": keys, "name": df_brands["name"].to_numpy()})
+        parts.append(part[part["key"].notna()].drop_duplicates(subset="key", keep="last"))
+    entries = pd.concat(parts, ignore_index=True).sort_values(["key_type", "key"], kind="stable")
+    return pa.Table.from_pandas(entries, schema=INDEX_SCHEMA, preserve_index=False)
+
+
+def write_brand_index(path=BRAND_INDEX_PATH):
+    """
+    Build the index from brands_cleaned.parquet and write it to `path`; returns the number of entries.
+    """
+    index = build_brand_index(read_table("brands_cleaned", columns=["barcode", "brandCode", "name"]))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, INDEX_SCHEMA) as writer:
+        writer.write_table(index)
+    return index.num_rows
+
+
+class ResolutionStats:
+    """
+    Lookups and hits per item alias, summed over the batches of one extraction.
+    """
+
+    def __init__(self):
+        self.items = 0
+        self.lookups = {field: 0 for field, _ in ITEM_ALIASES}
+        self.hits = {field: 0 for field, _ in ITEM_ALIASES}
+
+    def add(self, other):
+        self.items += other.items
+        for field, _ in ITEM_ALIASES:
+            self.lookups[field] += other.lookups[field]
+            self.hits[field] += other.hits[field]
+
+    def report(self):
+        """
+        Print the hit rate of every alias and the share of items with a resolved brand.
+        """
+        for field, key_type in ITEM_ALIASES:
+            lookups, hits = self.lookups[field], self.hits[field]
+            print(f"Brand lookups by {field} ({key_type} keys): {hits} of {lookups} hit "
+                  f"({hits / lookups if lookups else 0:.1%})")
+        resolved = sum(self.hits.values())
+        print(f"Brands resolved for {resolved} of {self.items} items ({resolved / self.items if self.items else 0:.1%})")
+
+
+class BrandIndex:
+    """
+    Memory-mapped brand resolution index (see write_brand_index).
+
+    Lookups stay in Arrow: keys are matched with a hash lookup (pc.index_in) and the names are
+    taken straight from the mapped file.
+    """
+
+    def __init__(self, path=BRAND_INDEX_PATH):
+        # The table's buffers point into the mapped file, so it stays open with the index
+        self._source = pa.memory_map(path)
+        table = pa.ipc.open_file(self._source).read_all()
+        self._keys = {}
+        self._names = {}
+        for key_type in NORMALIZERS:
+            entries = table.filter(pc.equal(table["key_type"], key_type))
+            self._keys[key_type] = entries["key"].combine_chunks()
+            self._names[key_type] = entries["name"].combine_chunks()
+
+    def lookup(self, key_type, values):
+        """
+        Return the brand names of the raw `values` (an Arrow array), null where they miss,
+        and the normalized keys that were looked up.
+        """
+        keys = NORMALIZERS[key_type](values)
+        return pc.take(self._names[key_type], pc.index_in(keys, value_set=self._keys[key_type])), keys
+
+    def resolve(self, fields):
+        """
+        Resolve the brand names of a batch of items.
+
+        `fields` maps the item fields of ITEM_ALIASES to Arrow arrays of equal length; each alias is
+        only tried for the items the earlier ones did not resolve. Returns (names Series, ResolutionStats).
+        """
+        stats = ResolutionStats()
+        names = None
+        for field, key_type in ITEM_ALIASES:
+            found, keys = self.lookup(key_type, fields[field])
+            if names is None:
+                names = pa.nulls(len(found), pa.string())
+                stats.items = len(found)
+            tried = pc.and_(pc.is_null(names), pc.is_valid(keys))
+            stats.lookups[field] = pc.sum(tried).as_py() or 0
+            stats.hits[field] = pc.sum(pc.and_(tried, pc.is_valid(found))).as_py() or 0
+            names = pc.coalesce(names, found)
+        return names.to_pandas(), stats
@@ -0,0 +1,7 @@
+from brand_index import write_brand_index
+from config import BRAND_INDEX_PATH
+
+# Build the brand resolution index from brands_cleaned.parquet once, for all extraction workers
+entries = write_brand_index()
+
+print(f"Brand index with {entries} keys written to {BRAND_INDEX_PATH}.")
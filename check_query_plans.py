@@ -0,0 +1,70 @@
+import re
+import sqlite3
+import sys
+
+from config import DB_PATH
+from query_sql import queries, question_sql
+from query_api import STATEMENTS, bind_parameters, statement_sql
+from partitions import parent_table, partition_rows
+from check_data_quality import queries as data_quality_queries
+
+# Query-plan regression check for the analytics and data-quality queries.
+# Every query is run through EXPLAIN QUERY PLAN; the check fails (exit code 1) when a plan
+# reads a table without an index ("SCAN <table>") or builds an automatic index, which
+# SQLite only does after a full scan. Scans of subqueries and CTEs are fine, and so is the one
+# pass of a data-quality query over the table it checks, as long as its lookups use indexes.
+#
+# With the monthly layout (see partitions.py), a scan of a partition counts as a scan of its table,
+# and partitions of fewer than SMALL_PARTITION_ROWS rows may be scanned: SQLite rightly reads a
+# few pages instead of searching an index. The questions of query_sql.py and the statements of
+# query_api.py are checked as they run on the stored layout (see question_sql and statement_sql).
+
+SMALL_PARTITION_ROWS = 1000
+
+# "SCAN receipts", "SCAN ri" -- a table read row by row, without any index
+TABLE_SCAN = re.compile(r"^SCAN (?P<name>[\w\"]+)$")
+# "CO-ROUTINE periods", "MATERIALIZE t" -- names of subqueries, not tables
+SUBQUERY = re.compile(r"^(?:CO-ROUTINE|MATERIALIZE) (?P<name>\S+)")
+
+
+def full_scans(conn, sql, scanned=(), params=(), small=()):
+    """
+    Return the steps of the query plan of `sql` that read a whole table or build an automatic index.
+    Tables in `scanned` are meant to be read in full, and the `small` ones are cheap to.
+    """
+    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    subqueries = {match["name"] for match in map(SUBQUERY.match, plan) if match}
+    problems = []
+    for step in plan:
+        match = TABLE_SCAN.match(step)
+        # A partition of a table counts as that table (see partitions.py)
+        if (match and match["name"] not in subqueries and match["name"] not in small
+                and parent_table(match["name"]) not in scanned) or "AUTOMATIC" in step:
+            problems.append(step)
+    return problems
+
+
+def main():
+    failed = 0
+    with sqlite3.connect(DB_PATH) as conn:
+        small = {table for table, rows in partition_rows(conn).items() if rows < SMALL_PARTITION_ROWS}
+        # (name, sql, tables the query is meant to read in full, parameters)
+        checks = [(question, question_sql(conn, sql), (), ()) for question, sql in queries.items()]
+        checks += [(f"query_api.py: {name}", statement_sql(conn, name, bind_parameters(name)), (), bind_parameters(name))
+                   for name in STATEMENTS]
+        checks += [(f"check_data_quality.py: {table}", sql, (table,), ()) for table, sql in data_quality_queries.items()]
+        for question, sql, scanned, params in checks:
+            problems = full_scans(conn, sql, scanned, params, small)
+            print(f"{'FULL SCAN' if problems else 'ok':<9}  {question}")
+            for step in problems:
+                print(f"           {step}")
+            failed += bool(problems)
+
+    if failed:
+        print(f"\n{failed} of {len(checks)} queries read a whole table; see INDEXES in sql_loader.py.")
+        sys.exit(1)
+    print(f"\nAll {len(checks)} queries use indexes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,68 @@
-import os
-import pandas as pd
-import ast
+from columnar import StageWriter, apply_dtypes
+from extended_json import parse_oid, parse_dbref_id
+from ingest import iter_source_batches
+from instrumentation import step, count
 
-# Data paths
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-data_path = os.path.join(BASE_DIR, "data")
-cleaned_data_path = os.path.join(data_path, "cleaned")
-
-# Load the raw brands CSV file
-df_brands = pd.read_csv(os.path.join(data_path, "brands_raw.csv"))
-
-# 1. Parse `_id`
-def extract_oid(oid_field):
-    """
-    Extract the ObjectId from a _id field.
-    
-    If the field is a string containing the pattern "{'$oid': ...}",
-    the function extracts the actual oid value.
+def clean_brands_batch(df_brands, seen_ids):
     """
-    if isinstance(oid_field, str) and "{'$oid':" in oid_field:
-        return oid_field.split(": '")[1].strip("'}")
-    return oid_field
+    Clean one batch of raw brand records.
 
-df_brands["_id"] = df_brands["_id"].apply(extract_oid)
-
-# 2. Parse the 'cpg' field and extract the '$id'
-def extract_cpg_id(cpg_field):
-    """
-    Extract the '$id' value from the cpg field.
-    
-    The function attempts to parse the string as a dictionary.
-    If successful, it retrieves the nested '$oid' value; otherwise, it returns 'UNKNOWN'.
+    `seen_ids` holds the `_id`s already written by earlier batches,
+    so duplicates are removed across the whole file and not only inside the batch.
     """
-    if isinstance(cpg_field, str):
-        try:
-            cpg_dict = ast.literal_eval(cpg_field)  
-            return cpg_dict.get("$id", {}).get("$oid", "UNKNOWN")
-        except:
-            return "UNKNOWN"
-    return "UNKNOWN"
+    # 1. Parse `_id`
+    df_brands["_id"] = parse_oid(df_brands["_id"])
 
-df_brands["cpg_id"] = df_brands["cpg"].apply(extract_cpg_id)
-# Drop the original cpg column as it's no longer needed
-df_brands.drop(columns=["cpg"], inplace=True)
+    # 2. Parse the 'cpg' reference and extract its '$id' ('UNKNOWN' when missing)
+    df_brands["cpg_id"] = parse_dbref_id(df_brands["cpg"])
+    # Drop the original cpg column as it's no longer needed
+    df_brands = df_brands.drop(columns=["cpg"])
 
-# 3. Remove 'test brand' data
-# Filter out any rows where the brand name contains the substring "test" (case-insensitive)
-df_brands = df_brands[~df_brands["name"].str.contains("test", case=False, na=False)]
+    # 3. Remove 'test brand' data
+    # Filter out any rows where the brand name contains the substring "test" (case-insensitive)
+    with step("drop test brands") as span:
+        rows_in = len(df_brands)
+        df_brands = df_brands[~df_brands["name"].str.contains("test", case=False, na=False)].copy()
+        span.count(rows_in, len(df_brands))
 
-# 4. Clean the 'topBrand' field
-# Convert to string, then to lowercase, and finally map the values to boolean (True/False)
-df_brands["topBrand"] = df_brands["topBrand"].astype(str).str.lower()
-df_brands["topBrand"] = df_brands["topBrand"].map({"true": True, "false": False})
-# Ensure that any missing values remain as None
-df_brands["topBrand"] = df_brands["topBrand"].where(df_brands["topBrand"].notna(), None)
+    # 4. Clean the 'topBrand' field
+    # Convert to string, then to lowercase, and finally map the values to boolean (True/False)
+    df_brands["topBrand"] = df_brands["topBrand"].astype(str).str.lower()
+    df_brands["topBrand"] = df_brands["topBrand"].map({"true": True, "false": False})
+    # Ensure that any missing values remain as None
+    df_brands["topBrand"] = df_brands["topBrand"].where(df_brands["topBrand"].notna(), None)
 
-# 5. Fill missing 'brandCode'
-# If 'brandCode' is missing, fill it with the value from 'barcode' (converted to string)
-df_brands["brandCode"].fillna(df_brands["barcode"].astype(str), inplace=True)
+    # 5. Fill missing 'brandCode'
+    # If 'brandCode' is missing, fill it with the value from 'barcode' (converted to string)
+    df_brands["brandCode"] = df_brands["brandCode"].fillna(df_brands["barcode"].astype(str))
 
-# 6. Remove duplicates based on `_id`
-# Keep only the first occurrence for each unique _id
-df_brands.drop_duplicates(subset=["_id"], keep="first", inplace=True)
+    # 6. Remove duplicates based on `_id`
+    # Keep only the first occurrence for each unique _id
+    with step("dedup") as span:
+        rows_in = len(df_brands)
+        df_brands = df_brands[~df_brands["_id"].isin(seen_ids)]
+        df_brands = df_brands.drop_duplicates(subset=["_id"], keep="first")
+        seen_ids.update(df_brands["_id"])
+        span.count(rows_in, len(df_brands))
 
-# Display processed brand data overview
-print("Processed brand data overview:")
-print(df_brands.info())
-print(df_brands.head(10))  
+    # 7. Store category and categoryCode as categories and topBrand as a nullable boolean
+    return apply_dtypes(df_brands, "brands_cleaned")
 
-# Save the cleaned DataFrame as a CSV file
-df_brands.to_csv(os.path.join(cleaned_data_path, "brands_cleaned.csv"), index=False, na_rep="NULL")
+# Stream the raw brands file batch by batch and append each cleaned batch to the output
+seen_ids = set()
+with StageWriter("brands_cleaned") as writer:
+    for i, df_batch in enumerate(iter_source_batches("brands")):
+        count(rows_in=len(df_batch))
+        df_brands = clean_brands_batch(df_batch, seen_ids)
+        if i == 0:
+            # Display processed brand data overview
+            print("Processed brand data overview:")
+            print(df_brands.info())
+            print(df_brands.head(10))
 
+        # Save the cleaned batch to brands_cleaned.parquet
+        writer.write(df_brands)
 
+print(f"{writer.rows} brands kept.")
+print("Memory per column of the largest batch:")
+print(writer.memory_report())
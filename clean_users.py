@@ -1,62 +1,66 @@
-import os
-import pandas as pd
-from datetime import datetime
+from columnar import StageWriter, apply_dtypes
+from data_quality import InlineChecks
+from extended_json import parse_oid, parse_date, normalize_nulls
+from ingest import iter_source_batches
+from instrumentation import step, count
+from watermarks import ChangeFilter
 
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-data_path = os.path.join(BASE_DIR, "data")
-cleaned_data_path = os.path.join(data_path, "cleaned")
-
-# Load the raw users CSV file
-df_users = pd.read_csv(os.path.join(data_path, "users_raw.csv"))
-
-# 1. Parse the `_id`
-def extract_oid(oid_field):
-    """
-    Extract the ObjectId from a _id field.
-    If the field contains the pattern "{'$oid': ...}",
-    return the actual oid value.
+def clean_users_batch(df_users, seen_ids):
     """
-    if isinstance(oid_field, str) and "{'$oid':" in oid_field:
-        return oid_field.split(": '")[1].strip("'}")
-    return oid_field
+    Clean one batch of raw user records.
 
-df_users["_id"] = df_users["_id"].apply(extract_oid)
-
-# 2. Parse timestamps
-def extract_timestamp(date_field):
-    """
-    Parse a date field and convert it to the format 'YYYY-MM-DD HH:MM:SS'.
-    If the date field is in the format "{'$date': ...}", convert the milliseconds to seconds.
-    Return None if parsing fails.
+    `seen_ids` holds the `_id`s already written by earlier batches,
+    so duplicates are removed across the whole file and not only inside the batch.
     """
-    if isinstance(date_field, str) and "{'$date':" in date_field:
-        try:
-            timestamp = int(date_field.split(": ")[1].strip("}")) / 1000
-            return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-        except:
-            return None
-    return None if pd.isna(date_field) or date_field == "" else date_field
+    # 1. Parse the `_id`
+    df_users["_id"] = parse_oid(df_users["_id"])
+
+    # 2. Parse timestamps
+    df_users["createdDate"] = parse_date(df_users["createdDate"])
+    df_users["lastLogin"] = parse_date(df_users["lastLogin"])
 
-df_users["createdDate"] = df_users["createdDate"].apply(extract_timestamp)
-df_users["lastLogin"] = df_users["lastLogin"].apply(extract_timestamp)
+    # 3. Fill missing values in all columns with None
+    normalize_nulls(df_users)
 
-# 3. Fill missing values in all columns with None
-for col in df_users.columns:
-    df_users[col] = df_users[col].apply(lambda x: None if pd.isna(x) or x == "" else x)
+    # Store role, signUpSource and state as categories and the active flag as a nullable boolean
+    apply_dtypes(df_users, "users_cleaned")
 
-# 4. Remove duplicate `_id`
-df_users.drop_duplicates(subset=["_id"], keep="first", inplace=True)
+    # 4. Remove duplicate `_id`, keeping the first occurrence in the file
+    with step("dedup") as span:
+        rows_in = len(df_users)
+        df_users = df_users[~df_users["_id"].isin(seen_ids)]
+        df_users = df_users.drop_duplicates(subset=["_id"], keep="first")
+        seen_ids.update(df_users["_id"])
+        span.count(rows_in, len(df_users))
 
-# Filter records where role equals "consumer"
-df_users = df_users[df_users["role"] == "consumer"]
+    # Filter records where role equals "consumer"
+    with step("keep consumers") as span:
+        rows_in = len(df_users)
+        df_users = df_users[df_users["role"] == "consumer"]
+        span.count(rows_in, len(df_users))
+    return df_users
 
-# Display processed users data overview
-print("Processed users data overview:")
-print(df_users.info())
-print(df_users.head(10))
+# Stream the raw users file batch by batch and append each cleaned batch to the output.
+# In incremental runs only users whose lastLogin moved past the committed watermark are kept.
+# FETCH_INLINE_CHECKS runs the row-level data-quality rules on every cleaned batch.
+seen_ids = set()
+change_filter = ChangeFilter("users")
+inline_checks = InlineChecks("users")
+with StageWriter("users_cleaned") as writer:
+    for i, df_batch in enumerate(iter_source_batches("users")):
+        count(rows_in=len(df_batch))
+        df_users = inline_checks.apply(clean_users_batch(change_filter.filter(df_batch), seen_ids))
+        writer.write(df_users)
+        if i == 0:
+            # Display processed users data overview
+            print("Processed users data overview:")
+            print(df_users.info())
+            print(df_users.head(10))
 
-# Save the cleaned DataFrame as a CSV file
-df_users.to_csv(os.path.join(cleaned_data_path, "users_cleaned.csv"), index=False, na_rep="NULL")
+change_filter.stage()
+inline_checks.report()
 
-print("Data cleaning completed. The file users_cleaned.csv has been saved!")
+print(f"{writer.rows} users kept.")
+print("Memory per column of the largest batch:")
+print(writer.memory_report())
+print("Data cleaning completed. The file users_cleaned.parquet has been saved!")
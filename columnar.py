@@ -0,0 +1,332 @@
+import os
+from collections import Counter
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import CLEANED_DATA_PATH, BATCH_SIZE, EXPORT_CSV
+from instrumentation import step, count
+
+# Typed Parquet handoff between the pipeline stages.
+# Every stage output has a fixed Arrow schema, so nested item lists, dates and
+# booleans survive the handoff as real types instead of Python-repr strings.
+
+# Fields of one entry in receipts.rewardsReceiptItemList, as they appear in the source JSON.
+# Quantities are kept as text like the prices, since the apps send both numbers and text ("2");
+# receipt_items.py parses them. Keys not listed here are dropped, and counted (see to_arrow).
+RECEIPT_ITEM_STRUCT = pa.struct([
+    ("barcode", pa.string()),
+    ("brandCode", pa.string()),
+    ("competitiveProduct", pa.bool_()),
+    ("competitorRewardsGroup", pa.string()),
+    ("deleted", pa.bool_()),
+    ("description", pa.string()),
+    ("discountedItemPrice", pa.string()),
+    ("finalPrice", pa.string()),
+    ("isBonus", pa.bool_()),
+    ("itemNumber", pa.string()),
+    ("itemPrice", pa.string()),
+    ("metabriteCampaignId", pa.string()),
+    ("needsFetchReview", pa.bool_()),
+    ("needsFetchReviewReason", pa.string()),
+    ("originalFinalPrice", pa.string()),
+    ("originalMetaBriteBarcode", pa.string()),
+    ("originalMetaBriteDescription", pa.string()),
+    ("originalMetaBriteItemPrice", pa.string()),
+    ("originalMetaBriteQuantityPurchased", pa.string()),
+    ("originalReceiptItemText", pa.string()),
+    ("partnerItemId", pa.string()),
+    ("pointsEarned", pa.string()),
+    ("pointsNotAwardedReason", pa.string()),
+    ("pointsPayerId", pa.string()),
+    ("preventTargetGapPoints", pa.bool_()),
+    ("priceAfterCoupon", pa.string()),
+    ("quantityPurchased", pa.string()),
+    ("rewardsGroup", pa.string()),
+    ("rewardsProductPartnerId", pa.string()),
+    ("targetPrice", pa.string()),
+    ("userFlaggedBarcode", pa.string()),
+    ("userFlaggedDescription", pa.string()),
+    ("userFlaggedNewItem", pa.bool_()),
+    ("userFlaggedPrice", pa.string()),
+    ("userFlaggedQuantity", pa.string()),
+])
+
+TIMESTAMP = pa.timestamp("ms")
+
+SCHEMAS = {
+    "users_cleaned": pa.schema([
+        ("_id", pa.string()),
+        ("active", pa.bool_()),
+        ("createdDate", TIMESTAMP),
+        ("lastLogin", TIMESTAMP),
+        ("role", pa.string()),
+        ("signUpSource", pa.string()),
+        ("state", pa.string()),
+    ]),
+    "brands_cleaned": pa.schema([
+        ("_id", pa.string()),
+        ("barcode", pa.string()),
+        ("category", pa.string()),
+        ("categoryCode", pa.string()),
+        ("name", pa.string()),
+        ("topBrand", pa.bool_()),
+        ("brandCode", pa.string()),
+        ("cpg_id", pa.string()),
+    ]),
+    "receipts_cleaned": pa.schema([
+        ("_id", pa.string()),
+        ("bonusPointsEarned", pa.int64()),
+        ("bonusPointsEarnedReason", pa.string()),
+        ("createDate", TIMESTAMP),
+        ("dateScanned", TIMESTAMP),
+        ("finishedDate", TIMESTAMP),
+        ("modifyDate", TIMESTAMP),
+        ("pointsAwardedDate", TIMESTAMP),
+        ("pointsEarned", pa.float64()),
+        ("purchaseDate", TIMESTAMP),
+        ("purchasedItemCount", pa.int64()),
+        ("rewardsReceiptItemList", pa.list_(RECEIPT_ITEM_STRUCT)),
+        ("rewardsReceiptStatus", pa.string()),
+        ("totalSpent", pa.float64()),
+        ("userId", pa.string()),
+    ]),
+    "receiptItems_cleaned": pa.schema([
+        ("_id", pa.string()),
+        ("receiptId", pa.string()),
+        ("brandCode", pa.string()),
+        ("barcode", pa.string()),
+        ("brandName", pa.string()),
+        ("description", pa.string()),
+        ("quantity", pa.int64()),
+        ("price", pa.float64()),
+        ("isBonus", pa.bool_()),
+        ("needsFetchReview", pa.bool_()),
+    ]),
+}
+
+
+# Low-cardinality text columns, held as pandas categoricals: each distinct value is stored once
+# and the rows only keep a small integer code.
+CATEGORICAL_COLUMNS = {
+    "users_cleaned": ["role", "signUpSource", "state"],
+    "brands_cleaned": ["category", "categoryCode"],
+    "receipts_cleaned": ["bonusPointsEarnedReason", "rewardsReceiptStatus"],
+    "receiptItems_cleaned": ["brandCode", "brandName"],
+}
+
+# pandas dtypes of the Arrow types: nullable booleans and integers instead of object/float64
+# columns, and fixed-width datetime64[ms] timestamps
+ARROW_TO_PANDAS = {
+    pa.bool_(): pd.BooleanDtype(),
+    pa.int64(): pd.Int64Dtype(),
+}
+
+
+def pandas_dtypes(name):
+    """
+    Return the memory-optimized pandas dtype of every scalar column of the stage output `name`.
+    Other text columns stay object strings.
+    """
+    dtypes = {}
+    for field in SCHEMAS[name]:
+        if field.name in CATEGORICAL_COLUMNS.get(name, []):
+            dtypes[field.name] = "category"
+        elif field.type in ARROW_TO_PANDAS:
+            dtypes[field.name] = ARROW_TO_PANDAS[field.type]
+        elif pa.types.is_timestamp(field.type):
+            dtypes[field.name] = "datetime64[ms]"
+        elif pa.types.is_floating(field.type):
+            dtypes[field.name] = "float64"
+    return dtypes
+
+
+def apply_dtypes(df, name):
+    """
+    Cast the columns of a batch to pandas_dtypes(name), in place; numeric text is parsed first.
+    """
+    for col, dtype in pandas_dtypes(name).items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if df[col].dtype == object and dtype == "datetime64[ms]":
+            df[col] = pd.to_datetime(df[col], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        elif df[col].dtype == object and dtype in ("float64", pd.Int64Dtype()):
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+        df[col] = df[col].astype(dtype)
+    return df
+
+
+def to_pandas(table, name):
+    """
+    Convert an Arrow table or record batch of the stage output `name` to a DataFrame with pandas_dtypes(name).
+    """
+    categories = [col for col in CATEGORICAL_COLUMNS.get(name, []) if col in table.schema.names]
+    return table.to_pandas(categories=categories, types_mapper=ARROW_TO_PANDAS.get)
+
+
+def memory_report(column_bytes, dtypes):
+    """
+    Format bytes per column (largest batch) as a DataFrame with a total row.
+    """
+    report = pd.DataFrame({"dtype": pd.Series(dtypes, dtype=object), "bytes": pd.Series(column_bytes)})
+    report.loc["(total)"] = ["", report["bytes"].sum()]
+    return report
+
+
+def table_path(name, extension="parquet"):
+    """
+    Return the path of a stage output, e.g. table_path("users_cleaned") -> data/cleaned/users_cleaned.parquet.
+    """
+    return os.path.join(CLEANED_DATA_PATH, f"{name}.{extension}")
+
+
+def _conform_items(item_lists, struct_type, unknown_keys):
+    """
+    Turn the numbers in the text fields of the item dicts of a list<struct> column into text, in place
+    (quantityPurchased 2 becomes "2"), as Arrow only converts str values to string fields.
+    Keys that `struct_type` does not declare are counted in `unknown_keys`.
+    """
+    fields = set(struct_type.names)
+    text_fields = {field.name for field in struct_type if pa.types.is_string(field.type)}
+    for items in item_lists:
+        if type(items) is not list:
+            continue
+        for item in items:
+            if type(item) is not dict:
+                continue
+            if not item.keys() <= fields:
+                unknown_keys.update(item.keys() - fields)
+            for key, value in item.items():
+                if type(value) is not str and key in text_fields and value is not None:
+                    item[key] = str(value)
+
+
+def to_arrow(df, name, unknown_keys=None):
+    """
+    Convert a DataFrame batch to an Arrow table with the declared schema of `name`.
+
+    Text dates ('YYYY-MM-DD HH:MM:SS') become timestamps, numeric text becomes numbers and numbers
+    in the text fields of nested items become text, so batches coming from different cleaning steps
+    always share one schema.
+    Columns missing from the batch are written as nulls. Item keys the schema does not declare are
+    dropped; they are counted per key in the Counter `unknown_keys` if given.
+    """
+    schema = SCHEMAS[name]
+    # Absent columns are built as typed nulls: reindex would fill them with float NaN, which
+    # does not convert to timestamps, strings or lists
+    df = df.reindex(columns=[col for col in schema.names if col in df.columns])
+    for field in schema:
+        if field.name not in df.columns or df[field.name].dtype != object:
+            continue
+        if pa.types.is_list(field.type) and pa.types.is_struct(field.type.value_type):
+            _conform_items(df[field.name], field.type.value_type,
+                           Counter() if unknown_keys is None else unknown_keys)
+        elif pa.types.is_timestamp(field.type):
+            df[field.name] = pd.to_datetime(df[field.name], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        elif pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+            df[field.name] = pd.to_numeric(df[field.name], errors="coerce")
+    table = pa.Table.from_pandas(df, schema=pa.schema([schema.field(col) for col in df.columns]), preserve_index=False)
+    return pa.Table.from_arrays([table[field.name] if field.name in df.columns else pa.nulls(len(df), field.type)
+                                 for field in schema], schema=schema)
+
+
+class StageWriter:
+    """
+    Append DataFrame batches to a stage output.
+
+    Each batch becomes one Parquet row group, so a stage can stream its output without
+    holding it in memory. When FETCH_EXPORT_CSV=1 the same batches are also appended to
+    the matching CSV file, with missing values written as "NULL" like the old CSV handoff.
+    The in-memory size of every column is tracked per batch (see memory_report); batches passed
+    as Arrow tables (write_arrow) count their Arrow buffers. Writing is measured as the step
+    "write <name>", and the rows written count as the stage's rows out.
+    """
+
+    def __init__(self, name, export_csv=EXPORT_CSV):
+        self.name = name
+        self.export_csv = export_csv
+        self.rows = 0
+        self.column_bytes = {}
+        self.dtypes = {}
+        self._writer = None
+
+    def __enter__(self):
+        os.makedirs(CLEANED_DATA_PATH, exist_ok=True)
+        self._writer = pq.ParquetWriter(table_path(self.name), SCHEMAS[self.name])
+        return self
+
+    def write(self, df):
+        # Bytes per column of the largest batch; nested values are counted shallowly
+        for col, size in df.memory_usage(index=False, deep=True).items():
+            if size > self.column_bytes.get(col, -1):
+                self.column_bytes[col] = int(size)
+                self.dtypes[col] = str(df[col].dtype)
+        with step(f"write {self.name}") as span:
+            self._append(to_arrow(df, self.name), df, span)
+
+    def write_arrow(self, table):
+        """
+        Append an Arrow table that already has the stage schema, without a round trip through pandas.
+        """
+        for field, column in zip(table.schema, table.columns):
+            if column.nbytes > self.column_bytes.get(field.name, -1):
+                self.column_bytes[field.name] = column.nbytes
+                self.dtypes[field.name] = str(field.type)
+        with step(f"write {self.name}") as span:
+            self._append(table, to_pandas(table, self.name) if self.export_csv else None, span)
+
+    def _append(self, table, df, span):
+        self._writer.write_table(table)
+        if self.export_csv:
+            df.to_csv(table_path(self.name, "csv"), mode="w" if self.rows == 0 else "a",
+                      header=(self.rows == 0), index=False, na_rep="NULL")
+        span.count(rows_in=table.num_rows, rows_out=table.num_rows)
+        count(rows_out=table.num_rows)
+        self.rows += table.num_rows
+
+    def memory_report(self):
+        """
+        Return the bytes per column of the largest batch written, as a DataFrame.
+        """
+        return memory_report(self.column_bytes, self.dtypes)
+
+    def __exit__(self, exc_type, exc, tb):
+        self._writer.close()
+        if self.export_csv and self.rows == 0:
+            pd.DataFrame(columns=SCHEMAS[self.name].names).to_csv(table_path(self.name, "csv"), index=False)
+        return False
+
+
+def write_table(df, name, export_csv=EXPORT_CSV):
+    """
+    Write a whole DataFrame as the stage output `name`.
+    """
+    with StageWriter(name, export_csv) as writer:
+        writer.write(df)
+
+
+def read_table(name, columns=None):
+    """
+    Read a stage output into a DataFrame.
+
+    Only `columns` are read when given; the file is memory-mapped instead of copied into memory first.
+    Columns get the memory-optimized dtypes of pandas_dtypes(name).
+    """
+    return to_pandas(pq.read_table(table_path(name), columns=columns, memory_map=True), name)
+
+
+def iter_table_batches(name, columns=None, batch_size=BATCH_SIZE):
+    """
+    Stream a stage output as DataFrame batches of at most `batch_size` rows.
+    """
+    parquet_file = pq.ParquetFile(table_path(name), memory_map=True)
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield to_pandas(record_batch, name)
+
+
+def scalar_columns(name):
+    """
+    Return the columns of `name` that are not nested lists or structs.
+    """
+    return [field.name for field in SCHEMAS[name] if not pa.types.is_nested(field.type)]
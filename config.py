@@ -0,0 +1,81 @@
+import os
+
+# Data paths shared by the pipeline scripts.
+# FETCH_DATA_PATH lets the whole pipeline run against another data directory.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.environ.get("FETCH_DATA_PATH", os.path.join(BASE_DIR, "data"))
+CLEANED_DATA_PATH = os.path.join(DATA_PATH, "cleaned")
+STATE_PATH = os.path.join(DATA_PATH, "state")
+DB_PATH = os.environ.get("FETCH_DB_PATH", os.path.join(BASE_DIR, "fetch_data.db"))
+
+USERS_FILE = os.path.join(DATA_PATH, "users.json.gz")
+BRANDS_FILE = os.path.join(DATA_PATH, "brands.json.gz")
+RECEIPTS_FILE = os.path.join(DATA_PATH, "receipts.json.gz")
+
+# Number of NDJSON records parsed into one DataFrame batch.
+# Peak memory of the ingestion and cleaning steps grows with this value, not with the file size.
+BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "10000"))
+
+# Stage outputs are handed off as typed Parquet files in CLEANED_DATA_PATH.
+# Set FETCH_EXPORT_CSV=1 to also write the matching *.csv files.
+EXPORT_CSV = os.environ.get("FETCH_EXPORT_CSV", "0") == "1"
+
+# Uncompressed bytes between two checkpoints of the gzip access index (see gzip_index.py); the
+# parallel receipt cleaning hands out the source in ranges of about this size.
+GZIP_INDEX_SPAN = int(os.environ.get("FETCH_GZIP_INDEX_SPAN_MB", "4")) * 1024 * 1024
+
+# Number of worker processes for the parallel stages (1 runs them in the current process).
+WORKERS = int(os.environ.get("FETCH_WORKERS", str(os.cpu_count() or 1)))
+
+# Incremental runs (FETCH_INCREMENTAL=1) only process users and receipts changed since the
+# watermarks saved by the last successful load, and merge them into fetch_data.db.
+INCREMENTAL = os.environ.get("FETCH_INCREMENTAL", "0") == "1"
+
+# How load_to_sql.py writes fetch_data.db:
+#   "replace" drops and reloads every table,
+#   "upsert" keeps existing rows and only inserts new or changed ones (keyed on _id),
+#   "partitions" (monthly layout only) replaces the months of receipts present in the stage
+#   outputs, or the months listed in FETCH_RELOAD_MONTHS (e.g. "2021-01,2021-02"), and keeps the others.
+#   It needs the full stage outputs of those months, so incremental runs cannot use it.
+LOAD_MODE = os.environ.get("FETCH_LOAD_MODE", "upsert" if INCREMENTAL else "replace")
+RELOAD_MONTHS = [month.strip() for month in os.environ.get("FETCH_RELOAD_MONTHS", "").split(",") if month.strip()]
+
+# Storage of receipts and receiptItems in fetch_data.db (see partitions.py): "single" tables, or
+# "monthly" partition tables per month of dateScanned behind receipts/receiptItems views.
+# Switching layouts takes a replace load.
+STORAGE_LAYOUT = os.environ.get("FETCH_STORAGE_LAYOUT", "single")
+
+# Ids in fetch_data.db (see keys.py): "text" stores the ObjectIds and brand codes themselves,
+# "integer" dense integer keys numbered in the key_map table. Switching key types takes a replace load.
+KEY_TYPE = os.environ.get("FETCH_KEY_TYPE", "text")
+
+# Rows per transaction of the bulk load into SQLite (bounds the size of the WAL file).
+LOAD_COMMIT_ROWS = int(os.environ.get("FETCH_LOAD_COMMIT_ROWS", "500000"))
+
+# Result cache of query_sql.py (see query_cache.py); FETCH_QUERY_CACHE=0 turns it off.
+QUERY_CACHE = os.environ.get("FETCH_QUERY_CACHE", "1") == "1"
+QUERY_CACHE_PATH = os.path.join(STATE_PATH, "query_cache.db")
+QUERY_CACHE_BYTES = int(os.environ.get("FETCH_QUERY_CACHE_MB", "64")) * 1024 * 1024
+
+# Engine of the analytics queries of query_sql.py (see query_backends.py): "sqlite" queries
+# fetch_data.db, "duckdb" the Parquet stage outputs; "compare" times every query on both side by side.
+QUERY_BACKEND = os.environ.get("FETCH_QUERY_BACKEND", "sqlite")
+
+# Row-level data-quality rules of data_quality.py applied while cleaning (FETCH_INLINE_CHECKS):
+#   "off" skips them, "warn" reports offending rows, "drop" also keeps them out of the stage outputs.
+INLINE_CHECKS = os.environ.get("FETCH_INLINE_CHECKS", "off")
+
+# Per-stage and per-step measurements of every pipeline run are appended to TRACE_PATH as JSON lines
+# (see instrumentation.py). FETCH_PROFILE lists stages (comma-separated, or "all") to run under
+# cProfile; their profiles are written to PROFILE_PATH/<stage>.prof.
+TRACE_PATH = os.environ.get("FETCH_TRACE_PATH", os.path.join(STATE_PATH, "trace.jsonl"))
+PROFILE_STAGES = {name.strip() for name in os.environ.get("FETCH_PROFILE", "").split(",") if name.strip()}
+PROFILE_PATH = os.path.join(STATE_PATH, "profiles")
+
+# Receipt de-duplication (see dedup.py): memory for the key buffer before it spills hash partitions to SPILL_PATH
+DEDUP_MEMORY_BYTES = int(os.environ.get("FETCH_DEDUP_MEMORY_MB", "256")) * 1024 * 1024
+DEDUP_PARTITIONS = int(os.environ.get("FETCH_DEDUP_PARTITIONS", "64"))
+SPILL_PATH = os.environ.get("FETCH_SPILL_PATH", os.path.join(STATE_PATH, "spill"))
+
+# Brand resolution index of the receipt-item extraction (see brand_index.py)
+BRAND_INDEX_PATH = os.path.join(CLEANED_DATA_PATH, "brand_index.arrow")
@@ -0,0 +1,229 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import pandas as pd
+
+from config import DB_PATH, WORKERS, INLINE_CHECKS
+from keys import KEY_COLUMNS, stored_key_type, original_ids
+
+# Data-quality engine used by check_data_quality.py and, optionally, by the cleaning stages.
+#
+# Rules are declared in RULES: mandatory fields (NotNull), references to another table (Exists)
+# and value ranges (Range). All rules of a table are counted in a single pass over it: one
+# SELECT with a COUNT(*) FILTER (WHERE <rule>) per rule. References are checked against the
+# parent key index, as "(x IN (SELECT key FROM parent)) IS NOT 1": unlike "x NOT IN (...)",
+# which is NULL for every missing key once the parent column holds a NULL, this still counts
+# them. For the rules that found something, a few offending keys are then read with LIMIT.
+# Tables are checked in parallel threads, each on its own read-only connection; SQLite releases
+# the GIL while it executes, so the passes overlap.
+#
+# With FETCH_INLINE_CHECKS=warn (or drop) the row-local rules (NotNull, Range) also run on every
+# batch the cleaners write, and report (or drop) bad rows before they reach the database.
+# Exists rules need the whole parent table, so they only run against the database.
+
+# Offending keys reported per rule
+SAMPLE_KEYS = 5
+
+
+@dataclass(frozen=True)
+class NotNull:
+    table: str
+    issue: str
+    columns: tuple
+
+    row_local = True
+
+    def condition(self):
+        return " OR ".join(f'{self.table}."{column}" IS NULL' for column in self.columns)
+
+    def violations(self, df):
+        return df[list(self.columns)].isna().any(axis=1)
+
+
+@dataclass(frozen=True)
+class Exists:
+    table: str
+    issue: str
+    column: str
+    parent: str
+    parent_column: str
+
+    row_local = False
+
+    def condition(self):
+        return (f'{self.table}."{self.column}" IS NOT NULL AND '
+                f'({self.table}."{self.column}" IN (SELECT "{self.parent_column}" FROM {self.parent})) IS NOT 1')
+
+
+@dataclass(frozen=True)
+class Range:
+    """
+    Values of `column` must lie within [low, high], or (low, high) if `strict`. NULLs are not checked.
+    """
+    table: str
+    issue: str
+    column: str
+    low: float = None
+    high: float = None
+    strict: bool = False
+
+    row_local = True
+
+    def condition(self):
+        below, above = ("<=", ">=") if self.strict else ("<", ">")
+        bounds = []
+        if self.low is not None:
+            bounds.append(f'{self.table}."{self.column}" {below} {self.low!r}')
+        if self.high is not None:
+            bounds.append(f'{self.table}."{self.column}" {above} {self.high!r}')
+        return " OR ".join(bounds)
+
+    def violations(self, df):
+        # Raw batches can still hold numbers as strings; the stage writer only casts them on write
+        values = pd.to_numeric(df[self.column], errors="coerce")
+        outside = pd.Series(False, index=df.index)
+        if self.low is not None:
+            outside |= (values <= self.low) if self.strict else (values < self.low)
+        if self.high is not None:
+            outside |= (values >= self.high) if self.strict else (values > self.high)
+        return outside.fillna(False).astype(bool)
+
+
+RULES = [
+    NotNull("users", "Missing mandatory fields (_id, createdDate, or role)", ("_id", "createdDate", "role")),
+    Exists("receipts", "User not found (userId missing in Users)", "userId", "users", "_id"),
+    Range("receipts", "Negative totalSpent", "totalSpent", low=0),
+    Exists("receiptItems", "Missing receipt (receiptId not in Receipts)", "receiptId", "receipts", "_id"),
+    Exists("receiptItems", "Missing brand (brandCode not in Brands)", "brandCode", "brands", "brandCode"),
+    Range("receiptItems", "Invalid quantity (<= 0)", "quantity", low=0, strict=True),
+    Range("receiptItems", "Negative price (< 0)", "price", low=0),
+]
+
+
+def rules_by_table(rules=RULES):
+    tables = {}
+    for rule in rules:
+        tables.setdefault(rule.table, []).append(rule)
+    return tables
+
+
+def table_query(table, rules):
+    """
+    Return the single-pass query of `rules` on `table`: one row with the number of offending rows per rule.
+    """
+    counts = ",\n       ".join(f"COUNT(*) FILTER (WHERE {rule.condition()})" for rule in rules)
+    return f"SELECT {counts}\nFROM {table}"
+
+
+def sample_query(rule, key="_id"):
+    return f'SELECT {rule.table}."{key}" FROM {rule.table} WHERE {rule.condition()} LIMIT {SAMPLE_KEYS}'
+
+
+class RuleTally:
+    """
+    Violation counts and sample keys of a list of rules, accumulated over chunks of rows.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.counts = [0] * len(rules)
+        self.samples = [[] for _ in rules]
+
+    def add(self, keys, flags):
+        """
+        Count one chunk: `keys` are the row keys, `flags` one boolean column per rule (same order as the rules).
+        """
+        for i, column in enumerate(flags.columns):
+            offending = keys[flags[column].to_numpy(dtype=bool)]
+            self.counts[i] += len(offending)
+            missing = SAMPLE_KEYS - len(self.samples[i])
+            if missing > 0:
+                self.samples[i].extend(offending[:missing].tolist())
+
+    def rows(self):
+        return [{
+            "TableName": rule.table[0].upper() + rule.table[1:],
+            "Issue": rule.issue,
+            "IssueCount": count,
+            "SampleKeys": samples,
+        } for rule, count, samples in zip(self.rules, self.counts, self.samples)]
+
+
+def check_table(db_path, table, rules):
+    """
+    Count all `rules` of `table` in one pass over it, then sample the keys of the rules that failed.
+    Returns their RuleTally.
+    """
+    tally = RuleTally(rules)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        tally.counts = list(conn.execute(table_query(table, rules)).fetchone())
+        for i, rule in enumerate(rules):
+            if tally.counts[i]:
+                tally.samples[i] = [key for (key,) in conn.execute(sample_query(rule))]
+        if stored_key_type(conn) == "integer":
+            # Report the ids the integer keys stand for (see keys.py)
+            tally.samples = [original_ids(conn, KEY_COLUMNS[table]["_id"], keys) for keys in tally.samples]
+    finally:
+        conn.close()
+    return tally
+
+
+def run_rules(db_path=DB_PATH, rules=RULES, workers=WORKERS):
+    """
+    Check `rules` against the database, one thread per table.
+
+    Returns a DataFrame with one row per rule (in registry order): TableName, Issue, IssueCount, SampleKeys.
+    """
+    tables = rules_by_table(rules)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tables)))) as pool:
+        futures = [pool.submit(check_table, db_path, table, table_rules) for table, table_rules in tables.items()]
+        by_rule = {}
+        for future in futures:
+            tally = future.result()
+            by_rule.update(zip(tally.rules, tally.rows()))
+    return pd.DataFrame([by_rule[rule] for rule in rules])
+
+
+class InlineChecks:
+    """
+    Row-local rules of one table, applied to the batches a cleaning stage writes.
+
+    action "warn" only counts the offending rows, "drop" also removes them from the batch,
+    "off" does nothing.
+    """
+
+    def __init__(self, table, action=INLINE_CHECKS, rules=RULES, key="_id"):
+        if action not in ("off", "warn", "drop"):
+            raise ValueError(f"Unknown FETCH_INLINE_CHECKS {action!r}, expected 'off', 'warn' or 'drop'")
+        self.table = table
+        self.action = action
+        self.key = key
+        self.rules = [rule for rule in rules if rule.table == table and rule.row_local] if action != "off" else []
+        self.tally = RuleTally(self.rules)
+        self.dropped = 0
+
+    def apply(self, df):
+        """
+        Check one batch; returns it, without the offending rows in "drop" mode.
+        """
+        if not self.rules or df.empty:
+            return df
+        flags = pd.DataFrame({i: rule.violations(df) for i, rule in enumerate(self.rules)}, index=df.index)
+        self.tally.add(df[self.key].to_numpy(), flags)
+        if self.action == "drop":
+            bad = flags.any(axis=1)
+            self.dropped += int(bad.sum())
+            df = df[~bad]
+        return df
+
+    def report(self):
+        """
+        Print the rules that found offending rows.
+        """
+        for row in self.tally.rows():
+            if row["IssueCount"]:
+                print(f"Inline check {self.table}: {row['Issue']}: {row['IssueCount']} rows, e.g. {row['SampleKeys']}")
+        if self.dropped:
+            print(f"Inline check {self.table}: {self.dropped} rows dropped")
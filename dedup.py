@@ -0,0 +1,205 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from config import DEDUP_MEMORY_BYTES, DEDUP_PARTITIONS, SPILL_PATH, WORKERS
+
+# "Keep the latest row per key" over a stream of key chunks, with bounded memory.
+#
+# Every chunk holds, per source row, its key, its version (larger is newer) and its row position.
+# For each key the row with the highest version survives, and of rows with the same version the
+# first one, which is what a stable sort by version followed by drop_duplicates(keep="first") keeps.
+# That choice is associative, so chunks can be reduced in any grouping:
+#   - Chunks are buffered as Arrow tables. When the buffer outgrows its share of the memory cap
+#     it is reduced to one row per key; while that keeps it under half its share, everything stays
+#     in memory (a single-pass hash aggregation).
+#   - Otherwise the reduced buffer is hash-partitioned by key into DEDUP_PARTITIONS Arrow IPC
+#     files in SPILL_PATH, and so is everything added after it. Each partition is reduced on its
+#     own at the end, `workers` partitions at a time in a process pool; one that is still larger
+#     than its share of the cap is split again with another hash key.
+# Reducing a table takes about REDUCE_OVERHEAD times its size (sorted copy, rank column, hash
+# table), so the buffer gets 1 / REDUCE_OVERHEAD of the cap, and each partition reduced in
+# parallel 1 / (REDUCE_OVERHEAD * workers). On top of that the result, a boolean mask over the
+# row positions, takes one byte per source row.
+
+REDUCE_OVERHEAD = 4
+# Splits of an oversized partition before it is reduced anyway
+MAX_SPILL_DEPTH = 4
+
+KEY_SCHEMA = pa.schema([
+    ("key", pa.string()),
+    ("version", pa.int64()),
+    ("row", pa.int64()),
+])
+
+
+def keep_latest(table):
+    """
+    Reduce a key table to the surviving row of every key (see the module comment).
+    """
+    table = table.take(pc.sort_indices(table, [("version", "descending"), ("row", "ascending")]))
+    table = table.append_column("rank", pa.array(np.arange(len(table), dtype=np.int64)))
+    first = table.group_by("key", use_threads=False).aggregate([("rank", "min")])["rank_min"]
+    return table.select(["key", "version", "row"]).take(first)
+
+
+def partition_ids(keys, partitions, depth):
+    # A different hash key per depth, so a partition that is split again spreads out
+    hashes = pd.util.hash_array(keys.to_numpy(zero_copy_only=False), hash_key=f"dedup-depth-{depth:04d}")
+    return (hashes % partitions).astype(np.int64)
+
+
+class SpillFiles:
+    """
+    Arrow IPC files of the hash partitions of one spill level.
+    """
+
+    def __init__(self, directory, partitions, depth):
+        os.makedirs(directory)
+        self.paths = [os.path.join(directory, f"part-{i:03d}.arrow") for i in range(partitions)]
+        self.depth = depth
+        self._writers = [None] * partitions
+
+    def write(self, table):
+        parts = partition_ids(table["key"], len(self.paths), self.depth)
+        order = np.argsort(parts, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(parts, minlength=len(self.paths)))])
+        for i in np.flatnonzero(np.diff(bounds)):
+            if self._writers[i] is None:
+                self._writers[i] = pa.ipc.new_stream(self.paths[i], KEY_SCHEMA)
+            self._writers[i].write_table(table.take(order[bounds[i]:bounds[i + 1]]))
+
+    def close(self):
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+
+    def written(self):
+        return [path for path, writer in zip(self.paths, self._writers) if writer is not None]
+
+
+def read_spill_file(path):
+    with pa.OSFile(path) as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def iter_spill_file(path):
+    with pa.OSFile(path) as source:
+        for batch in pa.ipc.open_stream(source):
+            yield pa.Table.from_batches([batch])
+
+
+def surviving_rows(path, max_bytes, partitions, depth=1):
+    """
+    Return the row positions that survive in the partition file `path`, splitting it into
+    `partitions` files first if it is larger than `max_bytes`. The file is removed.
+    """
+    if os.path.getsize(path) <= max_bytes or depth > MAX_SPILL_DEPTH:
+        rows = keep_latest(read_spill_file(path))["row"].to_numpy()
+        os.remove(path)
+        pa.default_memory_pool().release_unused()
+        return rows
+    split = SpillFiles(os.path.splitext(path)[0], partitions, depth)
+    try:
+        # Streamed batch by batch, so the oversized partition is never in memory as a whole
+        for table in iter_spill_file(path):
+            split.write(table)
+    finally:
+        split.close()
+    os.remove(path)
+    return np.concatenate([surviving_rows(split_path, max_bytes, partitions, depth + 1)
+                           for split_path in split.written()])
+
+
+class LatestRows:
+    """
+    Collect key chunks with add(), then get the mask of surviving rows with mask().
+
+    Use as a context manager, so spill files are removed however the stage ends.
+    """
+
+    def __init__(self, memory_bytes=DEDUP_MEMORY_BYTES, partitions=DEDUP_PARTITIONS, spill_path=SPILL_PATH,
+                 workers=WORKERS):
+        self.memory_bytes = memory_bytes
+        self.buffer_bytes = memory_bytes // REDUCE_OVERHEAD
+        self.workers = max(1, workers)
+        self.partitions = partitions
+        self.spill_path = spill_path
+        self.rows = 0
+        self.spilled_bytes = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._spill_dir = None
+        self._spill = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._spill is not None:
+            self._spill.close()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+        return False
+
+    def add(self, keys, versions):
+        """
+        Add the next source rows: their keys and versions (int64, larger is newer), in source order.
+        """
+        table = pa.table({
+            "key": pa.array(keys, pa.string()),
+            "version": pa.array(versions, pa.int64()),
+            "row": pa.array(np.arange(self.rows, self.rows + len(keys), dtype=np.int64)),
+        }, schema=KEY_SCHEMA)
+        self.rows += len(keys)
+        if self._spill is not None:
+            self._write_spill(table)
+            return
+        self._buffer.append(table)
+        self._buffer_bytes += table.nbytes
+        if self._buffer_bytes > self.buffer_bytes:
+            reduced = keep_latest(pa.concat_tables(self._buffer))
+            self._buffer, self._buffer_bytes = [reduced], reduced.nbytes
+            # Hand the memory of the unreduced chunks back, the allocator would otherwise keep it
+            pa.default_memory_pool().release_unused()
+            if reduced.nbytes > self.buffer_bytes // 2:
+                self._start_spill()
+
+    def _start_spill(self):
+        os.makedirs(self.spill_path, exist_ok=True)
+        self._spill_dir = tempfile.mkdtemp(prefix="dedup-", dir=self.spill_path)
+        self._spill = SpillFiles(os.path.join(self._spill_dir, "0"), self.partitions, 0)
+        for table in self._buffer:
+            self._write_spill(table)
+        self._buffer, self._buffer_bytes = [], 0
+
+    def _write_spill(self, table):
+        self._spill.write(table)
+        self.spilled_bytes += table.nbytes
+
+    def mask(self):
+        """
+        Return a boolean array over all rows added, True for the rows that survive.
+        """
+        keep = np.zeros(self.rows, dtype=bool)
+        if self._spill is None:
+            if self._buffer:
+                keep[keep_latest(pa.concat_tables(self._buffer))["row"].to_numpy()] = True
+            return keep
+        self._spill.close()
+        paths = self._spill.written()
+        if self.workers == 1:
+            for path in paths:
+                keep[surviving_rows(path, self.buffer_bytes, self.partitions)] = True
+            return keep
+        max_bytes = self.buffer_bytes // self.workers
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for rows in pool.map(surviving_rows, paths, [max_bytes] * len(paths), [self.partitions] * len(paths)):
+                keep[rows] = True
+        return keep
@@ -0,0 +1,166 @@
+import operator
+import numpy as np
+import pandas as pd
+
+# Parsers for MongoDB extended-JSON columns ($oid, $date, DBRef $id).
+#
+# Every parser takes a whole column and accepts three cell shapes:
+#   - parsed objects as streamed from the NDJSON sources, e.g. {"$oid": "5ff1..."}
+#   - their Python-repr text as found in CSV exports, e.g. "{'$oid': '5ff1...'}"
+#   - plain values, which are treated as already parsed
+# Each shape is handled once per column (a key lookup, a regex extract, a numeric cast)
+# instead of calling a Python function per row through `.apply`. An $oid is a single key
+# lookup, for which those column passes cost more than `.apply` itself, so parse_oid makes
+# one plain pass over the cells instead (and a second one only over text cells).
+
+OID_PREFIX = "'$oid': '"
+DATE_PATTERN = r"'\$date': (-?\d+)"
+DBREF_ID_PATTERN = r"'\$id': \{'\$oid': '([^']*)'"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _cell_types(values):
+    """
+    Return the Python type of every cell, so each shape can be selected with one mask.
+    """
+    return np.fromiter(map(type, values), dtype=object, count=len(values))
+
+
+def _object_array(items):
+    """
+    Wrap a list in a 1-D object array without numpy trying to infer nested shapes.
+    """
+    array = np.empty(len(items), dtype=object)
+    array[:] = items
+    return array
+
+
+def _to_float(values):
+    """
+    Cast an object array of numbers, numeric strings and missing values to float64 (NaN for missing).
+    """
+    values = values.copy()
+    values[pd.isna(values)] = np.nan
+    try:
+        return values.astype("float64")
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype="float64")
+
+
+def _get_nested(objects, keys):
+    """
+    Look up the nested `keys` in every object; a level that is missing gives None.
+    Raises AttributeError if one of the top-level cells is not an object.
+    """
+    extracted = list(map(operator.methodcaller("get", keys[0]), objects))
+    for key in keys[1:]:
+        extracted = [value.get(key) if type(value) is dict else None for value in extracted]
+    return _object_array(extracted)
+
+
+def _extract(series, keys, pattern):
+    """
+    Pull the value stored under the nested `keys` out of every cell of an extended-JSON column.
+
+    Returns an object array, the mask of cells that were objects or repr text, and the cell types.
+    Cells of other shapes are copied unchanged and are left out of the mask.
+    """
+    values = series.to_numpy(dtype=object, copy=True)
+
+    # Fast path: a column of parsed objects only, as streamed from the NDJSON sources
+    try:
+        extracted = _get_nested(values, keys)
+        return extracted, np.ones(len(values), dtype=bool), np.full(len(values), dict, dtype=object)
+    except AttributeError:
+        pass
+
+    types = _cell_types(values)
+    is_dict = types == dict
+    if is_dict.any():
+        values[is_dict] = _get_nested(values[is_dict], keys)
+
+    is_repr = np.zeros(len(values), dtype=bool)
+    is_str = types == str
+    if is_str.any():
+        matched = pd.Series(values[is_str], dtype=object).str.extract(pattern, expand=False)
+        hits = matched.notna().to_numpy()
+        is_repr[np.flatnonzero(is_str)[hits]] = True
+        values[is_repr] = matched[hits].to_numpy()
+
+    return values, is_dict | is_repr, types
+
+
+def parse_oid(series):
+    """
+    Parse an ObjectId column ({"$oid": ...}) into its hex string.
+    Plain string ids (such as receipts.userId) are returned unchanged.
+    """
+    values = series.tolist()
+    oids = [value.get("$oid") if type(value) is dict else value for value in values]
+    if str in set(map(type, values)):
+        # Repr text: the id runs from OID_PREFIX to the next quote
+        for i, value in enumerate(values):
+            if type(value) is str:
+                _, found, rest = value.partition(OID_PREFIX)
+                end = rest.find("'")
+                if found and end >= 0:
+                    oids[i] = rest[:end]
+    return pd.Series(_object_array(oids), index=series.index, copy=False)
+
+
+def parse_dbref_id(series, default="UNKNOWN"):
+    """
+    Parse a DBRef column ({"$id": {"$oid": ...}, "$ref": ...}) into the referenced ObjectId.
+    Cells that are missing or cannot be parsed become `default`.
+    """
+    values, parsed, _ = _extract(series, ["$id", "$oid"], DBREF_ID_PATTERN)
+    result = pd.Series(values, index=series.index, dtype=object)
+    return result.where(parsed & result.notna().to_numpy(), default)
+
+
+def parse_date_ms(series):
+    """
+    Parse a date column ({"$date": <epoch ms>}) into nullable Int64 epoch milliseconds.
+
+    Plain text dates in 'YYYY-MM-DD HH:MM:SS' format are accepted as well.
+    Cells that cannot be parsed become <NA>.
+    """
+    values, parsed, types = _extract(series, ["$date"], DATE_PATTERN)
+    millis = np.full(len(values), np.nan)
+    millis[parsed] = _to_float(values[parsed])
+
+    is_text = ~parsed & (types == str)
+    if is_text.any():
+        text_dates = pd.to_datetime(pd.Series(values[is_text]), format=TIMESTAMP_FORMAT, errors="coerce")
+        millis[is_text] = ((text_dates - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)).to_numpy(dtype="float64")
+
+    return pd.Series(pd.array(millis.round(), dtype="Int64"), index=series.index)
+
+
+def ms_to_datetime(millis):
+    """
+    Convert Int64 epoch milliseconds to a datetime64[ms] column, keeping <NA> as NaT.
+    """
+    missing = millis.isna().to_numpy()
+    raw = millis.fillna(0).to_numpy(dtype="int64").astype("datetime64[ms]")
+    raw[missing] = np.datetime64("NaT")
+    return pd.Series(raw, index=millis.index)
+
+
+def parse_date(series):
+    """
+    Parse a date column ({"$date": <epoch ms>}) into datetime64[ms] (UTC, naive).
+    Cells that cannot be parsed become NaT.
+    """
+    return ms_to_datetime(parse_date_ms(series))
+
+
+def normalize_nulls(df):
+    """
+    Turn NaN and empty strings into None in every object column of `df`, in place.
+    """
+    for col in df.select_dtypes(include="object").columns:
+        mask = df[col].isna() | (df[col] == "")
+        if mask.any():
+            df[col] = df[col].where(~mask, None)
+    return df
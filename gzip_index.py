@@ -0,0 +1,386 @@
+import bisect
+import ctypes
+import ctypes.util
+import io
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from config import GZIP_INDEX_SPAN
+
+# Random access into gzip files, after zlib's examples/zran.c.
+#
+# A deflate stream can only be decompressed from its start, because every block refers back up to
+# 32 KiB into the output before it. The index is built with one sequential pass: at the first
+# block boundary after every GZIP_INDEX_SPAN bytes of output it records a checkpoint, i.e. the
+# compressed offset of the block (in bits, as blocks are not byte-aligned) and the 32 KiB of output
+# before it. Decompression can then start at any checkpoint: a raw inflate stream is primed with
+# the leading bits of the block's first byte and given the saved output as its dictionary.
+#
+# Python's zlib module does not expose the calls this needs (inflate with Z_BLOCK, inflatePrime),
+# so the system libz is used through ctypes. Without it AVAILABLE is False and callers read the
+# file sequentially with the gzip module. The index of a file is cached next to it
+# (<file>.gzidx), about 32 KiB per checkpoint, and rebuilt when the file's size or mtime changes.
+# Concatenated gzip members (appended dumps) are supported.
+
+WINDOW_SIZE = 32768
+CHUNK_SIZE = 256 * 1024
+INDEX_SUFFIX = ".gzidx"
+
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+Z_OK, Z_STREAM_END, Z_NEED_DICT, Z_BUF_ERROR = 0, 1, 2, -5
+# windowBits: raw deflate, and gzip header/trailer (+16) with zlib auto-detection (+32)
+RAW_WBITS, GZIP_WBITS = -15, 15 + 32
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    path = ctypes.util.find_library("z") or ctypes.util.find_library("zlib1")
+    if path is None:
+        return None
+    try:
+        libz = ctypes.CDLL(path)
+        for name in ["inflateInit2_", "inflate", "inflateEnd", "inflateReset2", "inflatePrime", "inflateSetDictionary"]:
+            getattr(libz, name).restype = ctypes.c_int
+        libz.zlibVersion.restype = ctypes.c_char_p
+    except (OSError, AttributeError):
+        return None
+    return libz
+
+
+_libz = _load_libz()
+AVAILABLE = _libz is not None
+
+
+class GzipIndexError(Exception):
+    pass
+
+
+@dataclass
+class Checkpoint:
+    """
+    A point where decompression can start: output offset, compressed offset of the block's first
+    (partial) byte, bits of that byte that belong to the block before, and the output before it.
+    """
+    out: int
+    offset: int
+    bits: int
+    window: bytes
+
+
+class Inflater:
+    """
+    A libz inflate stream; owns its z_stream and frees it in close().
+    """
+
+    def __init__(self, wbits):
+        self.stream = ZStream()
+        version = _libz.zlibVersion()
+        if _libz.inflateInit2_(ctypes.byref(self.stream), wbits, version, ctypes.sizeof(ZStream)) != Z_OK:
+            raise GzipIndexError("inflateInit2 failed")
+        self.wbits = wbits
+
+    def reset(self, wbits):
+        _libz.inflateReset2(ctypes.byref(self.stream), wbits)
+        self.wbits = wbits
+
+    def inflate(self, flush):
+        ret = _libz.inflate(ctypes.byref(self.stream), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            message = self.stream.msg.decode() if self.stream.msg else f"error {ret}"
+            raise GzipIndexError(f"inflate failed: {message}")
+        return ret
+
+    def close(self):
+        _libz.inflateEnd(ctypes.byref(self.stream))
+
+
+class GzipIndex:
+    """
+    The checkpoints of one gzip file, with the size and mtime of the file they were built from.
+    """
+
+    def __init__(self, checkpoints, size, mtime_ns, length):
+        self.checkpoints = checkpoints
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # Uncompressed length of the file
+        self.length = length
+        self._outs = [point.out for point in checkpoints]
+
+    def checkpoint_before(self, offset):
+        """
+        Return the last checkpoint at or before uncompressed `offset`.
+        """
+        return self.checkpoints[max(0, bisect.bisect_right(self._outs, offset) - 1)]
+
+    def save(self, path):
+        np.savez(path, out=np.array(self._outs, dtype=np.int64),
+                 offset=np.array([point.offset for point in self.checkpoints], dtype=np.int64),
+                 bits=np.array([point.bits for point in self.checkpoints], dtype=np.int8),
+                 windows=np.frombuffer(b"".join(point.window for point in self.checkpoints), dtype=np.uint8),
+                 source=np.array([self.size, self.mtime_ns, self.length], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            windows = arrays["windows"].tobytes()
+            checkpoints = [Checkpoint(int(out), int(offset), int(bits), windows[i * WINDOW_SIZE:(i + 1) * WINDOW_SIZE])
+                           for i, (out, offset, bits) in enumerate(zip(arrays["out"], arrays["offset"], arrays["bits"]))]
+            size, mtime_ns, length = (int(value) for value in arrays["source"])
+        return cls(checkpoints, size, mtime_ns, length)
+
+
+def build_index(path, span=GZIP_INDEX_SPAN):
+    """
+    Decompress the gzip file at `path` once and return its GzipIndex, with a checkpoint about every `span` output bytes.
+    """
+    if not AVAILABLE:
+        raise GzipIndexError("libz is not available")
+    stat = os.stat(path)
+    inflater = Inflater(GZIP_WBITS)
+    stream = inflater.stream
+    window = ctypes.create_string_buffer(WINDOW_SIZE)
+    in_buffer = ctypes.create_string_buffer(CHUNK_SIZE)
+    total_in = total_out = last = 0
+    checkpoints = []
+    stream.avail_out = 0
+    ended = False
+    try:
+        with open(path, "rb") as f:
+            while True:
+                read = f.readinto(memoryview(in_buffer))
+                if not read:
+                    break
+                stream.next_in, stream.avail_in = ctypes.addressof(in_buffer), read
+                while stream.avail_in:
+                    if ended:
+                        # Another gzip member follows; its header is parsed by the reset stream
+                        inflater.reset(GZIP_WBITS)
+                        ended = False
+                    if stream.avail_out == 0:
+                        stream.next_out, stream.avail_out = ctypes.addressof(window), WINDOW_SIZE
+                    total_in += stream.avail_in
+                    total_out += stream.avail_out
+                    ret = inflater.inflate(Z_BLOCK)
+                    total_in -= stream.avail_in
+                    total_out -= stream.avail_out
+                    if ret == Z_STREAM_END:
+                        ended = True
+                        continue
+                    # At a block boundary, and not after the last block of a member
+                    at_boundary = stream.data_type & 128 and not stream.data_type & 64
+                    if at_boundary and (not checkpoints or total_out - last > span):
+                        used = WINDOW_SIZE - stream.avail_out
+                        checkpoints.append(Checkpoint(total_out, total_in, stream.data_type & 7,
+                                                      window.raw[used:] + window.raw[:used]))
+                        last = total_out
+    finally:
+        inflater.close()
+    if not ended:
+        raise GzipIndexError(f"{path} is truncated")
+    return GzipIndex(checkpoints, stat.st_size, stat.st_mtime_ns, total_out)
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def load_index(path, span=GZIP_INDEX_SPAN):
+    """
+    Return the GzipIndex of `path`, from its cache file if that is still current, else built and cached.
+    """
+    stat = os.stat(path)
+    cached = index_path(path)
+    if os.path.exists(cached):
+        try:
+            index = GzipIndex.load(cached)
+            if (index.size, index.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    index = build_index(path, span)
+    try:
+        # np.savez adds .npz to names without it; write under a temporary name, then move in place
+        index.save(cached + ".tmp.npz")
+        os.replace(cached + ".tmp.npz", cached)
+    except OSError:
+        pass
+    return index
+
+
+def iter_decompressed(path, checkpoint):
+    """
+    Yield the uncompressed bytes of the gzip file at `path` from `checkpoint` to the end, in blocks.
+    """
+    inflater = Inflater(RAW_WBITS)
+    stream = inflater.stream
+    in_buffer = ctypes.create_string_buffer(CHUNK_SIZE)
+    out_buffer = ctypes.create_string_buffer(CHUNK_SIZE)
+    try:
+        with open(path, "rb") as f:
+            f.seek(checkpoint.offset - (1 if checkpoint.bits else 0))
+            if checkpoint.bits:
+                byte = f.read(1)[0]
+                _libz.inflatePrime(ctypes.byref(stream), checkpoint.bits, byte >> (8 - checkpoint.bits))
+            _libz.inflateSetDictionary(ctypes.byref(stream), checkpoint.window, WINDOW_SIZE)
+            pending = b""
+            while True:
+                data = pending or f.read(CHUNK_SIZE)
+                pending = b""
+                if not data:
+                    return
+                ctypes.memmove(in_buffer, data, len(data))
+                stream.next_in, stream.avail_in = ctypes.addressof(in_buffer), len(data)
+                while stream.avail_in:
+                    stream.next_out, stream.avail_out = ctypes.addressof(out_buffer), CHUNK_SIZE
+                    ret = inflater.inflate(Z_NO_FLUSH)
+                    produced = CHUNK_SIZE - stream.avail_out
+                    if produced:
+                        yield out_buffer.raw[:produced]
+                    if ret == Z_STREAM_END:
+                        # End of a member: a raw stream leaves its 8-byte trailer, then another member may follow
+                        rest = data[len(data) - stream.avail_in:]
+                        if inflater.wbits == RAW_WBITS:
+                            rest = rest + f.read(max(0, 8 - len(rest)))
+                            rest = rest[8:]
+                        rest = rest or f.read(CHUNK_SIZE)
+                        if not rest.strip(b"\0"):
+                            return
+                        inflater.reset(GZIP_WBITS)
+                        pending = rest
+                        break
+                    if ret == Z_BUF_ERROR and not produced:
+                        break
+    finally:
+        inflater.close()
+
+
+class IndexedGzipFile(io.RawIOBase):
+    """
+    A read-only, seekable file object over the uncompressed content of a gzip file; seeks jump to the
+    nearest checkpoint of its index instead of decompressing from the start. Wrap it in
+    io.BufferedReader for line reading.
+    """
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index if index is not None else load_index(path)
+        self._position = 0
+        self._blocks = None
+        self._block = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.index.length
+        if offset != self._position or self._blocks is None:
+            checkpoint = self.index.checkpoint_before(offset)
+            # Going on from here is cheaper than restarting at a checkpoint unless that is further ahead
+            if self._blocks is None or offset < self._position or checkpoint.out > self._position:
+                self._blocks, self._block, self._position = iter_decompressed(self.path, checkpoint), b"", checkpoint.out
+            self._skip(offset - self._position)
+        return self._position
+
+    def _skip(self, count):
+        while count > 0:
+            if not self._block:
+                self._block = next(self._blocks, b"")
+                if not self._block:
+                    return
+            taken = min(count, len(self._block))
+            self._block = self._block[taken:]
+            self._position += taken
+            count -= taken
+
+    def readinto(self, buffer):
+        if self._blocks is None:
+            self.seek(0)
+        if not self._block:
+            self._block = next(self._blocks, b"")
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        self._position += size
+        return size
+
+
+@dataclass
+class LineRange:
+    """
+    The lines of a gzip file that start in [start, end), read from `checkpoint` on (see lines()).
+    Lines are counted from `begin`, and nothing at or after `limit` is read: the bounds of the
+    content of a tar member, for example.
+    """
+    path: str
+    checkpoint: Checkpoint
+    start: int
+    end: int
+    begin: int = 0
+    limit: int = None
+
+    def lines(self):
+        """
+        Yield the lines of the range, the last one read to its end. Ranges that meet split the
+        content into whole lines, each in exactly one range.
+        """
+        # Only ever read forward from the one checkpoint
+        index = GzipIndex([self.checkpoint], 0, 0, 0)
+        reader = io.BufferedReader(IndexedGzipFile(self.path, index), CHUNK_SIZE)
+        limit = self.limit if self.limit is not None else float("inf")
+        position = self.start
+        if self.start > self.begin:
+            # A line that starts right at `start` belongs here; a partial one to the range before
+            if self.start - 1 < self.checkpoint.out:
+                previous = self.checkpoint.window[-1:]
+            else:
+                reader.seek(self.start - 1)
+                previous = reader.read(1)
+            reader.seek(self.start)
+            if previous != b"\n":
+                position += len(reader.readline())
+        else:
+            reader.seek(self.start)
+        while position < self.end and position < limit:
+            line = reader.readline()
+            if not line:
+                return
+            if position + len(line) > limit:
+                line = line[:int(limit - position)]
+            position += len(line)
+            yield line
+
+
+def split_ranges(path, index, parts=None, begin=0, limit=None):
+    """
+    Split the content of `path` between `begin` and `limit` (default: all of it) into at most
+    `parts` LineRanges that start at checkpoints; one per checkpoint if `parts` is None.
+    """
+    limit = index.length if limit is None else limit
+    if parts is None:
+        starts = [point.out for point in index.checkpoints if begin < point.out < limit]
+    else:
+        starts = [index.checkpoint_before(int(target)).out for target in np.linspace(begin, limit, parts + 1)[1:-1]]
+    starts = sorted({begin} | {start for start in starts if start > begin})
+    ends = starts[1:] + [limit]
+    return [LineRange(path, index.checkpoint_before(start), start, end, begin, limit) for start, end in zip(starts, ends)]
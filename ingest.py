@@ -0,0 +1,172 @@
+import io
+import tarfile
+import json
+import gzip
+import numpy as np
+import pandas as pd
+
+import gzip_index
+from config import BATCH_SIZE, USERS_FILE, BRANDS_FILE, RECEIPTS_FILE
+from instrumentation import measure_batches
+
+# Source files and the top-level fields we keep from each of them.
+# Every batch is built with exactly these columns, so batches always line up
+# even when a field is missing from all records of one batch.
+SOURCES = {
+    "users": {
+        "path": USERS_FILE,
+        "member": "users.json",
+        "columns": ["_id", "active", "createdDate", "lastLogin", "role", "signUpSource", "state"],
+    },
+    "brands": {
+        "path": BRANDS_FILE,
+        "member": None,
+        "columns": ["_id", "barcode", "category", "categoryCode", "cpg", "name", "topBrand", "brandCode"],
+    },
+    "receipts": {
+        "path": RECEIPTS_FILE,
+        "member": None,
+        "columns": [
+            "_id", "bonusPointsEarned", "bonusPointsEarnedReason", "createDate", "dateScanned",
+            "finishedDate", "modifyDate", "pointsAwardedDate", "pointsEarned", "purchaseDate",
+            "purchasedItemCount", "rewardsReceiptItemList", "rewardsReceiptStatus", "totalSpent", "userId",
+        ],
+    },
+}
+
+
+def iter_ndjson_lines(lines, batch_size=BATCH_SIZE):
+    """
+    Group NDJSON lines into lists of at most `batch_size` unparsed lines; blank lines are skipped.
+    """
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_ndjson_records(lines, batch_size=BATCH_SIZE):
+    """
+    Group NDJSON lines into lists of parsed records.
+
+    Blank lines are skipped. At most `batch_size` records are held at a time,
+    and the last list may be shorter.
+    """
+    for batch in iter_ndjson_lines(lines, batch_size):
+        yield [json.loads(line) for line in batch]
+
+
+def records_to_df(records, columns=None):
+    """
+    Build a DataFrame batch from parsed records.
+
+    Nested values ($oid/$date objects, cpg references, item lists) are kept as Python objects.
+    Empty strings are treated as missing, matching how the old raw CSV round-trip read them back.
+    """
+    df = pd.DataFrame.from_records(records, columns=columns)
+    return df.replace("", np.nan)
+
+
+# Function to stream NDJSON batches from a tar.gz file containing a JSON file
+def iter_tar_ndjson_batches(tar_gz_file, json_filename, batch_size=BATCH_SIZE, columns=None):
+    with tarfile.open(tar_gz_file, "r|gz") as tar:
+        for member in tar:
+            if member.name != json_filename:
+                continue
+            json_file = tar.extractfile(member)
+            for records in iter_ndjson_records(json_file, batch_size):
+                yield records_to_df(records, columns)
+            return
+    raise KeyError(f"{json_filename} not found in {tar_gz_file}")
+
+
+# Function to stream NDJSON batches from a gzip file
+def iter_gzip_ndjson_batches(gz_file, batch_size=BATCH_SIZE, columns=None):
+    with gzip.open(gz_file, "rb") as f:
+        for records in iter_ndjson_records(f, batch_size):
+            yield records_to_df(records, columns)
+
+
+def iter_source_batches(name, batch_size=BATCH_SIZE):
+    """
+    Stream one of the raw sources ("users", "brands" or "receipts") as DataFrame batches.
+
+    The gzip/tar stream is decompressed and parsed lazily, so only one batch of
+    `batch_size` records is in memory at a time. Reading is measured as the step "read <name>".
+    """
+    source = SOURCES[name]
+    if source["member"]:
+        batches = iter_tar_ndjson_batches(source["path"], source["member"], batch_size, source["columns"])
+    else:
+        batches = iter_gzip_ndjson_batches(source["path"], batch_size, source["columns"])
+    return measure_batches(f"read {name}", batches)
+
+
+def iter_source_lines(name, batch_size=BATCH_SIZE):
+    """
+    Stream one of the raw gzip sources as lists of unparsed NDJSON lines, for parsing with
+    parse_source_lines() somewhere else (in a worker process). Reading is measured as the step
+    "read <name> lines".
+    """
+    source = SOURCES[name]
+    if source["member"]:
+        raise ValueError(f"{name} is a tar archive; use iter_source_batches()")
+
+    def batches():
+        with gzip.open(source["path"], "rb") as f:
+            yield from iter_ndjson_lines(f, batch_size)
+    return measure_batches(f"read {name} lines", batches())
+
+
+def source_ranges(name, parts=None):
+    """
+    Split one of the raw sources into line ranges (gzip_index.LineRange) that worker processes
+    can decompress and read on their own, through the cached gzip access index of the file:
+    at most `parts` ranges, or one per index checkpoint. For a tar source the ranges cover
+    the content of its member. Returns None if the file cannot be indexed (libz not available,
+    corrupt file); then read it with iter_source_lines() / iter_source_batches().
+    """
+    if not gzip_index.AVAILABLE:
+        return None
+    source = SOURCES[name]
+    try:
+        index = gzip_index.load_index(source["path"])
+        if not source["member"]:
+            return gzip_index.split_ranges(source["path"], index, parts)
+        # Headers are read with seeks over the index, not by decompressing the members before
+        raw = io.BufferedReader(gzip_index.IndexedGzipFile(source["path"], index))
+        with tarfile.open(fileobj=raw, mode="r:") as tar:
+            member = tar.getmember(source["member"])
+    except (gzip_index.GzipIndexError, tarfile.TarError, OSError):
+        return None
+    return gzip_index.split_ranges(source["path"], index, parts, member.offset_data, member.offset_data + member.size)
+
+
+def read_source_range(line_range):
+    """
+    Return the non-blank NDJSON lines of one range of source_ranges(), unparsed.
+    """
+    return [line for line in line_range.lines() if line.strip()]
+
+
+def parse_source_lines(name, lines):
+    """
+    Parse a list of NDJSON lines of source `name` into a DataFrame batch, as iter_source_batches() would.
+    """
+    return records_to_df([json.loads(line) for line in lines], SOURCES[name]["columns"])
+
+
+# Function to extract and read NDJSON from a tar.gz file containing a JSON file
+def load_tar_ndjson_to_df(tar_gz_file, json_filename):
+    return pd.concat(iter_tar_ndjson_batches(tar_gz_file, json_filename), ignore_index=True)
+
+
+# Function to extract and read NDJSON from a gzip file
+def load_gzip_ndjson_to_df(gz_file):
+    return pd.concat(iter_gzip_ndjson_batches(gz_file), ignore_index=True)
@@ -0,0 +1,234 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+# Per-stage and per-step measurements of the pipeline.
+#
+# pipeline.py opens one root span per stage it runs; stage code marks its sub-steps with
+#
+#     with step("drop test brands") as span:
+#         ...
+#         span.count(rows_in=before, rows_out=after)
+#
+# and counts the rows of the whole stage with count(). Spans are aggregated by their path
+# ("select rows/parse" for a step inside a step), so a step entered once per batch becomes one
+# record with `calls` set to the number of batches. Every span records wall time, CPU time of
+# the process, peak resident memory while it was open, rows in and out, and bytes read and
+# written by the process (rchar/wchar of /proc/self/io: everything passed through read() and
+# write(), whether or not it hit the disk). Memory, CPU and bytes of stage worker processes
+# (the receipt-item extraction pool) are only counted for the whole stage.
+#
+# Outside the pipeline (a script run on its own) steps are measured but not reported anywhere.
+
+# Fields of every trace record, after run/stage/step
+MEASURES = ["calls", "wall_s", "cpu_s", "peak_rss_mb", "rows_in", "rows_out", "read_mb", "written_mb"]
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory of this process, where the OS allows it (Linux).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory():
+    """
+    Return the peak resident memory of this process in bytes since the last reset_peak_memory().
+    Without /proc (macOS) it is the peak since the process started.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def io_bytes():
+    """
+    Return (bytes read, bytes written) by this process so far, or (0, 0) without /proc.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def cpu_time(include_children=False):
+    """
+    Return the CPU time of this process, plus that of its finished child processes if `include_children`.
+    """
+    if not include_children:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + usage.ru_utime + usage.ru_stime
+
+
+class Span:
+    """
+    Measurements of one stage or step, summed over every time it was entered.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def count(self, rows_in=0, rows_out=0):
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+
+    def record(self):
+        return {
+            "calls": self.calls,
+            "wall_s": round(self.wall, 4),
+            "cpu_s": round(self.cpu, 4),
+            "peak_rss_mb": round(self.peak / 2**20, 1),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "read_mb": round(self.bytes_read / 2**20, 2),
+            "written_mb": round(self.bytes_written / 2**20, 2),
+        }
+
+
+class Tracer:
+    """
+    The spans of the stage running in this process (see the module comment).
+    """
+
+    def __init__(self):
+        self.stage = None
+        self.steps = {}
+        self._open = []
+
+    def _reset_peak(self):
+        # The peak counter is shared, so the spans still open keep what it reached so far
+        current = peak_memory()
+        for span in self._open:
+            span.peak = max(span.peak, current)
+        reset_peak_memory()
+
+    @contextlib.contextmanager
+    def _measure(self, span, include_children=False):
+        self._reset_peak()
+        wall, cpu, (read, written) = time.perf_counter(), cpu_time(include_children), io_bytes()
+        self._open.append(span)
+        try:
+            yield span
+        finally:
+            self._open.pop()
+            now_read, now_written = io_bytes()
+            span.calls += 1
+            span.wall += time.perf_counter() - wall
+            span.cpu += cpu_time(include_children) - cpu
+            span.peak = max(span.peak, peak_memory())
+            span.bytes_read += now_read - read
+            span.bytes_written += now_written - written
+            for outer in self._open:
+                outer.peak = max(outer.peak, span.peak)
+
+    @contextlib.contextmanager
+    def run_stage(self, name):
+        """
+        Measure one stage; yields its root span. Stage worker processes count towards its CPU time.
+        """
+        self.stage, self.steps = Span(name), {}
+        with self._measure(self.stage, include_children=True):
+            yield self.stage
+
+    def step(self, name):
+        path = "/".join([span.path for span in self._open if span is not self.stage] + [name])
+        span = self.steps.setdefault(path, Span(path))
+        return self._measure(span)
+
+    def records(self):
+        """
+        Return the trace records of the last stage: the stage total first, then its steps.
+        """
+        if self.stage is None:
+            return []
+        records = [{"stage": self.stage.path, "step": None, **self.stage.record()}]
+        records += [{"stage": self.stage.path, "step": path, **span.record()} for path, span in self.steps.items()]
+        return records
+
+
+TRACER = Tracer()
+
+
+def step(name):
+    """
+    Measure a sub-step of the running stage; use as `with step(name) as span:`.
+    """
+    return TRACER.step(name)
+
+
+def count(rows_in=0, rows_out=0):
+    """
+    Count rows read and written by the running stage as a whole.
+    """
+    if TRACER.stage is not None:
+        TRACER.stage.count(rows_in, rows_out)
+
+
+def measure_batches(name, batches, rows=len):
+    """
+    Yield the items of the iterator `batches`, measuring the production of each one as step `name`
+    with rows(item) counted as rows out. Use it for lazily read inputs, whose reading happens in
+    the consumer's loop.
+    """
+    batches = iter(batches)
+    while True:
+        with step(name) as span:
+            batch = next(batches, None)
+            if batch is not None:
+                span.count(rows_out=rows(batch))
+        if batch is None:
+            return
+        yield batch
+
+
+def write_trace(path, run_id, records):
+    """
+    Append `records` to the JSON-lines trace at `path`, tagged with `run_id`.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps({"run": run_id, **record}) + "\n")
+
+
+def summary_table(records):
+    """
+    Format trace records as a table, steps indented under their stage.
+    """
+    header = f"{'stage / step':<40} " + " ".join(f"{measure:>11}" for measure in MEASURES)
+    lines = [header, "-" * len(header)]
+    for record in records:
+        label = record["stage"] if record["step"] is None else "  " + record["step"]
+        values = []
+        for measure in MEASURES:
+            value = record[measure]
+            values.append(f"{value:>11,}" if isinstance(value, int) else f"{value:>11,.2f}")
+        lines.append(f"{label[:40]:<40} " + " ".join(values))
+    return "\n".join(lines)
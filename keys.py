@@ -0,0 +1,130 @@
+import re
+
+import pandas as pd
+
+from config import KEY_TYPE
+
+# Integer surrogate keys of fetch_data.db (FETCH_KEY_TYPE=integer).
+#
+# Stored as TEXT, ids repeat their 24-character ObjectId (36 for item uuids, and barcodes or names
+# for brand codes) in every row, in every index that carries them and on both sides of every join.
+# With integer keys, each id is numbered once in key_map, and the tables hold its key instead:
+# users._id, brands._id, receipts._id and receiptItems._id become INTEGER PRIMARY KEY (the rowid,
+# so the tables need no separate key index), and the columns that refer to them (receipts.userId,
+# receiptItems.receiptId and the brandCode of brands, receiptItems and the rollups) hold the same
+# integers, so joins, foreign keys and the indexes over them compare small integers. The column
+# names stay the same, so every query of the repo runs unchanged on either key type.
+#
+# key_map is never dropped, also not by a replace load: ids keep the key they got first, and new
+# ids are numbered after the largest key of their kind, in id order (ObjectIds start with their
+# creation time, so keys roughly follow it). original_ids turns keys back into ids for reports.
+# Switching key types takes a replace load.
+
+# Kind of key held by each id column
+KEY_COLUMNS = {
+    "users": {"_id": "user"},
+    "brands": {"_id": "brand", "brandCode": "brandCode"},
+    "receipts": {"_id": "receipt", "userId": "user"},
+    "receiptItems": {"_id": "item", "receiptId": "receipt", "brandCode": "brandCode"},
+    # Rollups of rollups.py
+    "brand_daily_rollup": {"brandCode": "brandCode"},
+    "brand_monthly_users": {"brandCode": "brandCode", "userId": "user"},
+}
+
+KEY_MAP_TABLE = """
+CREATE TABLE IF NOT EXISTS key_map (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;"""
+
+# Largest key per kind, and keys back to ids
+KEY_MAP_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS ux_key_map_kind_key ON key_map (kind, key)"
+
+
+def key_columns(table, key_type=KEY_TYPE):
+    """
+    The id columns of `table` mapped to their kind of key ({column: kind}), or {} with text keys.
+    """
+    return KEY_COLUMNS.get(table, {}) if key_type == "integer" else {}
+
+
+def integer_key_tables(tables):
+    """
+    Return the declared DDL of `tables` with INTEGER id columns (see the module comment).
+    """
+    declared = {}
+    for table, ddl in tables.items():
+        for column in KEY_COLUMNS.get(table, {}):
+            ddl = re.sub(rf"^    {column} TEXT\b", f"    {column} INTEGER", ddl, flags=re.MULTILINE)
+        declared[table] = ddl
+    return declared
+
+
+def stored_key_type(conn):
+    """
+    The key type of the stored tables ("text" or "integer"), or None before the first load.
+    """
+    for _, name, declared, *_ in conn.execute("PRAGMA table_info(users)"):
+        if name == "_id":
+            return "integer" if declared == "INTEGER" else "text"
+    return None
+
+
+def create_key_map(conn):
+    conn.execute(KEY_MAP_TABLE)
+    conn.execute(KEY_MAP_INDEX)
+
+
+def assign_keys(conn, kind, source):
+    """
+    Number the ids selected by `source` (a query with an "id" column) that have no key of `kind` yet.
+    """
+    create_key_map(conn)
+    last = conn.execute("SELECT COALESCE(MAX(key), 0) FROM key_map WHERE kind = ?", (kind,)).fetchone()[0]
+    conn.execute(f"""
+        INSERT INTO key_map (kind, id, key)
+        SELECT :kind, id, :last + ROW_NUMBER() OVER (ORDER BY id)
+        FROM (SELECT DISTINCT id FROM ({source}) WHERE id IS NOT NULL) AS s
+        WHERE NOT EXISTS (SELECT 1 FROM key_map AS k WHERE k.kind = :kind AND k.id = s.id)
+    """, {"kind": kind, "last": last})
+
+
+def key_lookup(kind, expression):
+    """
+    SQL expression for the key of the id `expression` (NULL stays NULL).
+    """
+    return f"(SELECT key FROM key_map WHERE kind = '{kind}' AND id = {expression})"
+
+
+def map_keys(conn, table, df, key_type=KEY_TYPE):
+    """
+    Return `df` (rows of `table`) with its ids replaced by their keys, numbering new ids.
+    """
+    keys = key_columns(table, key_type)
+    if not keys:
+        return df
+    df = df.copy()
+    conn.execute("CREATE TEMP TABLE incoming_ids (id PRIMARY KEY)")
+    for column, kind in keys.items():
+        conn.execute("DELETE FROM incoming_ids")
+        conn.executemany("INSERT OR IGNORE INTO incoming_ids VALUES (?)", ((i,) for i in df[column].dropna()))
+        assign_keys(conn, kind, "SELECT id FROM incoming_ids")
+        mapping = dict(conn.execute("""
+            SELECT k.id, k.key FROM incoming_ids AS i JOIN key_map AS k ON k.kind = ? AND k.id = i.id
+        """, (kind,)))
+        # Python ints (and None), which sqlite3 binds as integers, unlike numpy's
+        df[column] = pd.Series([mapping.get(i) for i in df[column]], index=df.index, dtype=object)
+    conn.execute("DROP TABLE incoming_ids")
+    return df
+
+
+def original_ids(conn, kind, keys):
+    """
+    The ids of `keys` of `kind`, in the same order (keys without an id are returned as they are).
+    """
+    ids = dict(conn.execute(f"""
+        SELECT key, id FROM key_map WHERE kind = ? AND key IN ({', '.join('?' for _ in keys)})
+    """, (kind, *keys))) if keys else {}
+    return [ids.get(key, key) for key in keys]
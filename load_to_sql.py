@@ -1,84 +1,165 @@
-import os
-import pandas as pd
 import sqlite3
 
-# Database file path
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "fetch_data.db")
-DATA_PATH = os.path.join(BASE_DIR, "data", "cleaned")
+from config import DB_PATH, INCREMENTAL, LOAD_MODE, STORAGE_LAYOUT, RELOAD_MONTHS, KEY_TYPE
+from instrumentation import step, count
+from keys import stored_key_type, create_key_map, map_keys
+from sql_loader import (TABLES, TABLE_SOURCES, INDEXES, LOAD_PRAGMAS, apply_pragmas, read_for_sql, bulk_load,
+                        add_missing_columns, create_indexes, check_references, upsert_table, delete_stale_items,
+                        keep_latest_receipts)
+from partitions import (PARTITIONED_TABLES, stored_layout, check_months, drop_partitions, create_layout,
+                        partition_sources, partition_tables, unpartitioned_indexes, stage_outputs, stage_frames,
+                        incoming_months, write_partitions)
+from query_cache import bump_data_versions
+from query_api import refresh_anchors
+from rollups import ROLLUP_TABLES, SOURCES, rollups_exist, rebuild_rollups, update_rollups
+from watermarks import commit_pending, clear_pending
+
+if STORAGE_LAYOUT not in ("single", "monthly"):
+    raise ValueError(f"Unknown FETCH_STORAGE_LAYOUT {STORAGE_LAYOUT!r}, expected 'single' or 'monthly'")
+monthly = STORAGE_LAYOUT == "monthly"
+if KEY_TYPE not in ("text", "integer"):
+    raise ValueError(f"Unknown FETCH_KEY_TYPE {KEY_TYPE!r}, expected 'text' or 'integer'")
+if LOAD_MODE == "partitions" and not monthly:
+    raise ValueError("FETCH_LOAD_MODE=partitions needs FETCH_STORAGE_LAYOUT=monthly")
+if LOAD_MODE == "partitions" and INCREMENTAL:
+    # The stage outputs of an incremental run only hold the changed receipts: rebuilding their
+    # months from those alone would drop every other receipt of the month
+    raise ValueError("FETCH_LOAD_MODE=partitions rebuilds whole months and cannot load an incremental run; "
+                     "use FETCH_LOAD_MODE=upsert")
+check_months(RELOAD_MONTHS)
 
 # Connect to the SQLite database
 conn = sqlite3.connect(DB_PATH)
 cursor = conn.cursor()
 
-# Create database tables
-cursor.executescript("""
-DROP TABLE IF EXISTS users;
-CREATE TABLE users (
-    _id TEXT PRIMARY KEY,
-    active BOOLEAN,
-    createdDate TIMESTAMP,
-    lastLogin TIMESTAMP,
-    role TEXT,
-    signUpSource TEXT,
-    state TEXT
-);
+layout = stored_layout(conn)
+if LOAD_MODE != "replace" and layout not in (None, STORAGE_LAYOUT):
+    raise ValueError(f"fetch_data.db stores receipts in the {layout!r} layout; "
+                     f"switching to {STORAGE_LAYOUT!r} takes a replace load (FETCH_LOAD_MODE=replace)")
+key_type = stored_key_type(conn)
+if LOAD_MODE != "replace" and key_type not in (None, KEY_TYPE):
+    raise ValueError(f"fetch_data.db stores {key_type} keys; switching to {KEY_TYPE} keys takes a replace load "
+                     f"(FETCH_LOAD_MODE=replace)")
+if KEY_TYPE == "integer":
+    create_key_map(conn)
+
 
-DROP TABLE IF EXISTS brands;
-CREATE TABLE brands (
-    _id TEXT PRIMARY KEY,
-    barcode TEXT,
-    brandCode TEXT,
-    category TEXT,
-    categoryCode TEXT,
-    cpg TEXT,
-    topBrand BOOLEAN,
-    name TEXT
-);
+def report_partitions(written):
+    for month, (receipts, items) in written.items():
+        print(f"receipts {month}: {receipts} receipts and {items} items written")
+        count(receipts + items, receipts + items)
 
-DROP TABLE IF EXISTS receipts;
-CREATE TABLE receipts (
-    _id TEXT PRIMARY KEY,
-    userId TEXT,
-    createDate TIMESTAMP,
-    dateScanned TIMESTAMP,
-    finishedDate TIMESTAMP,
-    modifyDate TIMESTAMP,
-    pointsAwardedDate TIMESTAMP,
-    purchaseDate TIMESTAMP,
-    purchasedItemCount INTEGER,
-    rewardsReceiptStatus TEXT,
-    totalSpent REAL
-);
 
-DROP TABLE IF EXISTS receiptItems;
-CREATE TABLE receiptItems (
-    _id TEXT PRIMARY KEY,
-    receiptId TEXT REFERENCES receipts(_id),
-    brandCode TEXT REFERENCES brands(brandCode),
-    barcode TEXT,
-    brandName TEXT,
-    description TEXT,
-    quantity INTEGER,
-    price REAL,
-    isBonus BOOLEAN,
-    needsFetchReview BOOLEAN
-);
-""")
+if LOAD_MODE == "replace":
+    # Recreate the declared tables and bulk-load every row from the Parquet stage outputs
+    with step("bulk load") as span:
+        drop_partitions(conn)
+        tables = {table: name for table, name in TABLE_SOURCES.items() if not (monthly and table in PARTITIONED_TABLES)}
+        for table, (rows, seconds) in bulk_load(conn, tables).items():
+            print(f"{table}: {rows} rows loaded in {seconds:.2f}s ({rows / max(seconds, 1e-9):,.0f} rows/s)")
+            span.count(rows, rows)
+            count(rows, rows)
+        changed = set(TABLES)
+        if monthly:
+            staged = stage_outputs(conn)
+            written, partitions_changed = write_partitions(conn, rollups=False)
+            print(f"receipts: {staged['receipts']} rows and receiptItems: {staged['receiptItems']} rows "
+                  f"loaded into {len(written)} monthly partitions")
+            span.count(sum(staged.values()), sum(staged.values()))
+            count(sum(staged.values()), sum(staged.values()))
+            changed |= partitions_changed
+    with step("create indexes"):
+        create_indexes(conn, unpartitioned_indexes() if monthly else INDEXES)
+    with step("rebuild rollups"):
+        rebuild_rollups(conn, partition_sources(conn) if monthly else SOURCES)
+    changed |= set(ROLLUP_TABLES)
+elif LOAD_MODE in ("upsert", "partitions"):
+    # Keep the stored rows and only write what is new or changed
+    apply_pragmas(conn, LOAD_PRAGMAS)
+    unpartitioned = {table: ddl for table, ddl in TABLES.items() if not (monthly and table in PARTITIONED_TABLES)}
+    cursor.executescript("".join(unpartitioned.values()))
+    if monthly:
+        create_layout(conn)
+    add_missing_columns(conn, {**unpartitioned, **(partition_tables(conn) if monthly else {})})
+    # With integer keys, the ids of the incoming rows are replaced by their keys first
+    frames = {table: map_keys(conn, table, read_for_sql(TABLE_SOURCES[table])) for table in ["users", "brands"]}
+    if LOAD_MODE == "upsert":
+        df_receipts = map_keys(conn, "receipts", read_for_sql("receipts_cleaned"))
+        df_receipt_items = map_keys(conn, "receiptItems", read_for_sql("receiptItems_cleaned"))
+        # Receipts (and their items) only replace stored receipts with an older dateScanned
+        frames["receipts"] = keep_latest_receipts(conn, df_receipts)
+        frames["receiptItems"] = df_receipt_items[df_receipt_items["receiptId"].isin(frames["receipts"]["_id"])]
+        skipped = len(df_receipts) - len(frames["receipts"])
+        if skipped:
+            print(f"receipts: {skipped} rows skipped, the stored version is newer")
+    create_indexes(conn, unpartitioned_indexes() if monthly else INDEXES)
+    changed = set()
+    if not rollups_exist(conn):
+        rebuild_rollups(conn, partition_sources(conn) if monthly else SOURCES)
+        changed |= set(ROLLUP_TABLES)
+    if monthly:
+        # Users and brands are upserted; receipts and their items go to their month partitions
+        for table in ["users", "brands"]:
+            with step(f"upsert {table}") as span:
+                written = upsert_table(conn, table, frames[table])
+                span.count(len(frames[table]), written)
+            count(len(frames[table]), written)
+            print(f"{table}: {written} rows inserted or updated")
+            if written:
+                changed.add(table)
+        with step("write partitions"):
+            if LOAD_MODE == "partitions":
+                # Every month of the stage outputs (or of FETCH_RELOAD_MONTHS) is replaced as a whole
+                stage_outputs(conn)
+                replace = RELOAD_MONTHS or incoming_months(conn)
+                print(f"Reloading the partitions of {', '.join(replace) or 'no months'}")
+                written, partitions_changed = write_partitions(conn, replace=replace, months=RELOAD_MONTHS or None)
+            else:
+                stage_frames(conn, frames)
+                written, partitions_changed = write_partitions(conn)
+        report_partitions(written)
+        if partitions_changed:
+            changed |= partitions_changed | set(PARTITIONED_TABLES) | {"receipt_partitions"} | set(ROLLUP_TABLES)
+    else:
+        # Take the stored versions of the incoming receipts out of the rollups, write the new ones, add them back
+        update_rollups(conn, frames["receipts"]["_id"], -1)
+        for table, df in frames.items():
+            with step(f"upsert {table}") as span:
+                written = upsert_table(conn, table, df)
+                span.count(len(df), written)
+            count(len(df), written)
+            print(f"{table}: {written} rows inserted or updated")
+            if written:
+                changed.add(table)
+        deleted = delete_stale_items(conn, frames["receipts"]["_id"], frames["receiptItems"]["_id"])
+        print(f"receiptItems: {deleted} stale rows deleted")
+        if deleted:
+            changed.add("receiptItems")
+        update_rollups(conn, frames["receipts"]["_id"], 1)
+        if changed & {"receipts", "receiptItems"}:
+            changed |= set(ROLLUP_TABLES)
+else:
+    raise ValueError(f"Unknown FETCH_LOAD_MODE {LOAD_MODE!r}, expected 'replace', 'upsert' or 'partitions'")
 
-# Load CSV files and insert into the database
-df_users = pd.read_csv(os.path.join(DATA_PATH, "users_cleaned.csv"))
-df_brands = pd.read_csv(os.path.join(DATA_PATH, "brands_cleaned.csv"))
-df_receipts = pd.read_csv(os.path.join(DATA_PATH, "receipts_cleaned.csv"))
-df_receipt_items = pd.read_csv(os.path.join(DATA_PATH, "receiptItems_cleaned.csv"))
+# Check the declared references now that the data is in
+with step("check references"):
+    references = check_references(conn)
+for (table, column, parent, parent_column), orphans in references.items():
+    if orphans:
+        print(f"{table}.{column}: {orphans} rows without a matching {parent}.{parent_column}")
 
-df_users.to_sql("users", conn, if_exists="replace", index=False)
-df_brands.to_sql("brands", conn, if_exists="replace", index=False)
-df_receipts.to_sql("receipts", conn, if_exists="replace", index=False)
-df_receipt_items.to_sql("receiptItems", conn, if_exists="replace", index=False)
+# Move the watermarks of this run forward, recompute the window anchors of query_api.py and
+# invalidate cached query results of the changed tables, in the same transaction as the data
+watermarks = commit_pending(conn)
+if changed & {"receipts", "users"} or not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'query_anchors'").fetchone():
+    refresh_anchors(conn)
+    changed.add("query_anchors")
+bump_data_versions(conn, sorted(changed))
 
 # Commit and close the connection
 conn.commit()
 conn.close()
+clear_pending()
+print(f"Watermarks: {watermarks}")
 
-print("Data has been successfully inserted into the SQLite database 'fetch_data.db'.")
+print(f"Data has been successfully loaded into the SQLite database 'fetch_data.db' ({LOAD_MODE} mode).")
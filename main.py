@@ -1,54 +1,41 @@
-import subprocess
-import sys
+import argparse
 import os
+import sys
 
-def run_script(script_path):
-    """
-    Execute a single script and output its results.
-
-    This function does the following:
-      - Checks if the script exists. If not, it prints an error message and exits.
-      - Runs the script using Python and captures the output.
-      - Prints the standard output from the script.
-      - If the script fails (i.e., returns a non-zero exit code), it prints the error message and exits.
-      - Otherwise, it prints a success message.
-    """
-    if not os.path.exists(script_path):
-        print(f"Script {script_path} does not exist!")
-        sys.exit(1)
+def main():
+    parser = argparse.ArgumentParser(description="Run the data processing pipeline.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process users and receipts changed since the last load and merge them into the database")
+    parser.add_argument("--jobs", type=int, default=3,
+                        help="number of stages run at the same time (1 runs every stage in this process)")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun every stage, even the ones whose code and inputs did not change")
+    parser.add_argument("--profile", metavar="STAGES",
+                        help="run these stages (comma-separated names, or 'all') under cProfile, see pipeline.py")
+    args = parser.parse_args()
+    if args.incremental:
+        # The scripts read this through config.py
+        os.environ["FETCH_INCREMENTAL"] = "1"
+    if args.profile:
+        os.environ["FETCH_PROFILE"] = args.profile
 
-    print(f"\n===== Running {script_path} =====")
-    result = subprocess.run(["python", script_path], capture_output=True, text=True)
-    print(result.stdout)
-    if result.returncode != 0:
-        print(f"Error executing script {script_path}:")
-        print(result.stderr)
-        sys.exit(result.returncode)
-    else:
-        print(f"===== {script_path} executed successfully =====\n")
+    # Imported only now, so config.py sees the settings above
+    from pipeline import pipeline_stages, run_pipeline
 
-def main():
-    # List the scripts to run in sequence according to our data processing workflow:
-    # 1. Parse raw JSON data and generate raw CSV files.
-    # 2. Clean user data.
-    # 3. Clean brand data.
-    # 4. Clean receipts data.
+    # The pipeline stages, in the order of our data processing workflow:
+    # 1. Clean user data (streamed in batches straight from the raw JSON).
+    # 2. Clean brand data.
+    # 3. Clean receipts data.
+    # 4. Build the brand resolution index from the cleaned brands.
     # 5. Parse receipt items from receipts.
-    # 6. Load the CSV data into an SQLite database.
-    # 7. Execute SQL queries to validate and analyze the results.
-    scripts = [
-        "import json.py",
-        "clean_users.py",
-        "clean_brands.py",
-        "clean_receipts.py",
-        "extract_receipt_items.py",
-        "load_to_sql.py",
-        "check_data_quality.py",
-        "query_sql.py"
-    ]
-
-    for script in scripts:
-        run_script(script)
+    # 6. Load the cleaned Parquet outputs into an SQLite database.
+    # 7. Check that the analytics queries use the loader's indexes instead of full table scans.
+    # 8. Report data-quality issues (missing fields, broken references, out-of-range values).
+    # 9. Execute SQL queries to validate and analyze the results.
+    # Steps 1-3 are independent and run at the same time; stages whose code and inputs did not
+    # change since the last successful run are skipped (see pipeline.py).
+    # "import json.py" is an optional raw CSV export and is not needed by the steps below.
+    sys.exit(run_pipeline(pipeline_stages(), jobs=args.jobs, force=args.force))
 
 if __name__ == "__main__":
     main()
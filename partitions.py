@@ -0,0 +1,383 @@
+import datetime
+import json
+import re
+
+from columnar import table_path
+from config import WORKERS
+from rollups import apply_rollup_deltas
+from keys import key_columns
+from sql_loader import TABLES, TABLE_SOURCES, INDEXES, bulk_load_table, sql_rows
+
+# Month partitions of receipts and receiptItems (FETCH_STORAGE_LAYOUT=monthly).
+#
+# Every month of dateScanned gets its own pair of tables, receipts_YYYY_MM and receiptItems_YYYY_MM,
+# with the declared columns and the INDEXES of the parent table. An item lives in the partition of
+# its receipt, so a receipt and its items are always joined within one pair, and receipts without a
+# dateScanned (and items without a receipt) go to the _undated pair. receipts and receiptItems are
+# views, UNION ALL over the partitions, so every query of the repo still reads them unchanged, and
+# SQLite pushes their WHERE terms into each partition. The catalog table receipt_partitions lists
+# the months with their row counts.
+#
+# A query over a dateScanned window can read only the partitions the window touches instead of
+# the views: window_source() returns the UNION ALL of just those (query_api.py's scan-window
+# statements use it).
+#
+# Loads first put the incoming rows into the load tables (load_receipts, load_receiptItems), from
+# which write_partitions() fills the partitions:
+#   - a replaced month is dropped and rebuilt from the incoming rows alone, so reloading one month
+#     (FETCH_LOAD_MODE=partitions) leaves the tables of every other month as they are;
+#   - in the months that are kept, the incoming receipts and their items are deleted (a newer scan
+#     can move a receipt to another month) and then inserted into the partition of their month.
+# The rollups are corrected for exactly the rows removed and added, partition by partition.
+
+PARTITIONED_TABLES = ["receipts", "receiptItems"]
+
+# Month of receipts without a dateScanned
+UNDATED = "undated"
+
+CATALOG_TABLE = """
+CREATE TABLE IF NOT EXISTS receipt_partitions (
+    month TEXT PRIMARY KEY,
+    receipts INTEGER NOT NULL,
+    items INTEGER NOT NULL
+) WITHOUT ROWID;"""
+
+# Incoming rows of a load, before they are written to their partitions
+LOAD_TABLES = {"receipts": "load_receipts", "receiptItems": "load_receiptItems"}
+
+# Partition month of a receipt: 'YYYY-MM' from its dateScanned text
+MONTH_OF = f"COALESCE(substr(dateScanned, 1, 7), '{UNDATED}')"
+
+MONTH = re.compile(rf"^(?:\d{{4}}-\d{{2}}|{UNDATED})$")
+PARTITION_TABLE = re.compile(rf"^(?P<parent>{'|'.join(PARTITIONED_TABLES)})_(?:\d{{4}}_\d{{2}}|{UNDATED})$")
+
+
+def partition_table(parent, month):
+    """
+    Name of the partition of `parent` for `month` ('2021-01' -> receipts_2021_01).
+    """
+    return f"{parent}_{month.replace('-', '_')}"
+
+
+def partition_pair(month):
+    return partition_table("receipts", month), partition_table("receiptItems", month)
+
+
+def parent_table(name):
+    """
+    The partitioned table a partition belongs to ("receipts_2021_01" -> "receipts"); other names are returned as they are.
+    """
+    match = PARTITION_TABLE.match(name)
+    return match["parent"] if match else name
+
+
+def table_ddl(parent, name):
+    """
+    The declared DDL of `parent` for a table called `name`, without its REFERENCES clauses
+    (a partition cannot reference a view; check_references checks the views instead).
+    """
+    ddl = TABLES[parent].replace(f"CREATE TABLE IF NOT EXISTS {parent} (", f"CREATE TABLE IF NOT EXISTS {name} (", 1)
+    return re.sub(r" REFERENCES \w+\(\w+\)", "", ddl)
+
+
+def partition_indexes(parent, name):
+    """
+    The INDEXES of `parent`, renamed for its partition `name`.
+    """
+    return {index.replace(f"ix_{parent}_", f"ix_{name}_", 1):
+            ddl.replace(f"ix_{parent}_", f"ix_{name}_", 1).replace(f"ON {parent} (", f"ON {name} (")
+            for index, ddl in INDEXES.items() if f"ON {parent} (" in ddl}
+
+
+def unpartitioned_indexes():
+    """
+    The INDEXES of the tables that are not partitioned.
+    """
+    return {index: ddl for index, ddl in INDEXES.items()
+            if not any(f"ON {parent} (" in ddl for parent in PARTITIONED_TABLES)}
+
+
+def stored_layout(conn):
+    """
+    Layout of receipts in the database: "monthly" (a view over partitions), "single" (a table), or None.
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'receipts'").fetchone()
+    return None if row is None else "monthly" if row[0] == "view" else "single"
+
+
+def stored_months(conn):
+    """
+    The months that have partitions, in order.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'receipt_partitions'").fetchone():
+        return []
+    return [month for (month,) in conn.execute("SELECT month FROM receipt_partitions ORDER BY month")]
+
+
+def partition_rows(conn):
+    """
+    {partition table: rows} from the catalog.
+    """
+    if not stored_months(conn):
+        return {}
+    rows = {}
+    for month, receipts, items in conn.execute("SELECT month, receipts, items FROM receipt_partitions"):
+        rows.update(zip(partition_pair(month), (receipts, items)))
+    return rows
+
+
+def check_months(months):
+    """
+    Validate a list of partition months ('YYYY-MM' or 'undated').
+    """
+    bad = [month for month in months if not MONTH.match(month)]
+    if bad:
+        raise ValueError(f"Months must look like 2021-01 (or '{UNDATED}'), got {', '.join(bad)}")
+    return list(months)
+
+
+def months_between(first_day, last_day):
+    """
+    The months from the one of `first_day` to the one of `last_day` ('YYYY-MM-DD' text), both included.
+    """
+    first, last = datetime.date.fromisoformat(first_day[:10]), datetime.date.fromisoformat(last_day[:10])
+    months = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def window_months(conn, first_day=None, last_day=None):
+    """
+    The stored months from the one of `first_day` to the one of `last_day` (all of them without a window).
+    """
+    months = stored_months(conn)
+    if first_day is not None:
+        months = sorted(set(months) & set(months_between(first_day, last_day))) or [UNDATED]
+    return months
+
+
+def per_partition(conn, sql, first_day=None, last_day=None):
+    """
+    UNION ALL of `sql` once per partition pair of the window: {receipts} and {receiptItems} become the
+    tables of one month each. Without partitions, `sql` on the tables themselves.
+
+    Joins of receipts and receiptItems go through this instead of the views, since SQLite cannot push
+    a join into a UNION ALL view: it would materialize the view and build an automatic index on it.
+    """
+    if stored_layout(conn) != "monthly":
+        return sql.format(receipts="receipts", receiptItems="receiptItems")
+    return "\nUNION ALL\n".join(sql.format(receipts=receipts, receiptItems=receipt_items)
+                                 for receipts, receipt_items in map(partition_pair, window_months(conn, first_day, last_day)))
+
+
+def window_source(conn, parent, first_day, last_day):
+    """
+    A FROM source for `parent` that only reads the partitions of the months from `first_day` to
+    `last_day`; without partitions, the table itself.
+    """
+    if stored_layout(conn) != "monthly":
+        return parent
+    return "(" + per_partition(conn, f"SELECT * FROM {{{parent}}}", first_day, last_day) + ")"
+
+
+def create_views(conn, months):
+    """
+    (Re)create the receipts and receiptItems views over the partitions of `months`.
+    """
+    for parent in PARTITIONED_TABLES:
+        conn.execute(f"DROP VIEW IF EXISTS {parent}")
+        union = " UNION ALL ".join(f"SELECT * FROM {partition_table(parent, month)}" for month in months)
+        conn.execute(f"CREATE VIEW {parent} AS {union}")
+
+
+def drop_partitions(conn):
+    """
+    Drop the partitioned tables in either layout: partitions, views, catalog, or the single tables.
+    """
+    layout = stored_layout(conn)
+    if layout == "monthly":
+        for month in stored_months(conn):
+            for table in partition_pair(month):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+        for parent in PARTITIONED_TABLES:
+            conn.execute(f"DROP VIEW IF EXISTS {parent}")
+        conn.execute("DROP TABLE IF EXISTS receipt_partitions")
+    elif layout == "single":
+        for parent in PARTITIONED_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS {parent}")
+
+
+def partition_sources(conn):
+    """
+    The (receipts, receiptItems) partition pairs, as rollup sources.
+    """
+    return [partition_pair(month) for month in stored_months(conn)]
+
+
+def create_load_tables(conn):
+    for parent, name in LOAD_TABLES.items():
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute(table_ddl(parent, name))
+
+
+def stage_outputs(conn, workers=WORKERS):
+    """
+    Bulk-load the receipts and receiptItems stage outputs into the load tables.
+    Returns {table: rows}.
+    """
+    create_load_tables(conn)
+    return {parent: bulk_load_table(conn, name, table_path(TABLE_SOURCES[parent]), workers=workers,
+                                    keys=key_columns(parent))
+            for parent, name in LOAD_TABLES.items()}
+
+
+def stage_frames(conn, frames):
+    """
+    Insert the receipts and receiptItems DataFrames of `frames` into the load tables.
+    """
+    create_load_tables(conn)
+    for parent, name in LOAD_TABLES.items():
+        df = frames[parent]
+        column_list = ", ".join(f'"{col}"' for col in df.columns)
+        conn.executemany(f"INSERT OR REPLACE INTO {name} ({column_list}) VALUES ({', '.join('?' for _ in df.columns)})",
+                         sql_rows(df))
+
+
+def incoming_months(conn):
+    """
+    The months of the receipts in the load tables.
+    """
+    return [month for (month,) in conn.execute(f"SELECT DISTINCT {MONTH_OF} FROM load_receipts ORDER BY 1")]
+
+
+def partition_tables(conn):
+    """
+    {partition: declared DDL} of every stored partition (for add_missing_columns).
+    """
+    return {table: table_ddl(parent, table)
+            for month in stored_months(conn) for parent, table in zip(PARTITIONED_TABLES, partition_pair(month))}
+
+
+def create_layout(conn):
+    """
+    Start the monthly layout in a database that has no receipts yet: the catalog, the (empty)
+    undated partitions and the views over them.
+    """
+    if stored_layout(conn) is not None:
+        return
+    conn.execute(CATALOG_TABLE)
+    create_partition(conn, UNDATED)
+    index_partition(conn, UNDATED)
+    conn.execute("INSERT OR REPLACE INTO receipt_partitions (month, receipts, items) VALUES (?, 0, 0)", (UNDATED,))
+    create_views(conn, [UNDATED])
+
+
+def create_partition(conn, month):
+    """
+    Create the partition pair of `month` if it does not exist yet; returns True if it was created.
+    Its indexes are built by index_partition once the rows are in.
+    """
+    receipts, _ = partition_pair(month)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (receipts,)).fetchone():
+        return False
+    for parent, table in zip(PARTITIONED_TABLES, partition_pair(month)):
+        conn.execute(table_ddl(parent, table))
+    return True
+
+
+def index_partition(conn, month):
+    for parent, table in zip(PARTITIONED_TABLES, partition_pair(month)):
+        for ddl in partition_indexes(parent, table).values():
+            conn.execute(ddl)
+
+
+def write_partitions(conn, replace=(), months=None, rollups=True):
+    """
+    Write the rows of the load tables into the partitions of their months (see the module comment).
+
+    Months in `replace` are dropped first and hold only the incoming rows afterwards; with `months`,
+    incoming rows of other months are ignored. With `rollups`, the rollups are corrected for the
+    removed and added rows (leave it off when the rollups are rebuilt afterwards).
+    Returns {month: (receipts, items) written}, and the partition tables that changed.
+    """
+    conn.execute(CATALOG_TABLE)
+    # Month of every incoming receipt and item (items without an incoming receipt are undated)
+    conn.execute("DROP TABLE IF EXISTS load_months")
+    conn.execute(f"""
+        CREATE TEMP TABLE load_months AS
+        SELECT 'receipts' AS parent, {MONTH_OF} AS month, rowid AS row, _id AS receiptId FROM load_receipts
+    """)
+    conn.execute("CREATE INDEX temp.ix_load_months_receiptId ON load_months (receiptId)")
+    conn.execute(f"""
+        INSERT INTO load_months
+        SELECT 'receiptItems', COALESCE(r.month, '{UNDATED}'), i.rowid, i.receiptId
+        FROM load_receiptItems AS i
+        LEFT JOIN load_months AS r ON r.parent = 'receipts' AND r.receiptId = i.receiptId
+    """)
+    conn.execute("CREATE INDEX temp.ix_load_months ON load_months (parent, month, row)")
+    incoming = [month for (month,) in conn.execute("SELECT DISTINCT month FROM load_months ORDER BY month")]
+    if months is not None:
+        incoming = [month for month in incoming if month in set(months)]
+    conn.execute("DROP TABLE IF EXISTS incoming_receipts")
+    conn.execute("CREATE TEMP TABLE incoming_receipts (_id PRIMARY KEY)")
+    conn.execute("""
+        INSERT OR IGNORE INTO incoming_receipts
+        SELECT receiptId FROM load_months WHERE parent = 'receipts' AND month IN (SELECT value FROM json_each(?))
+    """, (json.dumps(incoming),))
+    is_incoming = "r._id IN (SELECT _id FROM incoming_receipts)"
+
+    changed = set()
+    stored = stored_months(conn)
+    for month in stored:
+        receipts, receipt_items = partition_pair(month)
+        if month in replace:
+            if rollups:
+                apply_rollup_deltas(conn, "1", -1, [(receipts, receipt_items)])
+            conn.execute(f"DROP TABLE {receipt_items}")
+            conn.execute(f"DROP TABLE {receipts}")
+            conn.execute("DELETE FROM receipt_partitions WHERE month = ?", (month,))
+            changed |= {receipts, receipt_items}
+            continue
+        if rollups:
+            apply_rollup_deltas(conn, is_incoming, -1, [(receipts, receipt_items)])
+        deleted = conn.execute(f"DELETE FROM {receipt_items} WHERE receiptId IN (SELECT _id FROM incoming_receipts)").rowcount
+        deleted += conn.execute(f"DELETE FROM {receipts} WHERE _id IN (SELECT _id FROM incoming_receipts)").rowcount
+        if deleted:
+            changed |= {receipts, receipt_items}
+
+    written = {}
+    for month in sorted(set(incoming) | {UNDATED}):
+        created = create_partition(conn, month)
+        counts = []
+        for parent, table in zip(PARTITIONED_TABLES, partition_pair(month)):
+            # In key order, like the bulk load; OR REPLACE for an item id that moved between receipts
+            counts.append(conn.execute(f"""
+                INSERT OR REPLACE INTO {table}
+                SELECT l.* FROM load_months AS m
+                JOIN {LOAD_TABLES[parent]} AS l ON l.rowid = m.row
+                WHERE m.parent = ? AND m.month = ?
+                ORDER BY l._id
+            """, (parent, month)).rowcount if month in incoming else 0)
+        if created:
+            index_partition(conn, month)
+        if rollups and month in incoming:
+            apply_rollup_deltas(conn, is_incoming, 1, [partition_pair(month)])
+        if created or any(counts):
+            changed |= set(partition_pair(month))
+            written[month] = tuple(counts)
+
+    # Row counts of the partitions that changed, and the views if the set of partitions did
+    for month in set(stored_months(conn)) | set(written):
+        if set(partition_pair(month)) & changed:
+            counts = [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in partition_pair(month)]
+            conn.execute("INSERT OR REPLACE INTO receipt_partitions (month, receipts, items) VALUES (?, ?, ?)",
+                         (month, *counts))
+    if stored_months(conn) != stored or stored_layout(conn) != "monthly":
+        create_views(conn, stored_months(conn))
+
+    for table in ["load_months", "incoming_receipts", *LOAD_TABLES.values()]:
+        conn.execute(f"DROP TABLE {table}")
+    return written, changed
@@ -0,0 +1,319 @@
+import ast
+import contextlib
+import cProfile
+import hashlib
+import json
+import multiprocessing
+import os
+import pstats
+import runpy
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from columnar import table_path
+from config import (BASE_DIR, STATE_PATH, DB_PATH, USERS_FILE, BRANDS_FILE, RECEIPTS_FILE, INCREMENTAL,
+                    BRAND_INDEX_PATH, TRACE_PATH, PROFILE_STAGES, PROFILE_PATH)
+from instrumentation import TRACER, summary_table, write_trace
+
+# DAG runner for the pipeline scripts.
+#
+# Every script is a stage with the files it reads and writes. A stage starts as soon as the
+# stages producing its inputs have finished, so independent stages (the three cleaners) run
+# at the same time. Stages run in a process pool whose workers are forked from a server that
+# has pandas and pyarrow imported already, or in the current process with jobs=1.
+#
+# A stage is skipped when its fingerprint matches the last successful run and its outputs are
+# still what that run wrote. The fingerprint hashes the script, the local modules it imports,
+# the contents of its input files and the FETCH_* settings. The stdout of a skipped stage is
+# replayed from its log in data/state/logs, so reports still show up.
+#
+# The time and peak resident memory of every stage that ran are printed with its output and
+# kept in data/state/stages.json. The peak is reset before each stage on Linux, so stages that
+# share a process (jobs=1) are still measured one by one. The full measurements of the stages
+# and of their steps (see instrumentation.py) are appended to data/state/trace.jsonl and printed
+# as a table at the end of the run. Stages listed in FETCH_PROFILE run under cProfile; the
+# hottest functions go to the stage log and the whole profile to data/state/profiles.
+
+STAGE_STATE_FILE = os.path.join(STATE_PATH, "stages.json")
+STAGE_LOG_PATH = os.path.join(STATE_PATH, "logs")
+
+# Modules the stage workers import once, before any stage is forked off
+PRELOAD_MODULES = ["pandas", "pyarrow", "pyarrow.parquet", "pyarrow.compute", "columnar", "extended_json"]
+
+# Settings that do not change what a stage produces
+IGNORED_SETTINGS = {"FETCH_WORKERS", "FETCH_BATCH_SIZE", "FETCH_TRACE_PATH", "FETCH_PROFILE", "FETCH_DEDUP_MEMORY_MB",
+                    "FETCH_DEDUP_PARTITIONS", "FETCH_SPILL_PATH", "FETCH_GZIP_INDEX_SPAN_MB"}
+
+# Functions of a profiled stage listed in its log
+PROFILE_TOP_FUNCTIONS = 25
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    # Files that change what the stage produces but are written further down the pipeline,
+    # so they count for the fingerprint but not for the order of the stages
+    state_inputs: list = field(default_factory=list)
+
+    @property
+    def script_path(self):
+        return os.path.join(BASE_DIR, self.script)
+
+
+def pipeline_stages():
+    """
+    Return the stages of the default pipeline run.
+    Dependencies are not listed; they follow from which stage writes each input file.
+    """
+    # Incremental cleaners filter on the watermarks that load_to_sql stores in the database
+    watermarks = [DB_PATH] if INCREMENTAL else []
+    cleaned = {name: table_path(name) for name in
+               ["users_cleaned", "brands_cleaned", "receipts_cleaned", "receiptItems_cleaned"]}
+    return [
+        Stage("clean_users", "clean_users.py", [USERS_FILE], [cleaned["users_cleaned"]], watermarks),
+        Stage("clean_brands", "clean_brands.py", [BRANDS_FILE], [cleaned["brands_cleaned"]]),
+        Stage("clean_receipts", "clean_receipts.py", [RECEIPTS_FILE], [cleaned["receipts_cleaned"]],
+              watermarks),
+        Stage("build_brand_index", "build_brand_index.py", [cleaned["brands_cleaned"]], [BRAND_INDEX_PATH]),
+        Stage("extract_receipt_items", "extract_receipt_items.py",
+              [BRAND_INDEX_PATH, cleaned["receipts_cleaned"]], [cleaned["receiptItems_cleaned"]]),
+        Stage("load_to_sql", "load_to_sql.py", list(cleaned.values()), [DB_PATH]),
+        Stage("check_query_plans", "check_query_plans.py", [DB_PATH]),
+        Stage("check_data_quality", "check_data_quality.py", [DB_PATH]),
+        Stage("query_sql", "query_sql.py", [DB_PATH] + list(cleaned.values())),
+    ]
+
+
+def stage_dependencies(stages):
+    """
+    Map each stage name to the names of the stages that write one of its inputs.
+    """
+    writers = {path: stage.name for stage in stages for path in stage.outputs}
+    return {stage.name: {writers[path] for path in stage.inputs if path in writers and writers[path] != stage.name}
+            for stage in stages}
+
+
+def local_modules(script_path, seen=None):
+    """
+    Return the script and, recursively, every module of this repository it imports.
+    """
+    seen = set() if seen is None else seen
+    if script_path in seen:
+        return seen
+    seen.add(script_path)
+    with open(script_path) as f:
+        tree = ast.parse(f.read(), filename=script_path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module_path = os.path.join(BASE_DIR, name.split(".")[0] + ".py")
+            if os.path.exists(module_path):
+                local_modules(module_path, seen)
+    return seen
+
+
+class FileDigests:
+    """
+    SHA-256 of file contents, memoized on (size, mtime) so unchanged files are not re-read.
+    """
+
+    def __init__(self, memo=None):
+        self.memo = memo or {}
+
+    def __call__(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self.memo.get(path)
+        if cached and cached[:2] == key:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self.memo[path] = key + [digest.hexdigest()]
+        return digest.hexdigest()
+
+
+def stage_fingerprint(stage, file_digest):
+    """
+    Hash everything that decides what a stage produces: code, input contents and settings.
+    """
+    settings = {key: value for key, value in os.environ.items()
+                if key.startswith("FETCH_") and key not in IGNORED_SETTINGS}
+    parts = {
+        "code": {os.path.relpath(path, BASE_DIR): file_digest(path) for path in sorted(local_modules(stage.script_path))},
+        "inputs": {path: file_digest(path) for path in stage.inputs + stage.state_inputs},
+        "settings": settings,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def load_state():
+    if not os.path.exists(STAGE_STATE_FILE):
+        return {"stages": {}, "files": {}}
+    with open(STAGE_STATE_FILE) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    os.makedirs(STATE_PATH, exist_ok=True)
+    tmp_file = STAGE_STATE_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, STAGE_STATE_FILE)
+
+
+def log_path(stage):
+    return os.path.join(STAGE_LOG_PATH, f"{stage.name}.log")
+
+
+def is_profiled(stage):
+    return stage.name in PROFILE_STAGES or "all" in PROFILE_STAGES
+
+
+def run_script(stage):
+    """
+    Execute the stage script as __main__, under cProfile if the stage is listed in FETCH_PROFILE.
+    """
+    # Worker pools of the stage must fork: a forkserver or spawn child would re-run the script,
+    # which is __main__ while it runs
+    if "fork" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("fork", force=True)
+    if not is_profiled(stage):
+        runpy.run_path(stage.script_path, run_name="__main__")
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(runpy.run_path, stage.script_path, run_name="__main__")
+    finally:
+        os.makedirs(PROFILE_PATH, exist_ok=True)
+        profile_file = os.path.join(PROFILE_PATH, f"{stage.name}.prof")
+        profiler.dump_stats(profile_file)
+        print(f"\nProfile written to {profile_file}; functions with the most cumulative time:")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+
+def run_stage(stage):
+    """
+    Execute one stage script as __main__, with its stdout and stderr written to the stage log.
+    Returns (succeeded, seconds, peak memory in bytes, traceback text, trace records).
+    """
+    os.makedirs(STAGE_LOG_PATH, exist_ok=True)
+    with open(log_path(stage), "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        with TRACER.run_stage(stage.name) as span:
+            try:
+                run_script(stage)
+                error = None
+            except SystemExit as exc:
+                error = None if exc.code in (None, 0) else traceback.format_exc()
+            except BaseException:
+                error = traceback.format_exc()
+    return error is None, span.wall, span.peak, error, TRACER.records()
+
+
+def print_stage_log(stage, status):
+    print(f"\n===== {stage.script} ({status}) =====")
+    if os.path.exists(log_path(stage)):
+        with open(log_path(stage)) as f:
+            print(f.read(), end="")
+
+
+def run_pipeline(stages, jobs=1, force=False):
+    """
+    Run `stages` in dependency order, up to `jobs` at a time, skipping the ones that are up to date.
+
+    Stage output is printed as a block when the stage finishes. The first failing stage stops
+    the run (stages already running are allowed to finish). Returns the process exit code.
+    """
+    state = load_state()
+    file_digest = FileDigests(state["files"])
+    dependencies = stage_dependencies(stages)
+    fingerprints, done, running, failed = {}, set(), {}, None
+    run_id = time.strftime("%Y-%m-%dT%H:%M:%S")
+    trace = []
+
+    def is_up_to_date(stage):
+        previous = state["stages"].get(stage.name)
+        if force or previous is None or previous["fingerprint"] != fingerprints[stage.name]:
+            return False
+        # The outputs must still be the files the last run wrote
+        return all(file_digest(path) == digest for path, digest in previous["outputs"].items())
+
+    def complete(stage, succeeded, seconds, peak_bytes, error, records):
+        write_trace(TRACE_PATH, run_id, [{**record, "ok": succeeded} for record in records])
+        trace.extend(records)
+        if not succeeded:
+            print_stage_log(stage, "failed")
+            print(f"Error executing script {stage.script}:")
+            print(error)
+            return stage.name
+        print_stage_log(stage, f"{seconds:.1f}s, peak memory {peak_bytes / 2**20:.0f} MiB")
+        print(f"===== {stage.script} executed successfully =====\n")
+        state["stages"][stage.name] = {
+            "fingerprint": fingerprints[stage.name],
+            "outputs": {path: file_digest(path) for path in stage.outputs},
+            "seconds": round(seconds, 3),
+            "peak_memory_mb": round(peak_bytes / 2**20, 1),
+        }
+        save_state(state)
+        done.add(stage.name)
+        return None
+
+    if jobs > 1:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        # One stage per worker process, so no module state leaks from one stage script into the next
+        pool = ProcessPoolExecutor(max_workers=jobs, mp_context=context, max_tasks_per_child=1)
+    else:
+        pool = None
+
+    try:
+        while len(done) < len(stages) and failed is None:
+            ready = [stage for stage in stages if stage.name not in done and stage not in running.values()
+                     and dependencies[stage.name] <= done]
+            if not ready and not running:
+                raise ValueError(f"Stages {sorted(set(dependencies) - done)} depend on each other")
+            for stage in ready:
+                fingerprints[stage.name] = stage_fingerprint(stage, file_digest)
+                if is_up_to_date(stage):
+                    print_stage_log(stage, "up to date, skipped")
+                    done.add(stage.name)
+                    continue
+                # Forget the last run until this one succeeds
+                state["stages"].pop(stage.name, None)
+                if pool is None:
+                    failed = complete(stage, *run_stage(stage))
+                    break
+                running[pool.submit(run_stage, stage)] = stage
+
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    failed = complete(running.pop(future), *future.result()) or failed
+    finally:
+        if pool is not None:
+            # Let running stages finish so no output file is left half-written
+            pool.shutdown(wait=True)
+        save_state(state)
+
+    if trace:
+        print(f"\n===== Stage measurements (appended to {TRACE_PATH}) =====")
+        print(summary_table(trace))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_pipeline(pipeline_stages()))
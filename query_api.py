@@ -0,0 +1,305 @@
+import datetime
+import json
+
+import pandas as pd
+
+from partitions import per_partition, window_source
+
+# Parameterized versions of the analytics queries of query_sql.py.
+#
+# Every statement is one fixed SQL text; the window, statuses, brands, top-N and reference day are
+# bound parameters. A new question is a new set of parameters, so sqlite3 finds the compiled
+# statement in the connection's statement cache instead of parsing and planning new SQL, and the
+# query cache and the service's coalescing see the same text. Statuses and brands are bound as
+# one JSON array each and expanded with json_each(), so lists of any length share the statement.
+#
+# Windows end on a reference day, `as_of`, and reach `months` months back from it. By default the
+# reference day is the latest scan day (latest signup day for the user windows). Those anchors are
+# computed once per load by load_to_sql.py, in the same transaction as the data, and stored in
+# query_anchors, so queries read two keyed rows instead of re-running MAX() over the tables.
+# With the default parameters the statements answer Q1-Q6 (see QUESTIONS).
+#
+# With the monthly layout (see partitions.py), statement_sql() fills in the sources of the
+# statements that read receipts: a dateScanned window ({receipts}) reads just the partitions it
+# touches, and receipts are joined to their items partition by partition ({user_receipt_items}).
+# Their text then varies with the stored partitions and the months of the window, not with every window.
+
+ANCHORS_TABLE = """
+CREATE TABLE IF NOT EXISTS query_anchors (
+    name TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;"""
+
+ANCHORS = {
+    "latest_scan_day": "SELECT date(MAX(dateScanned)) FROM receipts",
+    "latest_signup_day": "SELECT date(MAX(createdDateMs) / 1000, 'unixepoch') FROM users",
+}
+
+# Reference day of the windows: `as_of` if given, else the stored anchor
+REFERENCE_DAY = "COALESCE(:as_of, (SELECT value FROM query_anchors WHERE name = '{anchor}'))"
+
+SCAN_REFERENCE_DAY = REFERENCE_DAY.format(anchor="latest_scan_day")
+
+# First and last day of a scan window
+SCAN_WINDOW_DAYS = f"SELECT date(day, :window), day FROM (SELECT {SCAN_REFERENCE_DAY} AS day)"
+
+# Start and end (epoch ms) of a signup window, as the CTE w
+SIGNUP_WINDOW = f"""SELECT CAST(strftime('%s', date(day, :window)) AS INTEGER) * 1000 AS from_ms,
+                   CAST(strftime('%s', date(day, '+1 day')) AS INTEGER) * 1000 AS until_ms
+            FROM (SELECT {REFERENCE_DAY.format(anchor="latest_signup_day")} AS day)"""
+
+STATUS_FILTER = "IN (SELECT value FROM json_each(:statuses))"
+BRAND_FILTER = "(:brands IS NULL OR b.name IN (SELECT value FROM json_each(:brands)))"
+
+# Items of the receipts (in the statuses) of the users who signed up in the window w, per
+# partition pair: receipts and their items are joined within their month (see partitions.py)
+USER_RECEIPT_ITEMS = f"""
+            SELECT ri.brandCode, r._id AS receiptId, r.totalSpent
+            FROM w
+            CROSS JOIN users AS u
+            CROSS JOIN {{receipts}} AS r ON r.userId = u._id
+            JOIN {{receiptItems}} AS ri ON r._id = ri.receiptId
+            WHERE u.createdDateMs >= w.from_ms AND u.createdDateMs < w.until_ms
+              AND r.rewardsReceiptStatus {STATUS_FILTER}"""
+
+# name -> (SQL, parameters it takes with their defaults)
+STATEMENTS = {
+    # Q1: brands by items scanned in the window, from the daily rollup
+    "top_brands_by_scans": (f"""
+        WITH w AS (
+            SELECT date(day, :window) AS first_day, day AS last_day
+            FROM (SELECT {SCAN_REFERENCE_DAY} AS day)
+        )
+        SELECT
+            b.name AS brand_name,
+            SUM(br.scans) AS scan_count
+        FROM w
+        CROSS JOIN brand_daily_rollup AS br
+        JOIN brands AS b ON br.brandCode = b.brandCode
+        WHERE br.status {STATUS_FILTER}
+          AND br.scanDay BETWEEN w.first_day AND w.last_day
+          AND {BRAND_FILTER}
+        GROUP BY b.name
+        ORDER BY scan_count DESC
+        LIMIT :limit
+    """, {"months": 1, "statuses": ["FINISHED"], "brands": None, "limit": 5, "as_of": None}),
+
+    # Q2: top brands of the window and of the window of the same length before it
+    "brand_scans_by_period": (f"""
+        WITH w AS (
+            SELECT date(day, :window) AS recent_from, date(day, :double_window) AS previous_from, day AS last_day
+            FROM (SELECT {SCAN_REFERENCE_DAY} AS day)
+        ),
+        periods AS (
+            SELECT
+                b.name AS brand_name,
+                SUM(br.scans) AS scan_count,
+                CASE WHEN br.scanDay >= w.recent_from THEN 'Recent Period' ELSE 'Previous Period' END AS period
+            FROM w
+            CROSS JOIN brand_daily_rollup AS br
+            JOIN brands AS b ON br.brandCode = b.brandCode
+            WHERE br.status {STATUS_FILTER}
+              AND br.scanDay BETWEEN w.previous_from AND w.last_day
+              AND {BRAND_FILTER}
+            GROUP BY b.name, period
+        )
+        SELECT *
+        FROM (
+            SELECT *,
+                RANK() OVER (PARTITION BY period ORDER BY scan_count DESC) AS rank
+            FROM periods
+        ) AS t
+        WHERE rank <= :limit
+        ORDER BY period DESC, rank ASC
+    """, {"months": 1, "statuses": ["FINISHED"], "brands": None, "limit": 5, "as_of": None}),
+
+    # Q3: average spend per status, highest first. A zero row per status lists the statuses without
+    # receipts; unlike a LEFT JOIN, the status filter reaches every partition of the receipts view.
+    "spend_by_status": (f"""
+        SELECT
+            status AS status_type,
+            COALESCE(AVG(totalSpent), 0) AS avg_spent
+        FROM (
+            SELECT s.value AS status, NULL AS totalSpent FROM json_each(:statuses) AS s
+            UNION ALL
+            SELECT r.rewardsReceiptStatus, r.totalSpent FROM receipts AS r WHERE r.rewardsReceiptStatus {STATUS_FILTER}
+        )
+        GROUP BY status
+        ORDER BY avg_spent DESC
+    """, {"statuses": ["FINISHED", "REJECTED"]}),
+
+    # Q4: items purchased per status, most first
+    "items_by_status": (f"""
+        SELECT
+            status AS status_type,
+            SUM(purchasedItemCount) AS total_items
+        FROM (
+            SELECT s.value AS status, 0 AS purchasedItemCount FROM json_each(:statuses) AS s
+            UNION ALL
+            SELECT r.rewardsReceiptStatus, r.purchasedItemCount FROM receipts AS r WHERE r.rewardsReceiptStatus {STATUS_FILTER}
+        )
+        GROUP BY status
+        ORDER BY total_items DESC
+    """, {"statuses": ["FINISHED", "REJECTED"]}),
+
+    # Q3 and Q4 over the receipts scanned in the window, from its month partitions only
+    "status_summary_by_scan_window": (f"""
+        SELECT
+            status AS status_type,
+            SUM(receipt) AS receipts,
+            COALESCE(AVG(totalSpent), 0) AS avg_spent,
+            SUM(purchasedItemCount) AS total_items
+        FROM (
+            -- a zero row per status, so statuses without receipts are listed too
+            SELECT s.value AS status, 0 AS receipt, NULL AS totalSpent, 0 AS purchasedItemCount
+            FROM json_each(:statuses) AS s
+            UNION ALL
+            SELECT r.rewardsReceiptStatus, 1, r.totalSpent, COALESCE(r.purchasedItemCount, 0)
+            FROM {{receipts}} AS r
+            WHERE r.rewardsReceiptStatus {STATUS_FILTER}
+              AND r.dateScanned >= date({SCAN_REFERENCE_DAY}, :window)
+              AND r.dateScanned < date({SCAN_REFERENCE_DAY}, '+1 day')
+        )
+        GROUP BY status
+        ORDER BY avg_spent DESC
+    """, {"months": 1, "statuses": ["FINISHED", "REJECTED"], "as_of": None}),
+
+    # Q5: brands by receipt spend of the users who signed up in the window
+    "top_brands_by_user_spend": (f"""
+        WITH w AS (
+            {SIGNUP_WINDOW}
+        ),
+        user_items AS (
+            {{user_receipt_items}}
+        )
+        SELECT
+            b.name AS brand_name,
+            SUM(user_items.totalSpent) AS total_spent
+        FROM user_items
+        JOIN brands AS b ON user_items.brandCode = b.brandCode
+        WHERE {BRAND_FILTER}
+        GROUP BY b.name
+        ORDER BY total_spent DESC
+        LIMIT :limit
+    """, {"months": 6, "statuses": ["FINISHED"], "brands": None, "limit": 5, "as_of": None}),
+
+    # Q6: brands by receipt count of the users who signed up in the window
+    "top_brands_by_user_transactions": (f"""
+        WITH w AS (
+            {SIGNUP_WINDOW}
+        ),
+        user_items AS (
+            {{user_receipt_items}}
+        )
+        SELECT
+            b.name AS brand_name,
+            COUNT(user_items.receiptId) AS transaction_count
+        FROM user_items
+        JOIN brands AS b ON user_items.brandCode = b.brandCode
+        WHERE {BRAND_FILTER}
+        GROUP BY b.name
+        ORDER BY transaction_count DESC
+        LIMIT :limit
+    """, {"months": 6, "statuses": ["FINISHED"], "brands": None, "limit": 5, "as_of": None}),
+}
+
+# Statements whose text depends on the stored partitions (see statement_sql)
+PARTITIONED_STATEMENTS = {name for name, (sql, _) in STATEMENTS.items() if "{" in sql}
+
+# The questions of query_sql.py as statements with their default parameters
+QUESTIONS = {
+    "Q1": "top_brands_by_scans",
+    "Q2": "brand_scans_by_period",
+    "Q3": "spend_by_status",
+    "Q4": "items_by_status",
+    "Q5": "top_brands_by_user_spend",
+    "Q6": "top_brands_by_user_transactions",
+}
+
+
+def refresh_anchors(conn):
+    """
+    Recompute the stored anchors of the windows; call it in the transaction that loads the data.
+    """
+    conn.execute(ANCHORS_TABLE)
+    conn.executemany("INSERT OR REPLACE INTO query_anchors (name, value) VALUES (?, ?)",
+                     [(name, conn.execute(sql).fetchone()[0]) for name, sql in ANCHORS.items()])
+
+
+def _string_list(name, value):
+    if isinstance(value, str):
+        value = [item for item in value.split(",") if item]
+    if not isinstance(value, (list, tuple)) or not value or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{name} must be a non-empty list of strings")
+    return list(value)
+
+
+def _positive_int(name, value):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return number
+
+
+def bind_parameters(name, **params):
+    """
+    Check the parameters of statement `name` against its defaults and return the dict to bind.
+    Lists may also be given as comma-separated strings (as in a URL query string).
+    """
+    if name not in STATEMENTS:
+        raise ValueError(f"Unknown statement {name!r}, expected one of {', '.join(STATEMENTS)}")
+    defaults = STATEMENTS[name][1]
+    unknown = set(params) - set(defaults)
+    if unknown:
+        raise ValueError(f"{name} does not take {', '.join(sorted(unknown))}; it takes {', '.join(defaults)}")
+    values = {**defaults, **{key: value for key, value in params.items() if value is not None}}
+    bound = {}
+    if "months" in values:
+        months = _positive_int("months", values["months"])
+        bound["window"] = f"-{months} month"
+        bound["double_window"] = f"-{2 * months} month"
+    if "statuses" in values:
+        bound["statuses"] = json.dumps(_string_list("statuses", values["statuses"]))
+    if "brands" in values:
+        bound["brands"] = None if values["brands"] is None else json.dumps(_string_list("brands", values["brands"]))
+    if "limit" in values:
+        bound["limit"] = _positive_int("limit", values["limit"])
+    if "as_of" in values:
+        if values["as_of"] is not None:
+            bound["as_of"] = datetime.date.fromisoformat(str(values["as_of"])).isoformat()
+        else:
+            bound["as_of"] = None
+    return bound
+
+
+def statement_sql(conn, name, bound):
+    """
+    The SQL text of statement `name` for the parameters `bound` (from bind_parameters). In
+    PARTITIONED_STATEMENTS, {receipts} reads only the partitions of the scan window, and
+    {user_receipt_items} joins the receipts and items of every partition pair separately.
+    """
+    sql = STATEMENTS[name][0]
+    if name not in PARTITIONED_STATEMENTS:
+        return sql
+    sources = {}
+    if "{receipts}" in sql:
+        first_day, last_day = conn.execute(SCAN_WINDOW_DAYS, bound).fetchone()
+        sources["receipts"] = window_source(conn, "receipts", first_day, last_day) if first_day else "receipts"
+    if "{user_receipt_items}" in sql:
+        sources["user_receipt_items"] = per_partition(conn, USER_RECEIPT_ITEMS)
+    return sql.format(**sources)
+
+
+def run_statement(conn, name, cache=None, **params):
+    """
+    Run statement `name` with `params` (see STATEMENTS for the defaults); returns a DataFrame.
+    With a QueryCache, results are reused until the data they were computed from changes.
+    """
+    bound = bind_parameters(name, **params)
+    sql = statement_sql(conn, name, bound)
+    if cache is not None:
+        return cache.read_sql(sql, conn, bound)
+    return pd.read_sql(sql, conn, params=bound)
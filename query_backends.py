@@ -0,0 +1,94 @@
+import sqlite3
+
+import pandas as pd
+
+from columnar import scalar_columns, table_path
+from config import DB_PATH, QUERY_CACHE, WORKERS
+from query_cache import QueryCache
+from sql_loader import TABLE_SOURCES
+
+# Engines that query_sql.py can run the analytics queries on (FETCH_QUERY_BACKEND).
+#
+# "sqlite", the default, runs query_sql.queries against fetch_data.db, through the query cache.
+# "duckdb" runs query_sql.duckdb_queries in an in-process DuckDB, a vectorized, multi-threaded
+# columnar engine, directly on the Parquet stage outputs: each table of the database is a view
+# over the scalar columns of its stage output, so nothing is loaded or copied, and only the
+# columns a query reads are decoded. DuckDB is optional (pip install duckdb) and only imported
+# when the backend is opened.
+#
+# The stage outputs hold every row only after a full run; an incremental run leaves the changed
+# rows there and merges them into the database, so after one the database is the only complete copy.
+
+BACKENDS = ["sqlite", "duckdb"]
+
+# SQLite's date(day, '-N month'): the same day of the month N months earlier, where a day past the
+# end of that month runs over into the next one (2021-03-31 minus 1 month is 2021-03-03)
+DUCKDB_MACROS = """
+CREATE MACRO months_before(day_value, months) AS
+    CAST(date_trunc('month', day_value) - to_months(months) AS DATE) + CAST(day(day_value) - 1 AS INTEGER);
+"""
+
+
+class SqliteBackend:
+    """
+    The analytics queries on fetch_data.db, with results cached per data version if `cache`.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path=DB_PATH, cache=QUERY_CACHE):
+        self.conn = sqlite3.connect(db_path)
+        self.cache = QueryCache() if cache else None
+
+    def read_sql(self, sql):
+        if self.cache:
+            return self.cache.read_sql(sql, self.conn)
+        return pd.read_sql(sql, self.conn)
+
+    def close(self):
+        if self.cache:
+            print(f"\nQuery cache: {self.cache.hits} hits, {self.cache.misses} misses")
+            self.cache.close()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class DuckDBBackend(SqliteBackend):
+    """
+    The analytics queries on the Parquet stage outputs, in an in-memory DuckDB database.
+    """
+
+    name = "duckdb"
+
+    def __init__(self, tables=TABLE_SOURCES, threads=WORKERS):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise RuntimeError("The duckdb query backend needs the duckdb package (pip install duckdb)") from e
+        self.conn = duckdb.connect(config={"threads": max(1, threads)})
+        self.cache = None
+        for table, name in tables.items():
+            columns = ", ".join(f'"{col}"' for col in scalar_columns(name))
+            path = table_path(name).replace("'", "''")
+            self.conn.execute(f"CREATE VIEW {table} AS SELECT {columns} FROM read_parquet('{path}')")
+        self.conn.execute(DUCKDB_MACROS)
+
+    def read_sql(self, sql):
+        return self.conn.execute(sql).df()
+
+
+def open_backend(name):
+    """
+    Open the query backend `name`, one of BACKENDS.
+    """
+    if name == "sqlite":
+        return SqliteBackend()
+    if name == "duckdb":
+        return DuckDBBackend()
+    raise ValueError(f"Unknown query backend {name!r}, expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import sqlite3
+import time
+
+import pandas as pd
+
+from config import QUERY_CACHE_PATH, QUERY_CACHE_BYTES
+
+# Persistent result cache for the analytics queries.
+#
+# A result is stored under the hash of the normalized SQL text, its parameters, the database
+# file and the data version of every table the query reads. load_to_sql.py gives each table it
+# changes a new random version (data_versions table in fetch_data.db), so a reload never hits
+# a result computed from older data; stale entries are simply never read again and age out.
+# The tables a query reads are taken from SQLite's authorizer while the statement is compiled,
+# so views, CTEs and subqueries are resolved by SQLite itself. Queries that read a table
+# without a data version are not cached.
+#
+# Entries live in a small SQLite file (data/state/query_cache.db) and are evicted least
+# recently used first once their total size exceeds FETCH_QUERY_CACHE_MB.
+
+DATA_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS data_versions (
+    table_name TEXT PRIMARY KEY,
+    version TEXT NOT NULL
+);"""
+
+CACHE_TABLE = """
+CREATE TABLE IF NOT EXISTS query_results (
+    key TEXT PRIMARY KEY,
+    result BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);"""
+
+
+def bump_data_versions(conn, tables):
+    """
+    Give `tables` a new data version; call it in the transaction that changes them.
+    """
+    conn.execute(DATA_VERSIONS_TABLE)
+    conn.executemany("""
+        INSERT INTO data_versions (table_name, version) VALUES (?, ?)
+        ON CONFLICT(table_name) DO UPDATE SET version = excluded.version
+    """, [(table, os.urandom(8).hex()) for table in tables])
+
+
+def normalize_sql(sql):
+    """
+    Collapse whitespace and drop the trailing semicolon, leaving quoted literals untouched.
+    """
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(";").strip())
+    return "".join(part if part.startswith("'") else re.sub(r"\s+", " ", part) for part in parts)
+
+
+def tables_read(conn, sql, params=()):
+    """
+    Return the tables and views `sql` reads, as reported by SQLite while compiling it.
+    """
+    names = set()
+
+    def authorizer(action, arg1, arg2, db_name, source):
+        if action == sqlite3.SQLITE_READ and arg1:
+            names.add(arg1)
+        return sqlite3.SQLITE_OK
+
+    conn.set_authorizer(authorizer)
+    try:
+        conn.execute(f"EXPLAIN {sql}", params).fetchall()
+    finally:
+        conn.set_authorizer(None)
+    return names
+
+
+class QueryCache:
+    """
+    Size-bounded LRU cache of query results (DataFrames), persisted in an SQLite file.
+    """
+
+    def __init__(self, path=QUERY_CACHE_PATH, max_bytes=QUERY_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._store = sqlite3.connect(path, timeout=30)
+        self._store.execute("PRAGMA journal_mode = WAL")
+        self._store.execute(CACHE_TABLE)
+        self._tables = {}
+
+    def key(self, conn, sql, params=()):
+        """
+        Return the cache key of `sql` on `conn`, or None if the query reads unversioned tables.
+        """
+        sql = normalize_sql(sql)
+        if sql not in self._tables:
+            self._tables[sql] = tables_read(conn, sql, params)
+        versions = self._versions(conn)
+        views = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'view'")}
+        tables = sorted(self._tables[sql] - views)
+        if any(table not in versions for table in tables):
+            return None
+        database = conn.execute("PRAGMA database_list").fetchone()[2]
+        parts = [sql, params if isinstance(params, dict) else list(params), database, [(table, versions[table]) for table in tables]]
+        return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+    def read_sql(self, sql, conn, params=()):
+        """
+        pd.read_sql with caching: return the stored result if the data it was computed from is unchanged.
+        """
+        key = self.key(conn, sql, params)
+        if key is not None:
+            row = self._store.execute("SELECT result FROM query_results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                with self._store:
+                    self._store.execute("UPDATE query_results SET last_used = ? WHERE key = ?", (time.time(), key))
+                return pickle.loads(row[0])
+        self.misses += 1
+        df = pd.read_sql(sql, conn, params=params or None)
+        if key is not None:
+            self._put(key, pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+        return df
+
+    def _versions(self, conn):
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'data_versions'").fetchone():
+            return {}
+        return dict(conn.execute("SELECT table_name, version FROM data_versions"))
+
+    def _put(self, key, blob):
+        if len(blob) > self.max_bytes:
+            return
+        with self._store:
+            self._store.execute("INSERT OR REPLACE INTO query_results VALUES (?, ?, ?, ?)",
+                                (key, blob, len(blob), time.time()))
+            # Evict the least recently used entries until the cache fits again
+            total = self._store.execute("SELECT TOTAL(bytes) FROM query_results").fetchone()[0]
+            for old_key, size in self._store.execute(
+                    "SELECT key, bytes FROM query_results ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._store.execute("DELETE FROM query_results WHERE key = ?", (old_key,))
+                total -= size
+
+    def close(self):
+        self._store.close()
@@ -1,18 +1,46 @@
-import sqlite3
-import pandas as pd
-import os
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "fetch_data.db")
+import statistics
+import time
+
+from config import QUERY_BACKEND, INCREMENTAL
+from partitions import per_partition
+from query_backends import SqliteBackend, DuckDBBackend, open_backend
+
+# Repetitions of every query in the timing mode (FETCH_QUERY_BACKEND=compare)
+COMPARE_REPEATS = 3
+
+# Sources of the questions that join receipts and receiptItems or take MAX() over receipts. With
+# month partitions (see partitions.py), question_sql() expands each one into a UNION ALL over the
+# partition pairs, as SQLite can neither push a join into the receipts and receiptItems views nor
+# answer MAX() through them from an index; without partitions they read the tables.
+LATEST_SCAN = "SELECT MAX(dateScanned) AS dateScanned FROM {receipts}"
+# Q5/Q6 per brand, over the FINISHED receipts of the users who signed up in the six months before
+# the latest signup day. A receipt and its items share their partition, so per-partition totals add up.
+USER_BRAND_TOTALS = """
+            SELECT
+                b.name AS brand_name,
+                SUM(r.totalSpent) AS total_spent,
+                COUNT(r._id) AS transaction_count
+            FROM users AS u
+            CROSS JOIN {receipts} AS r ON r.userId = u._id
+            JOIN {receiptItems} AS ri ON r._id = ri.receiptId
+            JOIN brands AS b ON ri.brandCode = b.brandCode
+            WHERE r.rewardsReceiptStatus = 'FINISHED'
+              AND u.createdDateMs >= strftime('%s', date((SELECT MAX(createdDateMs) FROM users) / 1000, 'unixepoch', '-6 month')) * 1000
+            GROUP BY b.name"""
+QUESTION_SOURCES = {"latest_scan": LATEST_SCAN, "user_brand_totals": USER_BRAND_TOTALS}
+
 queries = {
+    # Q1 and Q2 read the brand rollups that load_to_sql.py maintains (see rollups.py) instead of
+    # joining receiptItems x receipts. scanDay >= date(...) selects the same receipts as
+    # dateScanned >= date(...), since dateScanned starts with its day.
     "Q1: Top 5 brands by receipts scanned in the most recent month": """
         SELECT 
             b.name AS brand_name,
-            COUNT(ri._id) AS scan_count
-        FROM receiptItems AS ri
-        JOIN receipts AS r ON ri.receiptId = r._id
-        JOIN brands AS b ON ri.brandCode = b.brandCode
-        WHERE r.rewardsReceiptStatus = 'FINISHED'
-          AND r.dateScanned >= date((SELECT MAX(dateScanned) FROM receipts), '-1 month')
+            SUM(br.scans) AS scan_count
+        FROM brand_daily_rollup AS br
+        JOIN brands AS b ON br.brandCode = b.brandCode
+        WHERE br.status = 'FINISHED'
+          AND br.scanDay >= date((SELECT MAX(dateScanned) FROM ({latest_scan})), '-1 month')
         GROUP BY b.name
         ORDER BY scan_count DESC
         LIMIT 5;
@@ -22,17 +50,16 @@ queries = {
         WITH periods AS (
             SELECT 
                 b.name AS brand_name,
-                COUNT(ri._id) AS scan_count,
+                SUM(br.scans) AS scan_count,
                 CASE 
-                    WHEN r.dateScanned >= date((SELECT MAX(dateScanned) FROM receipts), '-1 month') 
+                    WHEN br.scanDay >= date((SELECT MAX(dateScanned) FROM ({latest_scan})), '-1 month') 
                     THEN 'Recent Month'
                     ELSE 'Previous Month'
                 END AS period
-            FROM receiptItems AS ri
-            JOIN receipts AS r ON ri.receiptId = r._id
-            JOIN brands AS b ON ri.brandCode = b.brandCode
-            WHERE r.rewardsReceiptStatus = 'FINISHED'
-            AND r.dateScanned >= date((SELECT MAX(dateScanned) FROM receipts), '-2 month')
+            FROM brand_daily_rollup AS br
+            JOIN brands AS b ON br.brandCode = b.brandCode
+            WHERE br.status = 'FINISHED'
+            AND br.scanDay >= date((SELECT MAX(dateScanned) FROM ({latest_scan})), '-2 month')
             GROUP BY b.name, period 
         )
         SELECT *
@@ -87,42 +114,221 @@ queries = {
                END AS total_items_comparison;
     """,
     
+    # Q5 and Q6 compare the integer createdDateMs against the epoch ms of the day six months before
+    # the latest signup day, a range predicate on ix_users_createdDateMs. It selects the same users
+    # as comparing strftime('%Y-%m-%d', createdDate) with that day. CROSS JOIN makes SQLite start
+    # from that range of users and look up their receipts, instead of visiting every FINISHED receipt.
     "Q5: Brand with the highest total spend among users created within the past 6 months": """
         SELECT 
-            b.name AS brand_name, 
+            brand_name, 
+            SUM(total_spent) AS total_spent
+        FROM ({user_brand_totals})
+        GROUP BY brand_name
+        ORDER BY total_spent DESC
+        LIMIT 5;
+    """,
+    
+    "Q6: Brand with the highest transaction count among users created within the past 6 months": """
+        SELECT 
+            brand_name, 
+            SUM(transaction_count) AS transaction_count
+        FROM ({user_brand_totals})
+        GROUP BY brand_name
+        ORDER BY transaction_count DESC
+        LIMIT 5;
+    """
+}
+
+# The same questions for the duckdb backend (see query_backends.py), on the stage outputs.
+# Timestamps are typed there and there are no epoch-ms columns or rollups: Q1 and Q2 aggregate
+# receiptItems x receipts directly, which a columnar engine scans quickly, and the date windows
+# use months_before(), SQLite's month arithmetic. Q3 and Q4 mix numbers and text in one column,
+# which SQLite allows, so the numbers are cast to text here.
+duckdb_queries = {
+    "Q1: Top 5 brands by receipts scanned in the most recent month": """
+        SELECT
+            b.name AS brand_name,
+            COUNT(*) AS scan_count
+        FROM receiptItems AS ri
+        JOIN receipts AS r ON ri.receiptId = r._id
+        JOIN brands AS b ON ri.brandCode = b.brandCode
+        WHERE r.rewardsReceiptStatus = 'FINISHED'
+          AND CAST(r.dateScanned AS DATE) >= months_before(CAST((SELECT MAX(dateScanned) FROM receipts) AS DATE), 1)
+        GROUP BY b.name
+        ORDER BY scan_count DESC
+        LIMIT 5;
+    """,
+
+    "Q2: Comparison of top 5 brands by receipts scanned (recent month vs previous month)": """
+        WITH latest AS (
+            SELECT CAST(MAX(dateScanned) AS DATE) AS day FROM receipts
+        ),
+        periods AS (
+            SELECT
+                b.name AS brand_name,
+                COUNT(*) AS scan_count,
+                CASE
+                    WHEN CAST(r.dateScanned AS DATE) >= months_before(latest.day, 1)
+                    THEN 'Recent Month'
+                    ELSE 'Previous Month'
+                END AS period
+            FROM receiptItems AS ri
+            JOIN receipts AS r ON ri.receiptId = r._id
+            JOIN brands AS b ON ri.brandCode = b.brandCode
+            CROSS JOIN latest
+            WHERE r.rewardsReceiptStatus = 'FINISHED'
+              AND CAST(r.dateScanned AS DATE) >= months_before(latest.day, 2)
+            GROUP BY b.name, period
+        )
+        SELECT *
+        FROM (
+            SELECT *,
+                RANK() OVER (PARTITION BY period ORDER BY scan_count DESC) AS rank
+            FROM periods
+        ) AS t
+        WHERE rank <= 5
+        ORDER BY period DESC, rank ASC;
+    """,
+
+    "Q3: Average spend comparison for 'FINISHED' and 'REJECTED' receipts": """
+        WITH averages AS (
+            SELECT COALESCE(AVG(totalSpent) FILTER (WHERE rewardsReceiptStatus = 'FINISHED'), 0) AS finished,
+                   COALESCE(AVG(totalSpent) FILTER (WHERE rewardsReceiptStatus = 'REJECTED'), 0) AS rejected
+            FROM receipts
+        )
+        SELECT 'FINISHED' AS status_type, CAST(finished AS VARCHAR) AS avg_spent FROM averages
+        UNION ALL
+        SELECT 'REJECTED', CAST(rejected AS VARCHAR) FROM averages
+        UNION ALL
+        SELECT 'RESULT',
+               CASE WHEN finished > rejected
+                    THEN 'FINISHED has higher average spend'
+                    ELSE 'REJECTED has higher average spend'
+               END
+        FROM averages;
+    """,
+
+    "Q4: Total number of items purchased comparison for 'FINISHED' and 'REJECTED' receipts": """
+        WITH totals AS (
+            SELECT COALESCE(SUM(purchasedItemCount) FILTER (WHERE rewardsReceiptStatus = 'FINISHED'), 0) AS finished,
+                   COALESCE(SUM(purchasedItemCount) FILTER (WHERE rewardsReceiptStatus = 'REJECTED'), 0) AS rejected
+            FROM receipts
+        )
+        SELECT 'FINISHED' AS status_type, CAST(finished AS VARCHAR) AS total_items FROM totals
+        UNION ALL
+        SELECT 'REJECTED', CAST(rejected AS VARCHAR) FROM totals
+        UNION ALL
+        SELECT 'RESULT',
+               CASE WHEN finished > rejected
+                    THEN 'FINISHED has more items purchased'
+                    ELSE 'REJECTED has more items purchased'
+               END
+        FROM totals;
+    """,
+
+    "Q5: Brand with the highest total spend among users created within the past 6 months": """
+        SELECT
+            b.name AS brand_name,
             SUM(r.totalSpent) AS total_spent
-        FROM receipts AS r
-        JOIN users AS u ON r.userId = u._id
+        FROM users AS u
+        JOIN receipts AS r ON r.userId = u._id
         JOIN receiptItems AS ri ON r._id = ri.receiptId
         JOIN brands AS b ON ri.brandCode = b.brandCode
         WHERE r.rewardsReceiptStatus = 'FINISHED'
-          AND strftime('%Y-%m-%d', u.createdDate) >= date((SELECT MAX(strftime('%Y-%m-%d', createdDate)) FROM users), '-6 month')
+          AND u.createdDate >= months_before(CAST((SELECT MAX(createdDate) FROM users) AS DATE), 6)
         GROUP BY b.name
         ORDER BY total_spent DESC
         LIMIT 5;
     """,
-    
+
     "Q6: Brand with the highest transaction count among users created within the past 6 months": """
-        SELECT 
-            b.name AS brand_name, 
+        SELECT
+            b.name AS brand_name,
             COUNT(r._id) AS transaction_count
-        FROM receipts AS r
-        JOIN users AS u ON r.userId = u._id
+        FROM users AS u
+        JOIN receipts AS r ON r.userId = u._id
         JOIN receiptItems AS ri ON r._id = ri.receiptId
         JOIN brands AS b ON ri.brandCode = b.brandCode
         WHERE r.rewardsReceiptStatus = 'FINISHED'
-          AND strftime('%Y-%m-%d', u.createdDate) >= date((SELECT MAX(strftime('%Y-%m-%d', createdDate)) FROM users), '-6 month')
+          AND u.createdDate >= months_before(CAST((SELECT MAX(createdDate) FROM users) AS DATE), 6)
         GROUP BY b.name
         ORDER BY transaction_count DESC
         LIMIT 5;
     """
 }
 
-with sqlite3.connect(DB_PATH) as conn:
-    for question, query in queries.items():
-        print(f"\n{question}:\n")
-        try:
-            df = pd.read_sql(query, conn)
-            print(df.to_string(index=False))
-        except Exception as e:
-            print(f"Error executing query: {e}")
+BACKEND_QUERIES = {"sqlite": queries, "duckdb": duckdb_queries}
+
+
+def question_sql(conn, sql):
+    """
+    The SQL text of a question of `queries` for the layout of the database of `conn` (see QUESTION_SOURCES).
+    """
+    return sql.format(**{name: per_partition(conn, source) for name, source in QUESTION_SOURCES.items()})
+
+
+def backend_sql(backend, sql):
+    # The duckdb questions read the stage outputs, which have no partitions
+    return question_sql(backend.conn, sql) if backend.name == "sqlite" else sql
+
+
+def result_rows(df):
+    """
+    Return the rows of a query result as a sorted list, numbers (or numeric text) rounded, so
+    results that only differ in the order of tied rows or in float rounding compare equal.
+    """
+    rows = []
+    for row in df.itertuples(index=False, name=None):
+        values = []
+        for value in row:
+            try:
+                values.append(f"{float(value):.6g}")
+            except (TypeError, ValueError):
+                values.append(str(value))
+        rows.append(tuple(values))
+    return sorted(rows)
+
+
+def run_queries(backend_name):
+    # Results are reused until load_to_sql.py changes one of the tables a query reads (sqlite only)
+    with open_backend(backend_name) as backend:
+        for question, query in BACKEND_QUERIES[backend_name].items():
+            print(f"\n{question}:\n")
+            try:
+                df = backend.read_sql(backend_sql(backend, query))
+                print(df.to_string(index=False))
+            except Exception as e:
+                print(f"Error executing query: {e}")
+
+
+def compare_backends(repeats=COMPARE_REPEATS):
+    """
+    Run every question on every backend `repeats` times, without the query cache, and print the
+    median times side by side with whether the results agree.
+    """
+    results = {}
+    with SqliteBackend(cache=False) as sqlite_backend, DuckDBBackend() as duckdb_backend:
+        for backend in (sqlite_backend, duckdb_backend):
+            for question, query in BACKEND_QUERIES[backend.name].items():
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    df = backend.read_sql(backend_sql(backend, query))
+                    timings.append(time.perf_counter() - start)
+                results[question, backend.name] = (statistics.median(timings), df)
+    print(f"{'question':<8} {'sqlite s':>10} {'duckdb s':>10} {'speedup':>8}  results")
+    for question in queries:
+        (sqlite_s, sqlite_df), (duckdb_s, duckdb_df) = results[question, "sqlite"], results[question, "duckdb"]
+        agree = "same" if result_rows(sqlite_df) == result_rows(duckdb_df) else "DIFFERENT"
+        print(f"{question.split(':')[0]:<8} {sqlite_s:>10.4f} {duckdb_s:>10.4f} {sqlite_s / duckdb_s:>7.1f}x  {agree}")
+
+
+if __name__ == "__main__":
+    if QUERY_BACKEND == "compare":
+        compare_backends()
+    elif QUERY_BACKEND == "duckdb" and INCREMENTAL:
+        # The stage outputs of an incremental run only hold the changed rows (see query_backends.py)
+        print("Incremental run: querying fetch_data.db with the sqlite backend instead of duckdb.")
+        run_queries("sqlite")
+    else:
+        run_queries(QUERY_BACKEND)
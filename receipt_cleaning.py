@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+
+from columnar import StageWriter, apply_dtypes, to_arrow, to_pandas, SCHEMAS
+from config import WORKERS, SPILL_PATH
+from data_quality import InlineChecks
+from dedup import LatestRows
+from extended_json import parse_oid, parse_date
+from ingest import iter_source_lines, parse_source_lines, source_ranges, read_source_range
+from instrumentation import step, count, measure_batches
+from watermarks import ChangeFilter
+
+# Receipt cleaning engine used by clean_receipts.py.
+#
+# Cleaning is a per-receipt transform, so the raw receipts are cut into chunks and every chunk
+# is parsed and cleaned on its own, in a pool of `workers` processes. With the gzip access index
+# (gzip_index.py) a chunk is a range of the compressed file between two index checkpoints, which
+# the worker decompresses itself, so decompression runs on every core too. Without it the main
+# process decompresses the source and hands out chunks of BATCH_SIZE lines. Workers write their
+# cleaned chunk to an Arrow IPC file in SPILL_PATH and send back the `_id`s and scan
+# dates, which the main process feeds to dedup.py in source order. The de-duplication hash-
+# partitions the keys by `_id` and reduces the partitions in the same number of processes when
+# they do not fit in memory. Finally the surviving rows of every chunk file are appended to the
+# stage output, in source order, without going through pandas again.
+#
+# Each chunk ends up as one Parquet row group of receipts_cleaned.parquet, the unit that the
+# loader and the item extraction hand out to their own workers.
+# Every receipt is parsed once; the cleaned chunks take about the size of the output, uncompressed,
+# in SPILL_PATH until the stage ends.
+
+# Receipt timestamp fields
+TIME_COLUMNS = ["createDate", "dateScanned", "finishedDate", "modifyDate", "pointsAwardedDate", "purchaseDate"]
+
+# Change filter of the incremental mode, created once per worker process by _init_worker
+_change_filter = None
+
+
+def _init_worker():
+    global _change_filter
+    _change_filter = ChangeFilter("receipts")
+
+
+def clean_receipts_batch(df_receipts):
+    """
+    Parse ids and timestamps of one batch of raw receipts.
+
+    Missing values stay nulls in the typed Parquet output (and are written as "NULL" in the CSV export).
+    """
+    # 1. Parse `_id`
+    df_receipts["_id"] = parse_oid(df_receipts["_id"])
+
+    # 2. Parse time fields
+    for col in TIME_COLUMNS:
+        if col in df_receipts.columns:
+            df_receipts[col] = parse_date(df_receipts[col])
+
+    # 3. Parse the numbers, store the status and bonus reason as categories
+    return apply_dtypes(df_receipts, "receipts_cleaned")
+
+
+def scan_versions(scanned):
+    """
+    Order receipts by `dateScanned` for de-duplication: later scans are newer, and a missing date
+    counts as the newest, as the "NULL" placeholder of the old CSV handoff sorted first.
+    """
+    versions = scanned.to_numpy(dtype="datetime64[ms]").view("int64")
+    return np.where(scanned.isna().to_numpy(), np.iinfo(np.int64).max, versions)
+
+
+def clean_chunk(lines, chunk_path):
+    """
+    Parse and clean one chunk of raw receipt lines (or a source range to read them from), keeping
+    only the changed receipts in incremental runs, and write it to `chunk_path`.
+    Returns (raw rows, `_id`s, scan versions, change watermark of the worker so far, unknown item keys).
+    """
+    if not isinstance(lines, list):
+        lines = read_source_range(lines)
+    df_receipts = clean_receipts_batch(_change_filter.filter(parse_source_lines("receipts", lines)))
+    unknown_keys = Counter()
+    with pa.OSFile(chunk_path, "wb") as sink, pa.ipc.new_file(sink, SCHEMAS["receipts_cleaned"]) as writer:
+        writer.write_table(to_arrow(df_receipts, "receipts_cleaned", unknown_keys))
+    return len(lines), df_receipts["_id"].to_numpy(dtype=object), scan_versions(df_receipts["dateScanned"]), \
+        _change_filter.high, unknown_keys
+
+
+def iter_cleaned_chunks(chunk_paths, workers=WORKERS):
+    """
+    Clean the raw receipts chunk by chunk, the n-th chunk into chunk_paths(n), across `workers` processes.
+
+    Yields (chunk path, clean_chunk() result) in source order. At most two chunks per worker are
+    in flight, so memory stays bounded no matter how many receipts there are.
+    """
+    ranges = source_ranges("receipts") if workers > 1 else None
+    chunks = enumerate(ranges if ranges else iter_source_lines("receipts"))
+    if workers <= 1:
+        _init_worker()
+        for n, lines in chunks:
+            yield chunk_paths(n), clean_chunk(lines, chunk_paths(n))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        pending = deque()
+        for n, lines in chunks:
+            pending.append((chunk_paths(n), pool.submit(clean_chunk, lines, chunk_paths(n))))
+            if len(pending) >= 2 * workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def read_chunk(path):
+    with pa.OSFile(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def clean_receipts(output="receipts_cleaned", workers=WORKERS, spill_path=SPILL_PATH):
+    """
+    Run the whole stage: clean, de-duplicate and write the receipts (see the module comment).
+
+    Per `_id` the receipt with the latest `dateScanned` is kept, the first one in the file on ties.
+    That also settles the old second rule (one receipt per `_id` and rewardsReceiptStatus within a
+    short time span), since no `_id` is left twice. The row-level data-quality rules run on the
+    surviving receipts if FETCH_INLINE_CHECKS is set, and the new change watermark is staged.
+    Item keys that the receipts schema does not declare are reported, as they are not kept.
+    Returns the StageWriter of the output.
+    """
+    change_filter = ChangeFilter("receipts")
+    inline_checks = InlineChecks("receipts")
+    unknown_keys = Counter()
+    os.makedirs(spill_path, exist_ok=True)
+    chunk_dir = tempfile.mkdtemp(prefix="receipts-", dir=spill_path)
+    try:
+        chunks = []
+        with LatestRows(workers=workers) as latest:
+            with step("clean chunks"):
+                cleaned = iter_cleaned_chunks(lambda n: os.path.join(chunk_dir, f"chunk-{n:06d}.arrow"), workers)
+                for path, (raw_rows, ids, versions, high, chunk_unknown_keys) in cleaned:
+                    count(rows_in=raw_rows)
+                    unknown_keys.update(chunk_unknown_keys)
+                    change_filter.observe(high)
+                    latest.add(ids, versions)
+                    chunks.append((path, len(ids)))
+            with step("dedup") as span:
+                keep = latest.mask()
+                span.count(latest.rows, int(keep.sum()))
+            if latest.spilled_bytes:
+                print(f"De-duplication spilled {latest.spilled_bytes / 2**20:.0f} MiB of keys to disk.")
+            if unknown_keys:
+                print("Dropped receipt item keys missing from the schema: "
+                      + ", ".join(f"{key} ({items} items)" for key, items in unknown_keys.most_common()))
+
+        offset = 0
+        with StageWriter(output) as writer:
+            for path, rows in measure_batches("read chunks", chunks, rows=lambda chunk: chunk[1]):
+                table = read_chunk(path).filter(pa.array(keep[offset:offset + rows]))
+                offset += rows
+                os.remove(path)
+                if inline_checks.rules:
+                    writer.write(inline_checks.apply(to_pandas(table, output)))
+                elif table.num_rows:
+                    writer.write_arrow(table)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    change_filter.stage()
+    inline_checks.report()
+    return writer
@@ -0,0 +1,186 @@
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from brand_index import BrandIndex, ResolutionStats
+from columnar import StageWriter, apply_dtypes, table_path
+from config import BATCH_SIZE, WORKERS, BRAND_INDEX_PATH
+from data_quality import InlineChecks
+from instrumentation import count, measure_batches
+
+# Receipt-item extraction engine.
+# Receipts are read from receipts_cleaned.parquet in record batches, where
+# rewardsReceiptItemList is still the nested list of item structs from the source JSON.
+# Each batch is exploded column-wise with Arrow compute (no per-item Python dicts),
+# batches are sharded across a process pool, and item batches are streamed to
+# receiptItems_cleaned.parquet in receipt order as soon as they are ready.
+
+RECEIPT_COLUMNS = ["_id", "rewardsReceiptItemList"]
+
+# Item ids are uuid5(RECEIPT_ITEM_NAMESPACE, "<receiptId>/<partnerItemId>"), or "<receiptId>/#<position>"
+# when the item has no partnerItemId or shares it with another item of the same receipt.
+# The same receipt content therefore always yields the same item ids, so reloads can diff and upsert.
+RECEIPT_ITEM_NAMESPACE = uuid.UUID("6f1d0c52-3b8e-5a43-9d3e-0c1f2a7b9e41")
+
+# Brand resolution index, memory-mapped once per worker process by _init_worker
+_brand_index = None
+
+
+def _init_worker(brand_index_path):
+    global _brand_index
+    _brand_index = BrandIndex(brand_index_path)
+
+
+def _field(items, name, type=pa.string()):
+    """
+    Return one field of the flattened item structs, or a null column if the struct has no such field.
+    """
+    if items.type.get_field_index(name) >= 0:
+        return pc.struct_field(items, name)
+    return pa.nulls(len(items), type)
+
+
+def _coalesce(items, names, default, type=pa.string()):
+    """
+    Column-wise version of "first field that is set on the item, else `default`".
+    """
+    columns = [_field(items, name, type) for name in names]
+    return pc.coalesce(*columns, pa.scalar(default, type))
+
+
+# Prices and quantities as the apps send them: "12.49", "2", "-1.5", "1e3"; anything else is treated as missing
+NUMBER_PATTERN = r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$"
+
+
+def _to_float(column):
+    if pa.types.is_string(column.type):
+        column = pc.utf8_trim_whitespace(column)
+        column = pc.if_else(pc.match_substring_regex(column, NUMBER_PATTERN), column, pa.scalar(None, pa.string()))
+    return pc.cast(column, pa.float64())
+
+
+def _to_int(column):
+    """
+    _to_float, truncated to an integer; values beyond the int64 range are treated as missing too.
+    """
+    values = pc.trunc(_to_float(column))
+    return pc.cast(pc.if_else(pc.less(pc.abs(values), 2.0 ** 63), values, pa.scalar(None, pa.float64())), pa.int64())
+
+
+def receipt_item_ids(receipt_ids, partner_item_ids, positions):
+    """
+    Build the deterministic item ids of one batch (see RECEIPT_ITEM_NAMESPACE).
+    """
+    ambiguous = partner_item_ids.isna() | pd.DataFrame({"r": receipt_ids, "p": partner_item_ids}).duplicated(keep=False)
+    item_keys = partner_item_ids.where(~ambiguous, "#" + positions.astype(str))
+    return [str(uuid.uuid5(RECEIPT_ITEM_NAMESPACE, f"{receipt_id}/{item_key}"))
+            for receipt_id, item_key in zip(receipt_ids, item_keys)]
+
+
+def explode_receipt_items(record_batch):
+    """
+    Turn one batch of receipts into a DataFrame with one row per receipt item.
+    Returns the DataFrame and the ResolutionStats of its brand lookups.
+
+    For each item:
+      - _id is derived from the receipt _id and the item's partnerItemId or position (see receipt_item_ids).
+      - barcode is the item barcode, else its userFlaggedBarcode, else "UNKNOWN".
+      - brandName is resolved in the brand index by barcode, userFlaggedBarcode, then brandCode;
+        if still not found, the barcode is used.
+      - description, price and needsFetchReview fall back to the user-flagged value, then to a default.
+      - quantity is quantityPurchased as a number (text or not), else 1.
+    """
+    item_lists = record_batch.column("rewardsReceiptItemList")
+    items = pc.list_flatten(item_lists)
+    parent_indices = pc.list_parent_indices(item_lists)
+    receipt_ids = pc.take(record_batch.column("_id"), parent_indices).to_pandas()
+    # Position of each item inside its receipt's item list
+    parent_indices = parent_indices.to_pandas()
+    positions = parent_indices.groupby(parent_indices).cumcount()
+
+    brand_code = _field(items, "brandCode").to_pandas()
+    barcode = _coalesce(items, ["barcode", "userFlaggedBarcode"], "UNKNOWN").to_pandas()
+
+    # Resolve the brand name by barcode, userFlaggedBarcode, then brandCode.
+    brand_name, stats = _brand_index.resolve({field: _field(items, field) for field in
+                                              ["barcode", "userFlaggedBarcode", "brandCode"]})
+    # If not found, use the barcode as the brand identifier.
+    brand_name = brand_name.fillna(barcode)
+
+    price = pc.coalesce(_to_float(_field(items, "finalPrice")), _to_float(_field(items, "userFlaggedPrice")),
+                        pa.scalar(0.0))
+
+    df_items = pd.DataFrame({
+        "_id": receipt_item_ids(receipt_ids, _field(items, "partnerItemId").to_pandas(), positions),
+        "receiptId": receipt_ids,
+        "brandCode": brand_code.where(brand_code.notna() & (brand_code != ""), "UNKNOWN"),
+        "barcode": barcode,
+        "brandName": brand_name,
+        "description": _coalesce(items, ["description", "userFlaggedDescription"], "UNKNOWN").to_pandas(),
+        "quantity": pc.coalesce(_to_int(_field(items, "quantityPurchased")), pa.scalar(1)).to_pandas(),
+        "price": price.to_pandas(),
+        "isBonus": _coalesce(items, ["isBonus"], False, pa.bool_()).to_pandas(),
+        "needsFetchReview": _coalesce(items, ["needsFetchReview"], False, pa.bool_()).to_pandas(),
+    })
+    return apply_dtypes(df_items, "receiptItems_cleaned"), stats
+
+
+def iter_receipt_batches(name="receipts_cleaned", batch_size=BATCH_SIZE):
+    """
+    Stream the receipt ids and item lists of a receipts stage output as Arrow record batches.
+    The receipts count as the stage's rows in.
+    """
+    parquet_file = pq.ParquetFile(table_path(name), memory_map=True)
+    for record_batch in measure_batches(f"read {name}", parquet_file.iter_batches(batch_size=batch_size,
+                                                                                  columns=RECEIPT_COLUMNS)):
+        count(rows_in=len(record_batch))
+        yield record_batch
+
+
+def iter_receipt_items(record_batches, brand_index_path=BRAND_INDEX_PATH, workers=WORKERS):
+    """
+    Explode receipt batches into (item DataFrame, ResolutionStats) pairs, sharding the batches
+    across `workers` processes.
+
+    Results are yielded in input order. At most two batches per worker are in flight,
+    so memory stays bounded no matter how many receipts there are.
+    """
+    if workers <= 1:
+        _init_worker(brand_index_path)
+        for record_batch in record_batches:
+            yield explode_receipt_items(record_batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(brand_index_path,)) as pool:
+        pending = deque()
+        for record_batch in record_batches:
+            pending.append(pool.submit(explode_receipt_items, record_batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def extract_receipt_items(brand_index_path=BRAND_INDEX_PATH, output="receiptItems_cleaned", workers=WORKERS):
+    """
+    Run the whole extraction: stream receipts, explode items in parallel, and append them to `output`.
+    The row-level data-quality rules of receiptItems run on every batch if FETCH_INLINE_CHECKS is set.
+    Returns the StageWriter of the output (rows written, memory report) and the ResolutionStats of the brand lookups.
+    """
+    inline_checks = InlineChecks("receiptItems")
+    stats = ResolutionStats()
+    with StageWriter(output) as writer:
+        results = iter_receipt_items(iter_receipt_batches(), brand_index_path, workers)
+        # With workers, the step only measures the wait for the pool's results
+        results = measure_batches("explode receipt items", results, rows=lambda result: len(result[0]))
+        for df_items, batch_stats in results:
+            writer.write(inline_checks.apply(df_items))
+            stats.add(batch_stats)
+    inline_checks.report()
+    return writer, stats
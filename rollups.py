@@ -0,0 +1,131 @@
+from config import KEY_TYPE
+from keys import integer_key_tables
+
+# Materialized brand rollups, maintained by load_to_sql.py.
+#
+# brand_daily_rollup holds, per receipt status, scan day and brandCode, the number of scanned
+# items, the quantity bought and the item spend. The grain is a day, not a month, because the
+# "recent month" of Q1/Q2 is the month before the latest scan day, not a calendar month; the
+# monthly figures are sums over days (brand_monthly_rollup view). brand_monthly_users counts
+# the items of every user per status, month and brand, so distinct users stay exact when
+# receipts change.
+#
+# A replace load rebuilds the rollups with one GROUP BY. An upsert load subtracts the
+# contribution of the stored versions of the incoming receipts, writes the new versions, and
+# adds their contribution back, all in the load transaction. With month partitions, the deltas
+# run once per pair of partition tables, and a reloaded month is subtracted as a whole.
+
+ROLLUP_TABLES = {
+    "brand_daily_rollup": """
+CREATE TABLE IF NOT EXISTS brand_daily_rollup (
+    status TEXT NOT NULL,
+    scanDay TEXT NOT NULL,
+    brandCode TEXT NOT NULL,
+    scans INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    spend REAL NOT NULL,
+    PRIMARY KEY (status, scanDay, brandCode)
+) WITHOUT ROWID;""",
+    "brand_monthly_users": """
+CREATE TABLE IF NOT EXISTS brand_monthly_users (
+    status TEXT NOT NULL,
+    scanMonth TEXT NOT NULL,
+    brandCode TEXT NOT NULL,
+    userId TEXT NOT NULL,
+    scans INTEGER NOT NULL,
+    PRIMARY KEY (status, scanMonth, brandCode, userId)
+) WITHOUT ROWID;""",
+}
+
+if KEY_TYPE == "integer":
+    ROLLUP_TABLES = integer_key_tables(ROLLUP_TABLES)
+
+ROLLUP_VIEWS = {
+    "brand_monthly_rollup": """
+CREATE VIEW IF NOT EXISTS brand_monthly_rollup AS
+SELECT d.status,
+       substr(d.scanDay, 1, 7) AS scanMonth,
+       d.brandCode,
+       SUM(d.scans) AS scans,
+       SUM(d.items) AS items,
+       SUM(d.spend) AS spend,
+       (SELECT COUNT(*) FROM brand_monthly_users AS u
+        WHERE u.status = d.status AND u.scanMonth = substr(d.scanDay, 1, 7) AND u.brandCode = d.brandCode) AS users
+FROM brand_daily_rollup AS d
+GROUP BY d.status, scanMonth, d.brandCode;""",
+}
+
+# Contribution of the receipts selected by {selection} to each rollup, multiplied by :sign (+1 or -1),
+# read from the tables {receipts} and {receiptItems} (or a pair of month partitions, see partitions.py).
+# Missing statuses and scan dates are grouped under '' so they still have a key.
+ROLLUP_DELTAS = {
+    "brand_daily_rollup": """
+INSERT INTO brand_daily_rollup (status, scanDay, brandCode, scans, items, spend)
+SELECT COALESCE(r.rewardsReceiptStatus, ''), COALESCE(date(r.dateScanned), ''), COALESCE(ri.brandCode, ''),
+       :sign * COUNT(*), :sign * COALESCE(SUM(ri.quantity), 0), :sign * TOTAL(ri.price)
+FROM {receiptItems} AS ri
+JOIN {receipts} AS r ON ri.receiptId = r._id
+WHERE {selection}
+GROUP BY 1, 2, 3
+ON CONFLICT (status, scanDay, brandCode) DO UPDATE SET
+    scans = scans + excluded.scans,
+    items = items + excluded.items,
+    spend = spend + excluded.spend""",
+    "brand_monthly_users": """
+INSERT INTO brand_monthly_users (status, scanMonth, brandCode, userId, scans)
+SELECT COALESCE(r.rewardsReceiptStatus, ''), COALESCE(strftime('%Y-%m', r.dateScanned), ''), COALESCE(ri.brandCode, ''),
+       r.userId, :sign * COUNT(*)
+FROM {receiptItems} AS ri
+JOIN {receipts} AS r ON ri.receiptId = r._id
+WHERE {selection} AND r.userId IS NOT NULL
+GROUP BY 1, 2, 3, 4
+ON CONFLICT (status, scanMonth, brandCode, userId) DO UPDATE SET
+    scans = scans + excluded.scans""",
+}
+
+
+# Tables the deltas read by default
+SOURCES = [("receipts", "receiptItems")]
+
+
+def rollups_exist(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'brand_daily_rollup'").fetchone()[0] > 0
+
+
+def apply_rollup_deltas(conn, selection, sign, sources=SOURCES):
+    """
+    Add (sign=1) or subtract (sign=-1) the contribution of the receipts matching the SQL condition
+    `selection` (on alias r) in every (receipts, receiptItems) pair of `sources`.
+    Rollup rows that drop to zero are deleted.
+    """
+    for receipts, receipt_items in sources:
+        for delta in ROLLUP_DELTAS.values():
+            conn.execute(delta.format(receipts=receipts, receiptItems=receipt_items, selection=selection), {"sign": sign})
+    if sign < 0:
+        for table in ROLLUP_DELTAS:
+            conn.execute(f"DELETE FROM {table} WHERE scans = 0")
+
+
+def rebuild_rollups(conn, sources=SOURCES):
+    """
+    Recreate the rollups from the receipts and receiptItems tables (or the pairs of tables in `sources`).
+    """
+    for table, ddl in ROLLUP_TABLES.items():
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(ddl)
+    for ddl in ROLLUP_VIEWS.values():
+        conn.execute(ddl)
+    apply_rollup_deltas(conn, "1", 1, sources)
+
+
+def update_rollups(conn, receipt_ids, sign, sources=SOURCES):
+    """
+    Add (sign=1) or subtract (sign=-1) the current contribution of `receipt_ids` to the rollups.
+
+    Call it with sign=-1 before the receipts and their items are overwritten and with sign=1
+    afterwards. Rollup rows that drop to zero are deleted.
+    """
+    conn.execute("CREATE TEMP TABLE rollup_receipts (_id PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO rollup_receipts VALUES (?)", ((i,) for i in receipt_ids))
+    apply_rollup_deltas(conn, "r._id IN (SELECT _id FROM rollup_receipts)", sign, sources)
+    conn.execute("DROP TABLE rollup_receipts")
@@ -0,0 +1,475 @@
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from columnar import read_table, scalar_columns, table_path
+from config import LOAD_COMMIT_ROWS, WORKERS, KEY_TYPE
+from keys import key_columns, integer_key_tables, assign_keys, key_lookup
+
+# SQLite loading engine used by load_to_sql.py.
+#
+# "replace" loads go through the bulk path: the declared tables are recreated, and the stage
+# outputs are streamed from Parquet into a constraint-free staging table with plain executemany
+# INSERTs, in transactions of LOAD_COMMIT_ROWS rows, under load-time PRAGMAs. The staging rows
+# are then copied into the declared table in primary-key order, so the key index is appended to
+# instead of updated at random positions (item ids are uuids). Secondary indexes are built and
+# references checked once the data is in. "upsert" loads diff DataFrames against the stored rows.
+#
+# With several workers, the row groups of a stage output are split into ranges that worker
+# processes insert into staging databases of their own at the same time, so the per-row Python
+# work (converting and binding values) runs on several cores. The main connection then attaches
+# the staging databases and copies them into the declared table in one sorted INSERT ... SELECT.
+#
+# With integer keys (FETCH_KEY_TYPE=integer, see keys.py), the ids of the staged rows are numbered
+# in key_map before that copy, and the copy looks up their keys, so the declared table is written
+# in key order.
+
+# Declared schema of every table; the columns match the cleaned stage outputs.
+# Every timestamp is stored twice: as 'YYYY-MM-DD HH:MM:SS' text, and as integer epoch
+# milliseconds in <column>Ms, which date range filters can compare against an index directly.
+TABLES = {
+    "users": """
+CREATE TABLE IF NOT EXISTS users (
+    _id TEXT PRIMARY KEY,
+    active BOOLEAN,
+    createdDate TIMESTAMP,
+    lastLogin TIMESTAMP,
+    role TEXT,
+    signUpSource TEXT,
+    state TEXT,
+    createdDateMs INTEGER,
+    lastLoginMs INTEGER
+);""",
+    "brands": """
+CREATE TABLE IF NOT EXISTS brands (
+    _id TEXT PRIMARY KEY,
+    barcode TEXT,
+    category TEXT,
+    categoryCode TEXT,
+    name TEXT,
+    topBrand BOOLEAN,
+    brandCode TEXT,
+    cpg_id TEXT
+);""",
+    "receipts": """
+CREATE TABLE IF NOT EXISTS receipts (
+    _id TEXT PRIMARY KEY,
+    bonusPointsEarned INTEGER,
+    bonusPointsEarnedReason TEXT,
+    createDate TIMESTAMP,
+    dateScanned TIMESTAMP,
+    finishedDate TIMESTAMP,
+    modifyDate TIMESTAMP,
+    pointsAwardedDate TIMESTAMP,
+    pointsEarned REAL,
+    purchaseDate TIMESTAMP,
+    purchasedItemCount INTEGER,
+    rewardsReceiptStatus TEXT,
+    totalSpent REAL,
+    userId TEXT,
+    createDateMs INTEGER,
+    dateScannedMs INTEGER,
+    finishedDateMs INTEGER,
+    modifyDateMs INTEGER,
+    pointsAwardedDateMs INTEGER,
+    purchaseDateMs INTEGER
+);""",
+    "receiptItems": """
+CREATE TABLE IF NOT EXISTS receiptItems (
+    _id TEXT PRIMARY KEY,
+    receiptId TEXT REFERENCES receipts(_id),
+    brandCode TEXT REFERENCES brands(brandCode),
+    barcode TEXT,
+    brandName TEXT,
+    description TEXT,
+    quantity INTEGER,
+    price REAL,
+    isBonus BOOLEAN,
+    needsFetchReview BOOLEAN
+);""",
+}
+if KEY_TYPE == "integer":
+    TABLES = integer_key_tables(TABLES)
+
+# Stage output loaded into each table
+TABLE_SOURCES = {
+    "users": "users_cleaned",
+    "brands": "brands_cleaned",
+    "receipts": "receipts_cleaned",
+    "receiptItems": "receiptItems_cleaned",
+}
+
+# Secondary indexes for the access paths of query_sql.py and check_data_quality.py, built after
+# a bulk load (one sorted pass each instead of per-row maintenance). Most are covering, so the
+# queries never visit the table rows; check_query_plans.py fails if a query falls back to a full scan.
+INDEXES = {
+    # Q1-Q6: status filter and dateScanned window, then the receipt _id for the item join,
+    # userId for the user join and totalSpent/purchasedItemCount for the aggregates (Q3/Q4).
+    "ix_receipts_status_dateScanned": """CREATE INDEX IF NOT EXISTS ix_receipts_status_dateScanned
+        ON receipts (rewardsReceiptStatus, dateScanned, _id, userId, totalSpent, purchasedItemCount)""",
+    # Q5/Q6 starting from the users in the createdDateMs window: their FINISHED receipts.
+    # Also the narrowest index to read for the receipts pass of check_data_quality.py.
+    "ix_receipts_userId": """CREATE INDEX IF NOT EXISTS ix_receipts_userId
+        ON receipts (userId, rewardsReceiptStatus, _id, totalSpent)""",
+    # MAX(dateScanned) anchor of Q1/Q2
+    "ix_receipts_dateScanned": "CREATE INDEX IF NOT EXISTS ix_receipts_dateScanned ON receipts (dateScanned)",
+    # receipt -> items join of Q1, Q2, Q5, Q6 (COUNT(ri._id) needs the item _id); with quantity
+    # and price it also covers the receiptItems pass of check_data_quality.py
+    "ix_receiptItems_receiptId": """CREATE INDEX IF NOT EXISTS ix_receiptItems_receiptId
+        ON receiptItems (receiptId, brandCode, _id, quantity, price)""",
+    # item -> brand join and brand names
+    "ix_brands_brandCode": "CREATE INDEX IF NOT EXISTS ix_brands_brandCode ON brands (brandCode, name)",
+    # Users pass of check_data_quality.py (reads the mandatory fields from the index)
+    "ix_users_createdDate": "CREATE INDEX IF NOT EXISTS ix_users_createdDate ON users (createdDate, role, _id)",
+    # MAX(createdDateMs) anchor and createdDateMs range of Q5/Q6
+    "ix_users_createdDateMs": "CREATE INDEX IF NOT EXISTS ix_users_createdDateMs ON users (createdDateMs, _id)",
+}
+
+# Indexes older versions of INDEXES created, dropped from existing databases
+RETIRED_INDEXES = ["ix_receiptItems_brandCode"]
+
+# PRAGMAs of the loading connection. They only live as long as the connection, except
+# journal_mode=WAL, which stays on the database file. A crash mid-load can lose the last
+# transactions (synchronous=OFF), but does not corrupt a WAL database.
+LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -256 * 1024,   # KiB, i.e. 256 MiB of page cache
+    "journal_size_limit": 64 * 1024 * 1024,   # truncate the WAL after large load transactions
+    "foreign_keys": "OFF",
+}
+
+# Timestamp text format the SQL queries compare against, and the suffix of the epoch-ms columns
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH_MS_SUFFIX = "Ms"
+
+# Staging databases of a parallel load; they are attached all at once, and SQLite allows 10
+MAX_STAGING_DATABASES = 8
+
+
+def apply_pragmas(conn, pragmas):
+    for pragma, value in pragmas.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+
+def sql_columns(schema):
+    """
+    Return the SQL columns loaded from a stage output schema: its scalar columns,
+    plus <column>Ms after the scalar columns for every timestamp.
+    """
+    scalar = [field for field in schema if not pa.types.is_nested(field.type)]
+    return ([field.name for field in scalar] +
+            [field.name + EPOCH_MS_SUFFIX for field in scalar if pa.types.is_timestamp(field.type)])
+
+
+def read_for_sql(name):
+    """
+    Read the scalar columns of a stage output, format timestamps as 'YYYY-MM-DD HH:MM:SS' text
+    and add their epoch-ms columns (see sql_columns).
+    """
+    df = read_table(name, columns=scalar_columns(name))
+    timestamps = list(df.select_dtypes(include="datetime").columns)
+    for col in timestamps:
+        epoch_ms = df[col].astype("datetime64[ms]").to_numpy().view("int64")
+        df[col + EPOCH_MS_SUFFIX] = pd.Series(epoch_ms, index=df.index, dtype="Int64").mask(df[col].isna())
+    for col in timestamps:
+        df[col] = df[col].dt.strftime(TIMESTAMP_FORMAT)
+    return df
+
+
+def sql_rows(df):
+    """
+    Yield the rows of `df` as tuples of plain Python values (None for missing) that sqlite3 can bind.
+    """
+    return df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+
+def arrow_rows(record_batch):
+    """
+    Return the rows of an Arrow record batch as tuples that sqlite3 can bind, in sql_columns order.
+
+    Columns are converted one at a time (timestamps to text with Arrow's strftime and to
+    epoch ms with a cast), which is much cheaper than going through a pandas object frame.
+    """
+    columns, epoch_ms = [], []
+    for column in record_batch.columns:
+        if pa.types.is_timestamp(column.type):
+            epoch_ms.append(pc.cast(pc.cast(column, pa.timestamp("ms")), pa.int64()).to_pylist())
+            # Truncate to seconds first; strftime would add the milliseconds to %S
+            column = pc.strftime(pc.cast(column, pa.timestamp("s"), safe=False), format=TIMESTAMP_FORMAT)
+        columns.append(column.to_pylist())
+    return zip(*columns, *epoch_ms)
+
+
+def row_group_ranges(parquet_file, parts):
+    """
+    Split the row groups of `parquet_file` into at most `parts` consecutive ranges of about as many rows.
+    """
+    sizes = np.array([parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)])
+    bounds = np.searchsorted(np.cumsum(sizes), np.linspace(0, sizes.sum(), parts + 1)[1:-1], side="right")
+    return [list(part) for part in np.split(np.arange(len(sizes)), bounds) if len(part)]
+
+
+def stage_row_groups(path, row_groups, staging_db, batch_size=100_000):
+    """
+    Insert `row_groups` of the Parquet file at `path` into table "staging" of the new database
+    `staging_db`, in sql_columns order. Runs in a worker process of bulk_load_parallel.
+    Returns the number of rows inserted.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    columns = [field.name for field in parquet_file.schema_arrow if not pa.types.is_nested(field.type)]
+    target_columns = sql_columns(parquet_file.schema_arrow)
+    conn = sqlite3.connect(staging_db)
+    try:
+        # A scratch file, deleted after the load: nothing to recover after a crash
+        apply_pragmas(conn, {"journal_mode": "OFF", "synchronous": "OFF"})
+        column_list = ", ".join(f'"{col}"' for col in target_columns)
+        conn.execute(f"CREATE TABLE staging ({column_list})")
+        insert = f"INSERT INTO staging VALUES ({', '.join('?' for _ in target_columns)})"
+        rows = 0
+        for record_batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+            conn.executemany(insert, arrow_rows(record_batch))
+            rows += record_batch.num_rows
+        conn.commit()
+    finally:
+        conn.close()
+    return rows
+
+
+def copy_staged(conn, table, source, columns, key="_id", keys=None):
+    """
+    Copy the rows of `source` (a table, or a subquery in parentheses) into `table`, sorted on `key`.
+    The id columns in `keys` ({column: kind}) are numbered and replaced by their keys (see keys.py).
+    """
+    column_list = ", ".join(f'"{col}"' for col in columns)
+    if not keys:
+        conn.execute(f'INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {source} ORDER BY "{key}"')
+        return
+    for column, kind in keys.items():
+        assign_keys(conn, kind, f'SELECT "{column}" AS id FROM {source}')
+    values = ", ".join(key_lookup(keys[col], f's."{col}"') if col in keys else f's."{col}"' for col in columns)
+    conn.execute(f"INSERT INTO {table} ({column_list}) SELECT {values} FROM {source} AS s "
+                 f"ORDER BY {columns.index(key) + 1}")
+
+
+def bulk_load_parallel(conn, table, path, workers, key="_id", keys=None):
+    """
+    Load the Parquet file at `path` into `table` through staging databases written by
+    `workers` processes (see the module comment). Returns the number of rows inserted.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    ranges = row_group_ranges(parquet_file, min(workers, MAX_STAGING_DATABASES))
+    columns = sql_columns(parquet_file.schema_arrow)
+    # Next to the database, where there is room for the same rows
+    main_db = conn.execute("PRAGMA database_list").fetchone()[2]
+    staging_dir = tempfile.mkdtemp(prefix=f"staging-{table}-", dir=os.path.dirname(main_db) or None)
+    staging_dbs = [os.path.join(staging_dir, f"part-{i}.db") for i in range(len(ranges))]
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            rows = sum(pool.map(stage_row_groups, [path] * len(ranges), ranges, staging_dbs))
+        # ATTACH and DETACH cannot run inside a transaction
+        conn.commit()
+        for i, staging_db in enumerate(staging_dbs):
+            conn.execute(f"ATTACH DATABASE ? AS staging_{i}", (staging_db,))
+        union = " UNION ALL ".join(f"SELECT * FROM staging_{i}.staging" for i in range(len(staging_dbs)))
+        copy_staged(conn, table, f"({union})", columns, key, keys)
+        conn.commit()
+        for i in range(len(staging_dbs)):
+            conn.execute(f"DETACH DATABASE staging_{i}")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return rows
+
+
+def bulk_load_table(conn, table, path, key="_id", commit_rows=LOAD_COMMIT_ROWS, batch_size=100_000, workers=1,
+                    keys=None):
+    """
+    Stream the scalar columns of the Parquet file at `path` into `table`, with the
+    epoch-ms columns of its timestamps.
+
+    Rows are inserted with executemany into a staging table without constraints, committed
+    every `commit_rows` rows so the WAL stays bounded, and then copied into `table` sorted
+    on `key`, with the ids of `keys` replaced by their integer keys (see copy_staged). With more
+    than one worker and row group, bulk_load_parallel does the staging.
+    Returns the number of rows inserted.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    if workers > 1 and parquet_file.num_row_groups > 1:
+        return bulk_load_parallel(conn, table, path, workers, key, keys)
+    columns = [field.name for field in parquet_file.schema_arrow if not pa.types.is_nested(field.type)]
+    target_columns = sql_columns(parquet_file.schema_arrow)
+    column_list = ", ".join(f'"{col}"' for col in target_columns)
+    placeholders = ", ".join("?" for _ in target_columns)
+    staging = f"staging_{table}"
+    conn.execute(f"DROP TABLE IF EXISTS {staging}")
+    # Untyped columns, so ids are staged as they are (no numeric conversion of brand codes)
+    conn.execute(f"CREATE TABLE {staging} ({column_list})")
+    insert = f"INSERT INTO {staging} ({column_list}) VALUES ({placeholders})"
+
+    rows = uncommitted = 0
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        conn.executemany(insert, arrow_rows(record_batch))
+        rows += record_batch.num_rows
+        uncommitted += record_batch.num_rows
+        if uncommitted >= commit_rows:
+            conn.commit()
+            uncommitted = 0
+
+    copy_staged(conn, table, staging, target_columns, key, keys)
+    conn.execute(f"DROP TABLE {staging}")
+    return rows
+
+
+def bulk_load(conn, tables=TABLE_SOURCES, workers=WORKERS):
+    """
+    Recreate `tables` with their declared DDL and bulk-load them from the stage outputs.
+    Returns {table: (rows, seconds)}.
+    """
+    apply_pragmas(conn, LOAD_PRAGMAS)
+    conn.executescript("".join(f"\nDROP TABLE IF EXISTS {table};{TABLES[table]}\n" for table in tables))
+    stats = {}
+    for table, name in tables.items():
+        start = time.perf_counter()
+        rows = bulk_load_table(conn, table, table_path(name), workers=workers, keys=key_columns(table))
+        conn.commit()
+        stats[table] = (rows, time.perf_counter() - start)
+    return stats
+
+
+def add_missing_columns(conn, tables=TABLES):
+    """
+    Add the declared columns that the tables of an older database do not have yet.
+
+    New epoch-ms columns are filled from their text timestamp (to the second), so upsert
+    loads keep working on databases created before those columns existed.
+    """
+    for table, ddl in tables.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, definition in re.findall(r"^    (\w+) ([^,\n]+),?$", ddl, re.MULTILINE):
+            if name in existing:
+                continue
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            base = name[:-len(EPOCH_MS_SUFFIX)]
+            if name.endswith(EPOCH_MS_SUFFIX) and base in existing:
+                conn.execute(f"UPDATE {table} SET {name} = CAST(strftime('%s', {base}) AS INTEGER) * 1000 "
+                             f"WHERE {base} IS NOT NULL")
+
+
+def create_indexes(conn, indexes=INDEXES):
+    """
+    Build the secondary indexes and refresh the planner statistics.
+
+    Indexes of an existing database whose definition changed are rebuilt, and RETIRED_INDEXES dropped.
+    """
+    for name in RETIRED_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, ddl in indexes.items():
+        stored = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()
+        # SQLite stores the statement without IF NOT EXISTS
+        if stored and " ".join(stored[0].split()) != " ".join(ddl.replace(" IF NOT EXISTS", "").split()):
+            conn.execute(f"DROP INDEX {name}")
+        conn.execute(ddl)
+    # Sample at most 1000 rows per index, so ANALYZE stays cheap on large tables
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+
+
+def check_references(conn, tables=TABLES):
+    """
+    Count the rows that break a declared REFERENCES constraint.
+
+    Foreign keys are not enforced while loading (the source data has known orphans, which
+    check_data_quality.py reports), so this runs once after the load. The constraints are read
+    from the declared DDL, so they are also checked when a table is a view over partitions.
+    Returns {(table, column, referenced table, referenced column): orphan rows}.
+    """
+    orphans = {}
+    for table, ddl in tables.items():
+        for column, parent, parent_column in re.findall(r"^    (\w+) \w+ REFERENCES (\w+)\((\w+)\)", ddl, re.MULTILINE):
+            orphans[(table, column, parent, parent_column)] = conn.execute(f"""
+                SELECT COUNT(*) FROM {table} AS c
+                WHERE c."{column}" IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {parent} AS p WHERE p."{parent_column}" = c."{column}")
+            """).fetchone()[0]
+    return orphans
+
+
+def upsert_table(conn, table, df, key="_id"):
+    """
+    Insert the rows of `df` that are new to `table` and update the ones whose values changed.
+
+    Rows that are identical to what is already stored are skipped by the WHERE clause of the
+    upsert, so re-loading unchanged data writes nothing. Returns the number of rows written.
+    """
+    # ON CONFLICT needs a unique index on the key, also for tables created by an older "replace" load;
+    # an INTEGER PRIMARY KEY is the rowid and needs none
+    if not any(name == key and declared == "INTEGER" and pk
+               for _, name, declared, _, _, pk in conn.execute(f"PRAGMA table_info({table})")):
+        conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_{key} ON {table} ("{key}")')
+
+    columns = list(df.columns)
+    column_list = ", ".join(f'"{col}"' for col in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    assignments = ", ".join(f'"{col}" = excluded."{col}"' for col in columns if col != key)
+    changed = " OR ".join(f'{table}."{col}" IS NOT excluded."{col}"' for col in columns if col != key)
+
+    before = conn.total_changes
+    conn.executemany(
+        f'INSERT INTO {table} ({column_list}) VALUES ({placeholders}) '
+        f'ON CONFLICT("{key}") DO UPDATE SET {assignments} WHERE {changed}',
+        sql_rows(df),
+    )
+    return conn.total_changes - before
+
+
+def delete_stale_items(conn, receipt_ids, item_ids):
+    """
+    Delete the stored items of the given receipts that are no longer part of them.
+    Returns the number of rows deleted.
+    """
+    # Untyped keys, as the ids are text or integer keys (see keys.py)
+    conn.execute("CREATE TEMP TABLE loaded_receipts (_id PRIMARY KEY)")
+    conn.execute("CREATE TEMP TABLE loaded_items (_id PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO loaded_receipts VALUES (?)", ((i,) for i in receipt_ids))
+    conn.executemany("INSERT OR IGNORE INTO loaded_items VALUES (?)", ((i,) for i in item_ids))
+    deleted = conn.execute("""
+        DELETE FROM receiptItems
+        WHERE receiptId IN (SELECT _id FROM loaded_receipts)
+          AND _id NOT IN (SELECT _id FROM loaded_items)
+    """).rowcount
+    conn.execute("DROP TABLE loaded_receipts")
+    conn.execute("DROP TABLE loaded_items")
+    return deleted
+
+
+def keep_latest_receipts(conn, df_receipts):
+    """
+    Drop incoming receipts that are older than the version already stored.
+
+    This keeps the latest-`dateScanned` rule of clean_receipts.py when receipts are merged
+    across runs: the incoming row wins when its dateScanned is the same or newer.
+    A missing dateScanned counts as the latest, as it sorts first in clean_receipts.py.
+    """
+    conn.execute("CREATE TEMP TABLE incoming_receipts (_id PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO incoming_receipts VALUES (?)", ((i,) for i in df_receipts["_id"]))
+    df_stored = pd.read_sql("""
+        SELECT r._id, r.dateScanned AS storedDateScanned
+        FROM receipts AS r
+        JOIN incoming_receipts AS i ON i._id = r._id
+    """, conn)
+    conn.execute("DROP TABLE incoming_receipts")
+
+    df = df_receipts.merge(df_stored, on="_id", how="left", indicator=True)
+    is_new = (df["_merge"] == "left_only").to_numpy()
+    incoming_latest = df["dateScanned"].isna() | (df["storedDateScanned"].notna() & (df["dateScanned"] >= df["storedDateScanned"]))
+    return df_receipts[is_new | incoming_latest.to_numpy()]
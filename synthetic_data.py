@@ -0,0 +1,308 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import tarfile
+import time
+
+import numpy as np
+
+# Synthetic source data for scaling tests.
+# Usage: python synthetic_data.py OUTPUT_DIR --receipts 100000 [--seed 0] [...]
+#
+# Writes users.json.gz (a tar.gz holding users.json, like the sample), brands.json.gz and
+# receipts.json.gz in the Mongo extended-JSON shape of the files in data/, so the pipeline runs
+# on them unchanged with FETCH_DATA_PATH=OUTPUT_DIR. Field presence, status mix, item counts and
+# category mix follow the sample data. On top of that:
+#   - brand popularity is Zipf-distributed (--brand-skew is the exponent),
+#   - --duplicate-rate of the users and receipts are written again (receipts with a later scan),
+#   - --malformed-rate of the receipts carry a broken item list (missing, non-numeric or
+#     empty prices and quantities, items without any field, empty lists),
+#   - --orphan-rate of the receipts belong to a user that is not in users.json.
+# Users scale with receipts / 5 and brands with receipts / 10 (at least 1,000), as in the sample.
+# Records are generated in chunks of CHUNK_RECEIPTS, so memory does not grow with the scale.
+
+CHUNK_RECEIPTS = 50_000
+# Latest scan date of the generated receipts (2021-03-01); everything else is placed before it
+ANCHOR_MS = 1614556800000
+DAY_MS = 86_400_000
+
+STATUSES = (["FINISHED", "SUBMITTED", "REJECTED", "PENDING", "FLAGGED"], [0.46, 0.39, 0.06, 0.05, 0.04])
+# Number of items per receipt in the sample
+ITEM_COUNTS = ([0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11], [440, 377, 118, 10, 30, 77, 2, 3, 10, 11, 13])
+CATEGORIES = ["Baking", "Beer Wine Spirits", "Snacks", "Candy & Sweets", "Beverages", "Magazines",
+              "Health & Wellness", "Condiments & Sauces", "Dairy", "Frozen", None]
+CATEGORY_WEIGHTS = [0.32, 0.08, 0.07, 0.06, 0.05, 0.05, 0.05, 0.04, 0.04, 0.04, 0.20]
+STATES = (["WI", "NH", "AL", "OH", "IL", "KY", "CO", None], [0.80, 0.04, 0.03, 0.01, 0.01, 0.005, 0.005, 0.10])
+SIGN_UP_SOURCES = (["Email", "Google", None], [0.895, 0.01, 0.095])
+BONUS_REASONS = ["All-receipts receipt bonus", "COMPLETE_NONPARTNER_RECEIPT", "COMPLETE_PARTNER_RECEIPT",
+                 "Receipt number 1 completed, bonus point schedule DEFAULT (5cefdcacf3693e0b50e83a36)"]
+WORDS = ["KRAFT", "ORGANIC", "CHEESE", "PIZZA", "COLA", "CHIPS", "YOGURT", "COFFEE", "SOUP", "BREAD",
+         "DELUXE", "LIGHT", "ORIGINAL", "SPICY", "FAMILY", "SIZE", "12 OZ", "2 LB", "PACK", "CLASSIC"]
+
+
+def object_ids(rng, seconds, count, start):
+    """
+    Return `count` ObjectId hex strings: creation second, random bytes and a running counter.
+    """
+    random_part = rng.integers(0, 2**40, count)
+    return [f"{s:08x}{r:010x}{(start + i) % 2**24:06x}" for i, (s, r) in enumerate(zip(seconds, random_part))]
+
+
+def oid(value):
+    return {"$oid": value}
+
+
+def date(millis):
+    return {"$date": int(millis)}
+
+
+def choose(rng, values, weights, count):
+    weights = np.asarray(weights, dtype=float)
+    return [values[i] for i in rng.choice(len(values), count, p=weights / weights.sum())]
+
+
+def generate_brands(rng, count):
+    """
+    Return the brand records and, per brand, the (barcode, brandCode) the items use to reference it.
+    """
+    barcodes = [f"511111{n:06d}" for n in rng.permutation(10**6)[:count]]
+    created = (ANCHOR_MS - rng.integers(0, 365 * DAY_MS, count)) // 1000
+    ids = object_ids(rng, created, count, 0)
+    cpg_ids = object_ids(rng, created, count, count)
+    categories = choose(rng, CATEGORIES, CATEGORY_WEIGHTS, count)
+    records, references = [], []
+    for i in range(count):
+        words = rng.choice(len(WORDS), 2, replace=False)
+        name = f"{WORDS[words[0]].title()} {WORDS[words[1]].title()} {i}"
+        if rng.random() < 0.02:
+            name = f"test brand @{created[i] * 1000}"
+        record = {"_id": oid(ids[i]), "barcode": barcodes[i], "category": categories[i]}
+        if categories[i] is None:
+            del record["category"]
+        elif rng.random() < 0.5:
+            record["categoryCode"] = categories[i].upper().replace(" & ", "_AND_").replace(" ", "_")
+        record["cpg"] = {"$id": oid(cpg_ids[i]), "$ref": "Cogs" if rng.random() < 0.9 else "Cpgs"}
+        record["name"] = name
+        if rng.random() < 0.55:
+            record["topBrand"] = bool(rng.random() < 0.05)
+        # About a third of the brands have no brandCode; the cleaner falls back to the barcode
+        brand_code = name.upper() if rng.random() < 0.7 else None
+        if brand_code is not None:
+            record["brandCode"] = brand_code
+        records.append(record)
+        references.append((barcodes[i], brand_code))
+    return records, references
+
+
+def generate_users(rng, count):
+    """
+    Return the user records (before duplication) and their ids.
+    """
+    created = ANCHOR_MS - rng.integers(30 * DAY_MS, 730 * DAY_MS, count)
+    ids = object_ids(rng, created // 1000, count, 0)
+    roles = choose(rng, ["consumer", "fetch-staff"], [0.83, 0.17], count)
+    sources = choose(rng, *SIGN_UP_SOURCES, count)
+    states = choose(rng, *STATES, count)
+    records = []
+    for i in range(count):
+        record = {"_id": oid(ids[i]), "active": True, "createdDate": date(created[i])}
+        if rng.random() < 0.87:
+            record["lastLogin"] = date(created[i] + rng.integers(0, ANCHOR_MS - created[i]))
+        record["role"] = roles[i]
+        if sources[i] is not None:
+            record["signUpSource"] = sources[i]
+        if states[i] is not None:
+            record["state"] = states[i]
+        records.append(record)
+    return records, ids
+
+
+def item_record(rng, position, brand_reference):
+    """
+    One well-formed receipt item; `brand_reference` is the (barcode, brandCode) of its brand or None.
+    """
+    price = round(float(rng.gamma(2.0, 3.0)) + 0.49, 2)
+    quantity = int(rng.integers(1, 4))
+    item = {}
+    if brand_reference is not None:
+        barcode, brand_code = brand_reference
+        if rng.random() < 0.6:
+            item["barcode"] = barcode
+        if brand_code is not None and rng.random() < 0.8:
+            item["brandCode"] = brand_code
+    elif rng.random() < 0.3:
+        item["barcode"] = f"0{rng.integers(10**10, 10**11)}"
+    words = rng.choice(len(WORDS), 3)
+    item["description"] = " ".join(WORDS[w] for w in words)
+    item["discountedItemPrice"] = f"{price:.2f}"
+    item["finalPrice"] = f"{price * quantity:.2f}"
+    item["itemPrice"] = f"{price * quantity:.2f}"
+    if rng.random() < 0.12:
+        item["needsFetchReview"] = bool(rng.random() < 0.3)
+    item["partnerItemId"] = str(position + 1)
+    item["quantityPurchased"] = quantity
+    if rng.random() < 0.05:
+        item["userFlaggedBarcode"] = item.get("barcode", f"0{rng.integers(10**10, 10**11)}")
+        item["userFlaggedPrice"] = item["finalPrice"]
+        item["userFlaggedQuantity"] = quantity
+        item["userFlaggedNewItem"] = True
+    return item
+
+
+def malform(rng, items):
+    """
+    Break an item list the way real item lists break.
+    """
+    kind = rng.integers(0, 4)
+    if kind == 0 or not items:
+        return []
+    item = items[rng.integers(0, len(items))]
+    if kind == 1:
+        for field in ["finalPrice", "itemPrice", "quantityPurchased", "description"]:
+            item.pop(field, None)
+    elif kind == 2:
+        item["finalPrice"] = rng.choice(["", "N/A", "-"])
+        item["itemPrice"] = item["finalPrice"]
+    else:
+        items.append({})
+    return items
+
+
+def price(item):
+    """
+    The item's finalPrice as a number, 0 when it is missing or malformed.
+    """
+    try:
+        return float(item.get("finalPrice") or 0)
+    except ValueError:
+        return 0.0
+
+
+def receipt_record(rng, receipt_id, user_id, scanned, status, item_brands, brand_references, malformed):
+    """
+    One receipt; `item_brands` are the brand positions of its items.
+    """
+    items = [item_record(rng, position, brand_references[b] if rng.random() < 0.5 else None)
+             for position, b in enumerate(item_brands)]
+    if malformed:
+        items = malform(rng, items)
+    record = {"_id": oid(receipt_id)}
+    if status == "FINISHED" or rng.random() < 0.3:
+        record["bonusPointsEarned"] = int(rng.choice([5, 25, 250, 500, 750]))
+        record["bonusPointsEarnedReason"] = BONUS_REASONS[rng.integers(0, len(BONUS_REASONS))]
+    record["createDate"] = date(scanned)
+    record["dateScanned"] = date(scanned)
+    if status == "FINISHED":
+        record["finishedDate"] = date(scanned + rng.integers(0, DAY_MS))
+        record["pointsAwardedDate"] = date(scanned + rng.integers(0, DAY_MS))
+    record["modifyDate"] = date(scanned + rng.integers(0, 2 * DAY_MS))
+    if items or rng.random() < 0.1:
+        record["pointsEarned"] = f"{rng.integers(0, 1000) * 5:.1f}"
+        record["purchaseDate"] = date(scanned - rng.integers(0, 5) * DAY_MS)
+        record["purchasedItemCount"] = sum(item.get("quantityPurchased", 1) for item in items)
+        record["rewardsReceiptItemList"] = items
+        record["totalSpent"] = f"{sum(map(price, items)):.2f}"
+    record["rewardsReceiptStatus"] = status
+    record["userId"] = user_id
+    return record
+
+
+def chunk_receipts(rng, start, size, user_ids, brand_references, brand_weights, orphan_rate, malformed_rate,
+                   duplicate_rate):
+    """
+    Generate the receipts start..start+size, followed by the re-submitted copies of some of them.
+    """
+    scanned = ANCHOR_MS - rng.integers(0, 365 * DAY_MS, size)
+    ids = object_ids(rng, scanned // 1000, size, start)
+    orphan_ids = object_ids(rng, scanned // 1000, size, start + size)
+    owners = rng.integers(0, len(user_ids), size)
+    orphans = rng.random(size) < orphan_rate
+    malformed = rng.random(size) < malformed_rate
+    statuses = choose(rng, *STATUSES, size)
+    item_counts = np.array(choose(rng, *ITEM_COUNTS, size))
+    item_brands = np.split(rng.choice(len(brand_references), item_counts.sum(), p=brand_weights),
+                           np.cumsum(item_counts)[:-1])
+
+    records = []
+    for i in range(size):
+        user_id = orphan_ids[i] if orphans[i] else user_ids[owners[i]]
+        records.append(receipt_record(rng, ids[i], user_id, scanned[i], statuses[i], item_brands[i],
+                                      brand_references, malformed[i]))
+    # Re-submitted receipts: same _id, scanned again later
+    for i in np.flatnonzero(rng.random(size) < duplicate_rate):
+        rescanned = min(scanned[i] + int(rng.integers(1, 3 * DAY_MS)), ANCHOR_MS)
+        records.append(receipt_record(rng, ids[i], records[i]["userId"], rescanned, choose(rng, *STATUSES, 1)[0],
+                                      item_brands[i], brand_references, False))
+    return records
+
+
+def write_ndjson(f, records):
+    f.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records).encode())
+
+
+def generate(output_dir, receipts, seed=0, brand_skew=1.2, duplicate_rate=0.05, malformed_rate=0.01,
+             orphan_rate=0.1, compresslevel=1):
+    """
+    Write the three synthetic source files to `output_dir`; returns the number of records per file.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    user_count = max(receipts // 5, 1)
+    brand_count = max(receipts // 10, 1000)
+    counts = {}
+
+    brand_records, brand_references = generate_brands(rng, brand_count)
+    with gzip.open(os.path.join(output_dir, "brands.json.gz"), "wb", compresslevel=compresslevel) as f:
+        write_ndjson(f, brand_records)
+    counts["brands"] = len(brand_records)
+
+    # users.json.gz is a tar archive of users.json, as in the sample
+    user_records, user_ids = generate_users(rng, user_count)
+    user_records += [user_records[i] for i in rng.integers(0, user_count, int(user_count * duplicate_rate))]
+    users_json = io.BytesIO()
+    write_ndjson(users_json, user_records)
+    member = tarfile.TarInfo("users.json")
+    member.size = users_json.tell()
+    member.mtime = int(time.time())
+    users_json.seek(0)
+    with tarfile.open(os.path.join(output_dir, "users.json.gz"), "w:gz", compresslevel=compresslevel) as tar:
+        tar.addfile(member, users_json)
+    counts["users"] = len(user_records)
+
+    # Item brands follow a Zipf law over a random order of the brands
+    ranks = rng.permutation(brand_count) + 1
+    brand_weights = 1.0 / ranks ** brand_skew
+    brand_weights /= brand_weights.sum()
+
+    written = 0
+    with gzip.open(os.path.join(output_dir, "receipts.json.gz"), "wb", compresslevel=compresslevel) as f:
+        for start in range(0, receipts, CHUNK_RECEIPTS):
+            records = chunk_receipts(rng, start, min(CHUNK_RECEIPTS, receipts - start), user_ids, brand_references,
+                                     brand_weights, orphan_rate, malformed_rate, duplicate_rate)
+            write_ndjson(f, records)
+            written += len(records)
+    counts["receipts"] = written
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic users/brands/receipts source files.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--receipts", type=int, default=10_000, help="number of distinct receipts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--brand-skew", type=float, default=1.2, help="Zipf exponent of brand popularity")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="share of users and receipts written twice")
+    parser.add_argument("--malformed-rate", type=float, default=0.01, help="share of receipts with a broken item list")
+    parser.add_argument("--orphan-rate", type=float, default=0.1, help="share of receipts of an unknown user")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(args.output_dir, args.receipts, args.seed, args.brand_skew, args.duplicate_rate,
+                      args.malformed_rate, args.orphan_rate)
+    print(f"Wrote {counts} to {args.output_dir} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pandas as pd
+import pyarrow as pa
+
+import receipt_items
+from brand_index import INDEX_SCHEMA, build_brand_index
+from columnar import to_arrow
+
+
+def explode(items, tmp_path):
+    """
+    Clean one receipt holding `items` into the receipts_cleaned schema and explode it.
+    """
+    index_path = str(tmp_path / "brand_index.arrow")
+    brands = pd.DataFrame({"barcode": ["511111"], "brandCode": ["TEST"], "name": ["Test Brand"]})
+    with pa.OSFile(index_path, "wb") as sink, pa.ipc.new_file(sink, INDEX_SCHEMA) as writer:
+        writer.write_table(build_brand_index(brands))
+    receipt_items._init_worker(index_path)
+
+    table = to_arrow(pd.DataFrame({"_id": ["r1"], "rewardsReceiptItemList": [items]}), "receipts_cleaned")
+    df_items, _ = receipt_items.explode_receipt_items(table.select(receipt_items.RECEIPT_COLUMNS).to_batches()[0])
+    return df_items
+
+
+def test_quantities_sent_as_text_or_numbers(tmp_path):
+    items = [
+        {"partnerItemId": "1", "quantityPurchased": "2", "userFlaggedQuantity": 2},
+        {"partnerItemId": "2", "quantityPurchased": 3, "originalMetaBriteQuantityPurchased": 3},
+        {"partnerItemId": "3", "quantityPurchased": " 4 "},
+        {"partnerItemId": "4", "quantityPurchased": 2.0},
+    ]
+    assert explode(items, tmp_path)["quantity"].tolist() == [2, 3, 4, 2]
+
+
+def test_non_numeric_quantities_count_as_one(tmp_path):
+    items = [
+        {"partnerItemId": "1", "quantityPurchased": "two"},
+        {"partnerItemId": "2", "quantityPurchased": ""},
+        {"partnerItemId": "3", "quantityPurchased": None},
+        {"partnerItemId": "4"},
+    ]
+    assert explode(items, tmp_path)["quantity"].tolist() == [1, 1, 1, 1]
+
+
+def test_bonus_items(tmp_path):
+    items = [{"partnerItemId": "1", "isBonus": True}, {"partnerItemId": "2", "isBonus": False}, {"partnerItemId": "3"}]
+    assert explode(items, tmp_path)["isBonus"].tolist() == [True, False, False]
+
+
+def test_unknown_item_keys_are_counted():
+    items = [{"partnerItemId": "1", "couponCode": "X"}, {"partnerItemId": "2", "couponCode": "Y", "aisle": 4}]
+    unknown_keys = Counter()
+    table = to_arrow(pd.DataFrame({"_id": ["r1"], "rewardsReceiptItemList": [items]}), "receipts_cleaned", unknown_keys)
+    assert unknown_keys == {"couponCode": 2, "aisle": 1}
+    assert table["rewardsReceiptItemList"][0][1].as_py()["partnerItemId"] == "2"
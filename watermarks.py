@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+
+from config import DB_PATH, STATE_PATH, INCREMENTAL
+from extended_json import parse_date_ms
+
+# High-watermarks for incremental runs.
+#
+# The cleaning scripts track the newest change timestamp (epoch ms) they saw in each source
+# and stage it in data/state/watermarks.<source>.pending.json (one file per source, so the
+# cleaning stages can run concurrently). load_to_sql.py commits the staged values
+# into the `pipeline_watermarks` table of fetch_data.db in the same transaction as the data,
+# so a watermark only moves forward once the rows behind it are in the database.
+
+PENDING_PATTERN = os.path.join(STATE_PATH, "watermarks.{source}.pending.json")
+
+# Source fields that drive each watermark; later fields are fallbacks for records without the first one
+WATERMARK_FIELDS = {
+    "receipts": ["modifyDate", "dateScanned"],
+    "users": ["lastLogin", "createdDate"],
+}
+
+WATERMARK_TABLE = """
+CREATE TABLE IF NOT EXISTS pipeline_watermarks (
+    source TEXT PRIMARY KEY,
+    watermark INTEGER NOT NULL
+);"""
+
+
+def load_watermarks(db_path=DB_PATH):
+    """
+    Return the committed watermarks as {source: epoch ms}; empty if nothing has been loaded yet.
+    """
+    if not os.path.exists(db_path):
+        return {}
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(WATERMARK_TABLE)
+        return dict(conn.execute("SELECT source, watermark FROM pipeline_watermarks"))
+
+
+def change_stamps(df, fields):
+    """
+    Return the change timestamp (epoch ms, nullable) of every raw record in `df`.
+    """
+    stamps = parse_date_ms(df[fields[0]])
+    for field in fields[1:]:
+        stamps = stamps.fillna(parse_date_ms(df[field]))
+    return stamps
+
+
+class ChangeFilter:
+    """
+    Select the raw records of a source that changed since its committed watermark.
+
+    With incremental runs disabled every record passes, but the high-watermark is still
+    tracked, so a full run sets the starting point of the next incremental run.
+    Records without any change timestamp always pass, and so do records stamped exactly at the
+    watermark: one of them may have missed the previous dump, and the upsert load skips the
+    rows that did not change.
+    """
+
+    def __init__(self, source, incremental=INCREMENTAL):
+        self.source = source
+        self.since = load_watermarks().get(source) if incremental else None
+        self.high = self.since
+
+    def filter(self, df_batch):
+        stamps = change_stamps(df_batch, WATERMARK_FIELDS[self.source])
+        if stamps.notna().any():
+            self.high = max(self.high or 0, int(stamps.max()))
+        if self.since is None:
+            return df_batch
+        return df_batch[(stamps >= self.since).fillna(True).to_numpy(dtype=bool)]
+
+    def observe(self, high):
+        """
+        Take in the high-watermark of records filtered by another ChangeFilter (a worker process's).
+        """
+        if high is not None:
+            self.high = max(self.high or 0, high)
+
+    def stage(self):
+        """
+        Stage the new high-watermark; load_to_sql.py commits it after loading the data.
+        """
+        if self.high is None:
+            return
+        os.makedirs(STATE_PATH, exist_ok=True)
+        pending_file = PENDING_PATTERN.format(source=self.source)
+        tmp_file = pending_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.high, f)
+        os.replace(tmp_file, pending_file)
+
+
+def read_pending():
+    """
+    Return the staged watermarks as {source: epoch ms}.
+    """
+    pending = {}
+    for source in WATERMARK_FIELDS:
+        pending_file = PENDING_PATTERN.format(source=source)
+        if os.path.exists(pending_file):
+            with open(pending_file) as f:
+                pending[source] = json.load(f)
+    return pending
+
+
+def commit_pending(conn):
+    """
+    Write the staged watermarks into `pipeline_watermarks` on `conn`.
+
+    Call this inside the load transaction; watermarks never move backwards.
+    Returns the committed watermarks.
+    """
+    conn.execute(WATERMARK_TABLE)
+    for source, watermark in read_pending().items():
+        conn.execute("""
+            INSERT INTO pipeline_watermarks (source, watermark) VALUES (?, ?)
+            ON CONFLICT(source) DO UPDATE SET watermark = MAX(watermark, excluded.watermark)
+        """, (source, watermark))
+    return dict(conn.execute("SELECT source, watermark FROM pipeline_watermarks"))
+
+
+def clear_pending():
+    for source in WATERMARK_FIELDS:
+        pending_file = PENDING_PATTERN.format(source=source)
+        if os.path.exists(pending_file):
+            os.remove(pending_file)